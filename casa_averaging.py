@@ -0,0 +1,171 @@
+# Pre-averaging of the target MS
+# Averaging in frequency and time smears sources away from the phase centre
+# (bandwidth and time-average smearing). For the imaged field the amount of
+# averaging that keeps the peak loss at the field edge below a tolerance
+# follows from Bridle & Schwab (1999, Synthesis Imaging in Radio Astronomy
+# II, lecture 18), for a square bandpass and a Gaussian taper:
+#   bandwidth:  I/I0 = 1.0645 erf(0.8326 beta) / beta,
+#               beta = (dnu / nu) (theta / theta_b)
+#   time:       I/I0 = 1 - 1.22e-9 (theta / theta_b)^2 tau^2   (tau in s)
+# with theta the distance from the phase centre and theta_b the synthesised
+# beam (lambda / longest baseline). beta does not depend on frequency, while
+# time smearing is worst at the top of the band.
+# averaging_pars() turns the limits into mstransform chanaverage/timeaverage
+# parameters for the split of the target. The time bin is also kept within
+# the shortest time slice or snapshot (maxtime), so that the transient is
+# not averaged with the data around it, and averaged_spw() moves a channel
+# selection made on the original MS to the averaged channels.
+
+import math
+
+import numpy as np
+
+import casa_timeslices
+
+SPEED_OF_LIGHT = 299792458.0
+TIME_SMEARING = 1.22e-9
+
+# ------------------------------------------------------------------------
+
+def bandwidth_loss(beta):
+    # Fractional peak loss from bandwidth smearing
+    if beta <= 0:
+        return 0.0
+    return 1.0 - 1.0645 * math.erf(0.8326 * beta) / beta
+
+
+def time_loss(ratio, tau):
+    # Fractional peak loss from time-average smearing at ratio = theta / theta_b
+    return TIME_SMEARING * (ratio * tau) ** 2
+
+
+def max_beta(tolerance):
+    # Largest beta with bandwidth_loss(beta) <= tolerance (bisection; the
+    # loss grows monotonically with beta)
+    lo, hi = 0.0, 10.0
+    for i in range(60):
+        mid = 0.5 * (lo + hi)
+        if bandwidth_loss(mid) <= tolerance:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def max_chanwidth(radius, maxbaseline, tolerance = 0.01):
+    # Widest channel (Hz) for a field of radius (radians) and the longest
+    # baseline (m)
+    return max_beta(tolerance) * SPEED_OF_LIGHT / (radius * maxbaseline)
+
+
+def max_timebin(radius, maxbaseline, maxfreq, tolerance = 0.01):
+    # Longest averaging time (s) at the highest frequency (Hz)
+    beam = SPEED_OF_LIGHT / (maxfreq * maxbaseline)
+    return math.sqrt(tolerance / TIME_SMEARING) * beam / radius
+
+def duration(value):
+    # Length in seconds of a CASA timerange ('2019/06/01/12:00:00~12:01:00',
+    # the stop time may leave out the date) or a time quantity ('16s');
+    # None for ''
+    if not value:
+        return None
+    from casatools import quanta
+    qa = quanta()
+    if '~' not in value:
+        return qa.convert(qa.quantity(value), 's')['value']
+    start, stop = value.split('~')
+    if '/' in start and '/' not in stop:
+        stop = start.rsplit('/', 1)[0] + '/' + stop
+    return qa.convert(qa.totime(stop), 's')['value'] - qa.convert(qa.totime(start), 's')['value']
+
+
+def averaged_spw(spw, chanbin):
+    # The spw selection spw ('0:100~500;600~900', '*:900~1200MHz', ...) of
+    # the original channels on the MS averaged by chanbin channels: channel
+    # ranges are divided by chanbin, frequency ranges are kept
+    if chanbin <= 1 or not spw:
+        return spw
+    parts = []
+    for part in spw.split(','):
+        if ':' not in part:
+            parts.append(part)
+            continue
+        spws, chans = part.split(':')
+        ranges = []
+        for chan in chans.split(';'):
+            if 'Hz' in chan:
+                ranges.append(chan)
+                continue
+            first, last = chan.split('~') if '~' in chan else (chan, chan)
+            ranges.append('%d~%d' % (int(first) // chanbin, int(last) // chanbin))
+        parts.append(spws + ':' + ';'.join(ranges))
+    return ','.join(parts)
+
+# ------------------------------------------------------------------------
+
+def ms_geometry(vis):
+    # Longest baseline (m), channel width and lowest/highest frequency (Hz)
+    # and integration time (s) of vis
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/ANTENNA')
+    pos = tb.getcol('POSITION')
+    tb.close()
+    maxbaseline = 0.0
+    for i in range(pos.shape[1]):
+        maxbaseline = max(maxbaseline, np.sqrt(((pos - pos[:, i:i + 1]) ** 2).sum(axis = 0)).max())
+    tb.open(vis + '/SPECTRAL_WINDOW')
+    freqs = [tb.getcell('CHAN_FREQ', row) for row in range(tb.nrows())]
+    widths = [np.abs(tb.getcell('CHAN_WIDTH', row)) for row in range(tb.nrows())]
+    tb.close()
+    tb.open(vis)
+    interval = float(np.median(tb.getcol('INTERVAL', 0, min(tb.nrows(), 10000))))
+    nchan = min([len(f) for f in freqs])
+    tb.close()
+    return {'maxbaseline': float(maxbaseline),
+        'chanwidth': float(max([w.max() for w in widths])),
+        'minfreq': float(min([f.min() for f in freqs])),
+        'maxfreq': float(max([f.max() for f in freqs])),
+        'nchan': nchan,
+        'interval': interval}
+
+
+def field_radius(imsize, cell):
+    # Half-width of the image in radians, from tclean imsize and cell
+    if isinstance(cell, (list, tuple)):
+        cell = cell[0]
+    if isinstance(imsize, (list, tuple)):
+        imsize = max(imsize)
+    return math.radians(0.5 * imsize * casa_timeslices.to_arcsec(cell) / 3600.0)
+
+
+def averaging_pars(vis, imsize, cell, tolerance = 0.01, maxtime = None):
+    # mstransform averaging parameters for imaging vis out to the edge of
+    # an imsize x cell field with at most tolerance peak loss from each of
+    # bandwidth and time smearing, and time bins of at most maxtime
+    # seconds. chanbin divides the number of channels.
+    geometry = ms_geometry(vis)
+    radius = field_radius(imsize, cell)
+    chanwidth = max_chanwidth(radius, geometry['maxbaseline'], tolerance)
+    timebin = max_timebin(radius, geometry['maxbaseline'], geometry['maxfreq'], tolerance)
+    chanbin = max(int(chanwidth // geometry['chanwidth']), 1)
+    while geometry['nchan'] % chanbin:
+        chanbin -= 1
+    ndumps = max(int(timebin // geometry['interval']), 1)
+    if maxtime and ndumps * geometry['interval'] > maxtime:
+        print('Averaging %s: time bin limited to the shortest time slice or snapshot (%g s)' % (vis, maxtime))
+        ndumps = max(int(maxtime // geometry['interval']), 1)
+
+    beta = chanbin * geometry['chanwidth'] * radius * geometry['maxbaseline'] / SPEED_OF_LIGHT
+    ratio = radius * geometry['maxfreq'] * geometry['maxbaseline'] / SPEED_OF_LIGHT
+    print('Averaging %s: %d channels (%.1f kHz, bandwidth smearing loss %.2f%%), %d dumps (%.1f s, time smearing loss %.2f%%) at %.2f deg from the phase centre' % (
+        vis, chanbin, chanbin * geometry['chanwidth'] / 1e3, 100 * bandwidth_loss(beta),
+        ndumps, ndumps * geometry['interval'], 100 * time_loss(ratio, ndumps * geometry['interval']), math.degrees(radius)))
+    print('   data volume reduced by a factor of %d' % (chanbin * ndumps))
+
+    pars = {}
+    if chanbin > 1:
+        pars.update(chanaverage = True,chanbin = chanbin)
+    if ndumps > 1:
+        pars.update(timeaverage = True,timebin = '%gs' % (ndumps * geometry['interval']))
+    return pars
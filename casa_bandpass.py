@@ -0,0 +1,109 @@
+# Cleaning of bandpass tables
+# After each bandpass solve the pipelines used to run flagdata tfcrop and
+# rflag on the CPARAM column of the table: two passes of RFI heuristics
+# over what are smooth gain curves. clean_bandpass() reads the table once
+# into an (antenna, channel, polarisation, time) cube per spw and, per
+# antenna, polarisation and solution time:
+#   - fits the gains with a running median over window channels (real and
+#     imaginary parts, ignoring flagged channels),
+#   - flags channels whose gain is more than cutoff times the MAD sigma of
+#     the residuals away from the fit,
+#   - fills flagged runs of at most gapfill channels between two good
+#     channels by linear interpolation in amplitude and phase, as
+#     bandpass(fillgaps=...) does for the gaps in its own solutions,
+# and writes CPARAM and FLAG back in one go.
+
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ------------------------------------------------------------------------
+
+def running_median(cube, flags, window):
+    # Median over window channels (axis 1) of the unflagged values, NaN
+    # where a window has none
+    values = np.where(flags, np.nan, cube)
+    half = window // 2
+    pad = [(0, 0)] * values.ndim
+    pad[1] = (half, half)
+    padded = np.pad(values, pad, mode = 'constant', constant_values = np.nan)
+    windows = sliding_window_view(padded, window, axis = 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(windows, axis = -1)
+
+
+def outliers(gains, flags, window = 9, cutoff = 5.0):
+    # Channels of (antenna, channel, polarisation, time) gains that deviate
+    # from the running median fit by more than cutoff MAD sigma
+    fit = running_median(gains.real, flags, window) + 1j * running_median(gains.imag, flags, window)
+    residual = np.where(flags, np.nan, np.abs(gains - fit))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        sigma = 1.4826 * np.nanmedian(np.abs(residual - np.nanmedian(residual, axis = 1)[:, None]), axis = 1)
+    # A perfectly smooth solution (sigma 0) has no outliers
+    return ((residual > cutoff * sigma[:, None]) & (sigma[:, None] > 0)) | ~np.isfinite(fit)
+
+
+def fill_gaps(gains, flags, gapfill = 24):
+    # Fill flagged runs of at most gapfill channels (axis 1) that have good
+    # channels on both sides by linear interpolation of amplitude and
+    # phase. Returns the new gains and flags.
+    nchan = gains.shape[1]
+    index = np.arange(nchan).reshape((1, nchan) + (1,) * (gains.ndim - 2))
+    good = ~flags
+    # Nearest good channel below and above each channel
+    below = np.maximum.accumulate(np.where(good, index, -1), axis = 1)
+    above = np.flip(np.minimum.accumulate(np.flip(np.where(good, index, nchan), axis = 1), axis = 1), axis = 1)
+    fill = flags & (below >= 0) & (above < nchan) & (above - below - 1 <= gapfill)
+    if gapfill <= 0 or not fill.any():
+        return gains, flags
+    lo = np.take_along_axis(gains, np.clip(below, 0, nchan - 1), axis = 1)
+    hi = np.take_along_axis(gains, np.clip(above, 0, nchan - 1), axis = 1)
+    t = (index - below) / np.maximum(above - below, 1).astype(np.float64)
+    amp = (1 - t) * np.abs(lo) + t * np.abs(hi)
+    phase = np.angle(lo) + t * np.angle(hi * np.conj(lo))
+    gains = np.where(fill, amp * np.exp(1j * phase), gains)
+    return gains, flags & ~fill
+
+
+def clean_bandpass(caltable, window = 9, cutoff = 5.0, gapfill = 24):
+    # Flag outliers in, and fill the short gaps of, the bandpass table
+    # caltable in place. Returns the fractions of solutions flagged before
+    # and after.
+    from casatools import table
+    tb = table()
+    tb.open(caltable, nomodify = False)
+    gains = tb.getcol('CPARAM')
+    flags = tb.getcol('FLAG')
+    antennas = tb.getcol('ANTENNA1')
+    times = tb.getcol('TIME')
+    spws = tb.getcol('SPECTRAL_WINDOW_ID')
+    before = float(flags.mean())
+    nflagged = nfilled = 0
+    for spw in np.unique(spws):
+        rows = np.nonzero(spws == spw)[0]
+        ants, ant_index = np.unique(antennas[rows], return_inverse = True)
+        slots, time_index = np.unique(times[rows], return_inverse = True)
+        npol, nchan = gains.shape[:2]
+        # (npol, nchan, nrow) rows to an (antenna, channel, polarisation,
+        # time) cube; solutions without a row stay flagged
+        cube = np.zeros((len(ants), nchan, npol, len(slots)), dtype = gains.dtype)
+        cubeflags = np.ones(cube.shape, dtype = bool)
+        cube[ant_index, :, :, time_index] = np.transpose(gains[:, :, rows], (2, 1, 0))
+        cubeflags[ant_index, :, :, time_index] = np.transpose(flags[:, :, rows], (2, 1, 0))
+        new = cubeflags | outliers(cube, cubeflags, window, cutoff)
+        nflagged += int((new & ~cubeflags).sum())
+        cube, filled = fill_gaps(cube, new, gapfill)
+        nfilled += int((new & ~filled).sum())
+        gains[:, :, rows] = np.transpose(cube[ant_index, :, :, time_index], (2, 1, 0))
+        flags[:, :, rows] = np.transpose(filled[ant_index, :, :, time_index], (2, 1, 0))
+    tb.putcol('CPARAM', gains)
+    tb.putcol('FLAG', flags)
+    tb.flush()
+    tb.close()
+    after = float(flags.mean())
+    print('%s: %d solutions flagged, %d filled across gaps of up to %d channels; %.2f%% flagged (was %.2f%%)' % (
+        caltable, nflagged, nfilled, gapfill, 100 * after, 100 * before))
+    return before, after
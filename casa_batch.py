@@ -0,0 +1,284 @@
+# Config-driven and batch runs of the pipelines
+# Each observation is described by a config file (.toml, .yaml or .json,
+# casa_config) holding the script options to set (bpcal_ms, target_ms,
+# target, refant, ...) and a few batch keys:
+#   pipeline  'multims' (default) or 'singlems' (casa_benchmark.PIPELINES)
+#   workdir   directory to run in, relative to the config file (default:
+#             the directory of the config file); MS paths are relative to it
+#   name      name in the run database (default: the config path)
+#   mpi       number of mpicasa processes (default 1: plain casa)
+#   cpu, io   CPU and I/O slots the run takes (default: the largest of mpi,
+#             nproc and slicenproc, and 1)
+# A run starts a CASA session in workdir with the options in
+# CASA_PIPELINE_CONFIG and its output in pipeline.log there:
+#   python casa_batch.py run epoch01/obs.toml
+#   python casa_batch.py run epochs/*/obs.toml --defaults common.toml --cpu 32 --io 4
+#   python casa_batch.py status
+# Observations are started, in the order given, whenever the CPU and I/O
+# slots they need are free on this node (--cpu, default the number of cores;
+# --io, default 2); a smaller one may start ahead of one that does not fit
+# yet. Status, host, times and the stage wall times (casa_benchmark.
+# stage_times) of every observation go to a SQLite run database (--db,
+# default runs.db). Runs are claimed in the database, so batches started on
+# several nodes with the same configs and database share the observations
+# out; observations already done with the same options are skipped (--force
+# reruns them) and failed ones are rerun. A failed run, or one left running
+# by a batch that died, restarts with --resume from its last completed
+# stage (casa_stages) if it has any and its options are unchanged. Runs
+# outside CASA.
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+import casa_benchmark
+import casa_config
+import casa_mpi
+
+# casa -c does not always set __file__
+HERE = os.path.dirname(os.path.abspath(globals().get('__file__', sys.argv[0])))
+# Keys of an observation config that are not script options
+BATCH_KEYS = ['name', 'pipeline', 'workdir', 'mpi', 'cpu', 'io']
+# nproc and slicenproc when the config does not set them (as in the scripts)
+DEFAULT_NPROC = 3
+CONFIG_NAME = 'pipeline_config.json'
+LOG_NAME = 'pipeline.log'
+
+# ------------------------------------------------------------------------
+
+def observation(path, defaults = None):
+    # The run described by the config file path, on top of defaults (a
+    # dict of options and batch keys)
+    config = dict(defaults or {})
+    config.update(casa_config.load(path))
+    batch = dict([(key, config.pop(key)) for key in BATCH_KEYS if key in config])
+    pipeline = batch.get('pipeline', 'multims')
+    if pipeline not in casa_benchmark.PIPELINES:
+        raise ValueError('%s: unknown pipeline %s (%s)' % (path, pipeline, ', '.join(sorted(casa_benchmark.PIPELINES))))
+    mpi = int(batch.get('mpi', 1))
+    return {'name': batch.get('name', os.path.splitext(os.path.relpath(path))[0]),
+        'config': os.path.abspath(path), 'pipeline': pipeline,
+        'script': os.path.join(HERE, casa_benchmark.PIPELINES[pipeline][0]),
+        'workdir': os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), batch.get('workdir', '.'))),
+        'mpi': mpi, 'options': config,
+        'cpu': int(batch.get('cpu') or max(mpi, config.get('nproc', DEFAULT_NPROC), config.get('slicenproc', DEFAULT_NPROC))),
+        'io': int(batch.get('io', 1)),
+        'hash': hashlib.sha1(json.dumps([pipeline, mpi, config], sort_keys = True).encode()).hexdigest()}
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def checkpointed(obs):
+    # True if a run of obs has completed stages in its checkpoint manifest
+    path = os.path.join(obs['workdir'], obs['options'].get('checkpoint', 'checkpoint.json'))
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        return bool(json.load(f).get('completed'))
+
+
+def _now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S')
+
+# ------------------------------------------------------------------------
+
+class RunDB(object):
+
+    COLUMNS = ['name', 'config', 'pipeline', 'workdir', 'hash', 'status', 'host', 'pid', 'cpu', 'io',
+        'submitted', 'started', 'finished', 'wall', 'returncode', 'log', 'stages']
+
+    def __init__(self, path = 'runs.db'):
+        # Autocommit; claims take the write lock explicitly
+        self.db = sqlite3.connect(path, timeout = 60, isolation_level = None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (name TEXT PRIMARY KEY, config TEXT, pipeline TEXT, '
+            'workdir TEXT, hash TEXT, status TEXT, host TEXT, pid INTEGER, cpu INTEGER, io INTEGER, submitted TEXT, '
+            'started TEXT, finished TEXT, wall REAL, returncode INTEGER, log TEXT, stages TEXT)')
+
+    def get(self, name):
+        row = self.db.execute('SELECT %s FROM runs WHERE name = ?' % ', '.join(self.COLUMNS), (name,)).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def rows(self):
+        return [dict(zip(self.COLUMNS, row)) for row in
+            self.db.execute('SELECT %s FROM runs ORDER BY submitted, name' % ', '.join(self.COLUMNS))]
+
+    def submit(self, obs, force = False):
+        # Add obs as pending, unless it is running or done with the same
+        # options. Returns True if it is pending.
+        row = self.get(obs['name'])
+        if row and row['status'] == 'running':
+            print('%s: running on %s' % (obs['name'], row['host']))
+            return False
+        if row and row['status'] == 'done' and row['hash'] == obs['hash'] and not force:
+            print('%s: done (%.0f s), skipped' % (obs['name'], row['wall']))
+            return False
+        self.db.execute('INSERT OR REPLACE INTO runs (name, config, pipeline, workdir, hash, status, cpu, io, submitted) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (obs['name'], obs['config'], obs['pipeline'], obs['workdir'],
+            obs['hash'], 'pending', obs['cpu'], obs['io'], _now()))
+        return True
+
+    def claim(self, name, host):
+        # Mark a pending run as running on host; False if another node got
+        # there first
+        self.db.execute('BEGIN IMMEDIATE')
+        cursor = self.db.execute("UPDATE runs SET status = 'running', host = ?, started = ? WHERE name = ? AND status = 'pending'",
+            (host, _now(), name))
+        self.db.execute('COMMIT')
+        return cursor.rowcount == 1
+
+    def started(self, name, pid, log):
+        self.db.execute('UPDATE runs SET pid = ?, log = ? WHERE name = ?', (pid, log, name))
+
+    def finish(self, name, returncode, wall, stages):
+        self.db.execute('UPDATE runs SET status = ?, finished = ?, returncode = ?, wall = ?, stages = ? WHERE name = ?',
+            ('done' if returncode == 0 else 'failed', _now(), returncode, wall, json.dumps(stages, sort_keys = True), name))
+
+    def release_stale(self, host):
+        # Runs left 'running' on host by a batch that died
+        for row in self.rows():
+            if row['status'] == 'running' and row['host'] == host and not (row['pid'] and _alive(row['pid'])):
+                print('%s: was left running, pending again' % row['name'])
+                self.db.execute("UPDATE runs SET status = 'pending' WHERE name = ?", (row['name'],))
+
+# ------------------------------------------------------------------------
+
+def start(obs, casa = 'casa', mpicasa = 'mpicasa', args = ()):
+    # Start the CASA session of obs in its workdir, with args for the
+    # script. Returns the process.
+    if not os.path.isdir(obs['workdir']):
+        os.makedirs(obs['workdir'])
+    config = os.path.join(obs['workdir'], CONFIG_NAME)
+    with open(config, 'w') as f:
+        json.dump(obs['options'], f, indent = 1, sort_keys = True)
+    env = dict(os.environ, **{'PYTHONPATH': os.pathsep.join([HERE, os.environ.get('PYTHONPATH', '')]), casa_config.CONFIG_ENV: config})
+    command = casa_mpi.casa_command(obs['script'], nproc = obs['mpi'], casa = casa, mpicasa = mpicasa, args = args)
+    log = open(os.path.join(obs['workdir'], LOG_NAME), 'a')
+    log.write('# %s %s\n' % (_now(), ' '.join(command)))
+    log.flush()
+    print('%s: %s in %s (%d cpu, %d io)' % (obs['name'], ' '.join(command), obs['workdir'], obs['cpu'], obs['io']))
+    process = subprocess.Popen(command, cwd = obs['workdir'], env = env, stdout = log, stderr = subprocess.STDOUT)
+    log.close()
+    return process
+
+
+def run_batch(observations, db, cpu = None, io = 2, poll = 10.0, force = False, casa = 'casa', mpicasa = 'mpicasa'):
+    # Run the observations on this node within cpu and io slots. Returns
+    # the names of those that failed.
+    workdirs = [obs['workdir'] for obs in observations]
+    shared = sorted(set([path for path in workdirs if workdirs.count(path) > 1]))
+    if shared:
+        raise ValueError('More than one observation runs in %s' % ', '.join(shared))
+    host = socket.gethostname()
+    limits = {'cpu': cpu or os.cpu_count() or 1, 'io': io}
+    free = dict(limits)
+    db.release_stale(host)
+    # Runs that were started before with the same options (failed, or left
+    # running) carry on from their checkpoints
+    previous = dict([(obs['name'], db.get(obs['name'])) for obs in observations])
+    pending = [obs for obs in observations if db.submit(obs, force = force)]
+    running = {}
+    failed = []
+    try:
+        while pending or running:
+            for obs in list(pending):
+                # A run larger than the node gets the whole node
+                need = dict([(key, min(obs[key], limits[key])) for key in limits])
+                if any([need[key] > free[key] for key in free]):
+                    continue
+                pending.remove(obs)
+                if not db.claim(obs['name'], host):
+                    print('%s: claimed by another node' % obs['name'])
+                    continue
+                row = previous[obs['name']]
+                resume = bool(row and row['status'] in ('failed', 'pending') and row['started'] and
+                    row['hash'] == obs['hash'] and checkpointed(obs))
+                process = start(obs, casa = casa, mpicasa = mpicasa, args = ['--resume'] if resume else [])
+                db.started(obs['name'], process.pid, os.path.join(obs['workdir'], LOG_NAME))
+                running[obs['name']] = (obs, process, need, time.time())
+                for key in free:
+                    free[key] -= need[key]
+            if not running:
+                continue
+            time.sleep(poll)
+            for name in list(running):
+                obs, process, need, t0 = running[name]
+                if process.poll() is None:
+                    continue
+                del running[name]
+                wall = time.time() - t0
+                db.finish(name, process.returncode, wall, casa_benchmark.stage_times(obs['workdir']))
+                for key in free:
+                    free[key] += need[key]
+                if process.returncode:
+                    failed.append(name)
+                print('%s: %s in %.0f s (%d running, %d waiting)' % (name, 'failed (%d)' % process.returncode if process.returncode else 'done',
+                    wall, len(running), len(pending)))
+    except KeyboardInterrupt:
+        for name in running:
+            obs, process, need, t0 = running[name]
+            process.terminate()
+            process.wait()
+            db.finish(name, process.returncode, time.time() - t0, {})
+        raise
+    return failed
+
+
+def print_status(db):
+    rows = db.rows()
+    print('%-32s %-8s %-16s %-19s %9s  %s' % ('name', 'status', 'host', 'started', 'wall (s)', 'slowest stages'))
+    for row in rows:
+        stages = json.loads(row['stages']) if row['stages'] else {}
+        slowest = ', '.join(['%s %.0f s' % (stage, stages[stage]) for stage in sorted(stages, key = stages.get, reverse = True)[:3]])
+        print('%-32s %-8s %-16s %-19s %9s  %s' % (row['name'], row['status'], row['host'] or '', row['started'] or '',
+            '%.0f' % row['wall'] if row['wall'] is not None else '', slowest))
+    counts = {}
+    for row in rows:
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    print(', '.join(['%d %s' % (counts[status], status) for status in sorted(counts)]))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run the pipelines on one or many observations from config files')
+    parser.add_argument('--db', default = 'runs.db', help = 'run database (SQLite)')
+    sub = parser.add_subparsers(dest = 'command')
+    run = sub.add_parser('run', help = 'run the observations of the config files')
+    run.add_argument('configs', nargs = '+', help = 'observation configs (.toml, .yaml or .json)')
+    run.add_argument('--defaults', help = 'config with the options shared by all observations')
+    run.add_argument('--cpu', type = int, default = None, help = 'CPU slots of this node (default: number of cores)')
+    run.add_argument('--io', type = int, default = 2, help = 'I/O slots of this node')
+    run.add_argument('--poll', type = float, default = 10.0, help = 'seconds between checks of the running observations')
+    run.add_argument('--force', action = 'store_true', help = 'rerun observations that are already done')
+    run.add_argument('--casa', default = 'casa', help = 'casa executable')
+    run.add_argument('--mpicasa', default = 'mpicasa', help = 'mpicasa executable')
+    sub.add_parser('status', help = 'show the runs in the database')
+    args = parser.parse_args(argv)
+    db = RunDB(args.db)
+    if args.command == 'run':
+        defaults = casa_config.load(args.defaults) if args.defaults else None
+        observations = [observation(path, defaults) for path in args.configs]
+        failed = run_batch(observations, db, cpu = args.cpu, io = args.io, poll = args.poll, force = args.force,
+            casa = args.casa, mpicasa = args.mpicasa)
+        if failed:
+            print('Failed: %s' % ', '.join(failed))
+        return 1 if failed else 0
+    elif args.command == 'status':
+        print_status(db)
+    else:
+        parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
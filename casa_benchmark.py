@@ -0,0 +1,236 @@
+# End-to-end benchmark of the pipelines on synthetic data
+# For each data size (antennas x channels x dump time) a MeerKAT-like
+# observation is simulated (casa_simulate.simulate_observation: bandpass
+# and phase calibrators and a target with point sources and a transient)
+# and a pipeline is run on it in its own directory, with the time slices
+# set to the simulated transient. The wall time of every stage comes from
+# the trace (casa_trace) and the checkpoint manifest (casa_stages) of the
+# run. The report gives, per stage, the time at each size and the scaling
+# exponent with the number of visibilities (a log-log fit), and marks the
+# stages that grow faster than linearly. With --compare the times are
+# checked against an earlier report for regressions.
+#   python casa_benchmark.py --sizes 16x256x8s,32x512x8s,64x1024x8s
+#   python casa_benchmark.py --pipeline singlems --compare bench/report.json
+# Runs outside CASA, starting a CASA session for each simulation and run.
+
+import argparse
+import csv
+import json
+import math
+import os
+import shutil
+import sys
+
+import casa_config
+import casa_mpi
+import casa_trace
+
+BENCH_ENV = 'CASA_BENCHMARK'
+# casa -c does not always set __file__
+HERE = os.path.dirname(os.path.abspath(globals().get('__file__', sys.argv[0])))
+
+# The pipeline scripts and the MS files they start from. The simulated
+# observation is split or renamed to these names in the run directory, so
+# that the calibration table names derived from them are unchanged.
+PIPELINES = {
+    'multims': ('casa_pipeline_multims_V0_0.py', {'1623281324_sdp_l0.ms': 'calibrators', 'J1708-3506.ms': 'target'}),
+    'singlems': ('casa_pipeline_singlems_V0_0_dev.py', {'FRB19_cut.ms': 'all'}),
+}
+
+# Exponent above which a stage counts as superlinear
+SUPERLINEAR = 1.2
+
+# ------------------------------------------------------------------------
+
+def parse_size(size):
+    # 'NANTxNCHANxINTTIME', e.g. '32x512x8s'
+    try:
+        nant, nchan, inttime = size.split('x')
+        return int(nant), int(nchan), inttime
+    except ValueError:
+        raise ValueError('Bad size %s: expected antennas x channels x dump time, e.g. 32x512x8s' % size)
+
+
+def simulate(workdir, pipeline, nant, nchan, inttime, duration):
+    # Runs inside CASA: the observation and the input MS files of pipeline
+    import casa_simulate
+    vis = os.path.join(workdir, 'sim.ms')
+    info = casa_simulate.simulate_observation(vis, nant = nant, nchan = nchan, inttime = inttime, duration = duration)
+    fields = {'calibrators': '%s,%s' % (info['bpcal'], info['pcal']), 'target': info['target']}
+    inputs = PIPELINES[pipeline][1]
+    if list(inputs.values()) == ['all']:
+        os.rename(vis, os.path.join(workdir, list(inputs)[0]))
+    else:
+        casa_simulate.split_fields(vis, dict([(os.path.join(workdir, name), fields[inputs[name]]) for name in inputs]))
+        shutil.rmtree(vis)
+
+
+def pipeline_config(info, improfile = 'quick', nproc = 1):
+    # Pipeline settings for the simulated observation
+    return {'bpcal_name': info['bpcal'], 'bpcal': info['bpcal'],
+        'pcal_name': info['pcal'], 'pcal': info['pcal'],
+        'target': info['target'], 'refant': 'm000', 'ref_ant': 'm000',
+        'time_before': info['time_before'], 'time_on': info['time_on'], 'time_after': info['time_after'],
+        'improfile': improfile, 'nproc': nproc, 'stagecache': None}
+
+
+def stage_times(workdir):
+    # Wall time of each stage of the run in workdir: the checkpoint manifest
+    # has it for the stages run from the script, the trace for the stages
+    # of the task graph (the sum of their task calls)
+    times = {}
+    path = os.path.join(workdir, 'trace.jsonl')
+    if os.path.exists(path):
+        for record in casa_trace.load(path):
+            stage = record.get('stage') or 'other'
+            times[stage] = times.get(stage, 0.0) + record['wall']
+    path = os.path.join(workdir, 'checkpoint.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            completed = json.load(f)['completed']
+        for stage in completed:
+            if 'wall' in completed[stage]:
+                times[stage] = completed[stage]['wall']
+    return times
+
+
+def run_size(args, size):
+    nant, nchan, inttime = parse_size(size)
+    workdir = os.path.abspath(os.path.join(args.outdir, '%s_%s' % (args.pipeline, size)))
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    env = {'PYTHONPATH': os.pathsep.join([HERE, os.environ.get('PYTHONPATH', '')])}
+    pars = {'path': HERE, 'simulate': dict(workdir = workdir, pipeline = args.pipeline, nant = nant, nchan = nchan, inttime = inttime, duration = args.duration)}
+    simulate_wall = casa_mpi.run_casa(os.path.join(HERE, 'casa_benchmark.py'), casa = args.casa, env = dict(env, **{BENCH_ENV: json.dumps(pars)}), cwd = workdir)
+    with open(os.path.join(workdir, 'sim.ms.json')) as f:
+        info = json.load(f)
+    config = os.path.join(workdir, 'config.json')
+    with open(config, 'w') as f:
+        json.dump(pipeline_config(info, args.improfile, args.nproc), f, indent = 1)
+
+    script = os.path.join(HERE, PIPELINES[args.pipeline][0])
+    wall = casa_mpi.run_casa(script, nproc = args.mpi, casa = args.casa, mpicasa = args.mpicasa,
+        env = dict(env, **{casa_config.CONFIG_ENV: config}), cwd = workdir)
+    result = {'size': size, 'nant': nant, 'nchan': nchan, 'inttime': inttime, 'duration': args.duration,
+        'nvis': info['nvis'], 'simulate': simulate_wall, 'wall': wall, 'stages': stage_times(workdir)}
+    if not args.keep:
+        for name in PIPELINES[args.pipeline][1]:
+            shutil.rmtree(os.path.join(workdir, name), ignore_errors = True)
+    return result
+
+# ------------------------------------------------------------------------
+# Report
+
+def fit_exponent(sizes, times):
+    # Least-squares slope of log(time) against log(size)
+    points = [(math.log(s), math.log(t)) for s, t in zip(sizes, times) if s > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    mx = sum([x for x, y in points]) / len(points)
+    my = sum([y for x, y in points]) / len(points)
+    sxx = sum([(x - mx) ** 2 for x, y in points])
+    if sxx == 0:
+        return None
+    return sum([(x - mx) * (y - my) for x, y in points]) / sxx
+
+
+def scaling(results):
+    # {stage: exponent} over the runs, including the whole run ('wall')
+    nvis = [r['nvis'] for r in results]
+    stages = sorted(set([stage for r in results for stage in r['stages']]))
+    exponents = dict([(stage, fit_exponent(nvis, [r['stages'].get(stage, 0.0) for r in results])) for stage in stages])
+    exponents['wall'] = fit_exponent(nvis, [r['wall'] for r in results])
+    return exponents
+
+
+def regressions(report, baseline, tolerance = 0.2, floor = 5.0):
+    # (size, stage, old, new) for stages at least tolerance slower than in
+    # baseline at the same size. Stages faster than floor seconds in both
+    # are ignored (start-up noise).
+    old = dict([(r['size'], r) for r in baseline['results']])
+    slower = []
+    for result in report['results']:
+        if result['size'] not in old:
+            continue
+        before = dict(old[result['size']]['stages'], wall = old[result['size']]['wall'])
+        after = dict(result['stages'], wall = result['wall'])
+        for stage in sorted(after):
+            if stage in before and max(before[stage], after[stage]) >= floor and after[stage] > (1 + tolerance) * before[stage]:
+                slower.append((result['size'], stage, before[stage], after[stage]))
+    return slower
+
+
+def write_report(report, outdir):
+    results = report['results']
+    stages = sorted(set([stage for r in results for stage in r['stages']])) + ['wall']
+    with open(os.path.join(outdir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent = 1, sort_keys = True)
+    with open(os.path.join(outdir, 'report.csv'), 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stage'] + [r['size'] for r in results] + ['exponent'])
+        for stage in stages:
+            exponent = report['exponents'].get(stage)
+            writer.writerow([stage] + ['%.2f' % dict(r['stages'], wall = r['wall']).get(stage, 0.0) for r in results]
+                + ['' if exponent is None else '%.3f' % exponent])
+
+    lines = ['%-12s' % 'stage' + ''.join(['%14s' % r['size'] for r in results]) + '%10s' % 'exponent']
+    lines.append('%-12s' % 'visibilities' + ''.join(['%14.3g' % r['nvis'] for r in results]))
+    for stage in stages:
+        exponent = report['exponents'].get(stage)
+        line = '%-12s' % stage + ''.join(['%14.1f' % dict(r['stages'], wall = r['wall']).get(stage, 0.0) for r in results])
+        if exponent is not None:
+            line += '%10.2f' % exponent
+            if exponent > SUPERLINEAR:
+                line += '  superlinear'
+        lines.append(line)
+    for size, stage, before, after in report.get('regressions', []):
+        lines.append('Regression at %s: %s took %.1f s, was %.1f s' % (size, stage, after, before))
+    with open(os.path.join(outdir, 'report.txt'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Time the pipeline stages on synthetic observations of several sizes')
+    parser.add_argument('--pipeline', default = 'multims', choices = sorted(PIPELINES))
+    parser.add_argument('--sizes', default = '16x256x8s,32x512x8s,64x1024x8s', help = 'comma-separated antennas x channels x dump time')
+    parser.add_argument('--duration', default = '1h', help = 'length of each observation')
+    parser.add_argument('--improfile', default = 'quick', help = 'imaging profile (casa_imaging.PROFILES)')
+    parser.add_argument('--nproc', type = int, default = 1, help = 'worker processes of the pipeline task graph')
+    parser.add_argument('--mpi', type = int, default = 1, help = 'run the pipeline under mpicasa with this many processes')
+    parser.add_argument('--outdir', default = 'bench')
+    parser.add_argument('--compare', help = 'earlier report.json to check for regressions')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'fractional slow-down counted as a regression')
+    parser.add_argument('--keep', action = 'store_true', help = 'keep the MS files of each run')
+    parser.add_argument('--casa', default = 'casa', help = 'casa executable')
+    parser.add_argument('--mpicasa', default = 'mpicasa', help = 'mpicasa executable')
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes.split(',')
+    for size in sizes:
+        parse_size(size)
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    baseline = None
+    if args.compare:
+        # Read before the new report can overwrite it
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    results = sorted([run_size(args, size) for size in sizes], key = lambda r: r['nvis'])
+    report = {'pipeline': args.pipeline, 'improfile': args.improfile, 'nproc': args.nproc, 'mpi': args.mpi,
+        'revision': casa_trace.git_revision(), 'results': results, 'exponents': scaling(results)}
+    if baseline is not None:
+        report['regressions'] = regressions(report, baseline, tolerance = args.tolerance)
+    write_report(report, args.outdir)
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    if BENCH_ENV in os.environ:
+        # Started by run_size() inside CASA
+        pars = json.loads(os.environ[BENCH_ENV])
+        sys.path.insert(0, pars.pop('path'))
+        simulate(**pars['simulate'])
+    else:
+        sys.exit(main())
@@ -0,0 +1,70 @@
+# Settings for the pipeline scripts from a JSON, TOML or YAML file
+# The scripts set their options as globals at the top. apply() overrides
+# them from a table of {name: value} (.json, .toml or .yaml / .yml), given
+# after the script name
+#   casa --nogui -c casa_pipeline_multims_V0_0.py --config run.toml
+# or in the CASA_PIPELINE_CONFIG environment variable (a file name). Only
+# names the script already defines can be set, so a misspelt option fails
+# instead of being ignored. Setting bpcal_name, pcal_name or refant also
+# sets the alias the script derives from it (bpcal, pcal, ref_ant) unless
+# that is given too. Used by casa_benchmark to run the pipelines on
+# synthetic data and by casa_batch to run them on many observations.
+# TOML needs Python 3.11 (tomllib) or the tomli package, YAML needs PyYAML.
+
+import argparse
+import json
+import os
+import sys
+
+CONFIG_ENV = 'CASA_PIPELINE_CONFIG'
+# Options the scripts set from another one at the top
+ALIASES = {'bpcal': 'bpcal_name', 'pcal': 'pcal_name', 'ref_ant': 'refant'}
+
+# ------------------------------------------------------------------------
+
+def config_path(argv = None):
+    # --config from the script arguments, else the environment
+    parser = argparse.ArgumentParser(add_help = False)
+    parser.add_argument('--config')
+    args, unknown = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return args.config or os.environ.get(CONFIG_ENV)
+
+
+def load(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+    elif ext in ('.yaml', '.yml'):
+        import yaml
+        with open(path) as f:
+            config = yaml.safe_load(f)
+    else:
+        with open(path) as f:
+            config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError('%s: expected a table of option names and values' % path)
+    return config
+
+
+def apply(namespace, argv = None):
+    # Set the options in namespace (a script's globals()) from the config
+    # file, if there is one. Returns the options that were set.
+    path = config_path(argv)
+    if not path:
+        return {}
+    config = load(path)
+    for alias, name in ALIASES.items():
+        if name in config and alias not in config and alias in namespace:
+            config[alias] = config[name]
+    unknown = sorted([name for name in config if name not in namespace or name.startswith('_')])
+    if unknown:
+        raise ValueError('%s: unknown options %s' % (path, ', '.join(unknown)))
+    for name in sorted(config):
+        print('Config %s: %s = %r' % (path, name, config[name]))
+    namespace.update(config)
+    return config
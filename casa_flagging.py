@@ -0,0 +1,453 @@
+# Flagging helpers for the MeerKAT imaging pipelines
+# Based on the oxkat pipeline hosted here: https://github.com/IanHeywood/oxkat
+# The basic flagging step (static RFI bands, autocorrelations and clipping)
+# is built as one command list and applied with a single flagdata(mode='list')
+# pass, so each MS is read once instead of once per selection.
+# The RFI frequency ranges (per band presets below) are resolved to channel
+# ranges here rather than by flagdata: the channel frequencies of an MS are
+# read once, all ranges are merged and matched to channels in one vectorised
+# step, and the resulting channel selections are cached on disk by spectral
+# set-up, so the calibrator and target MS files of an observation (and later
+# runs) reuse them.
+# The static selections (channel ranges, short baselines, autocorrelations)
+# depend only on channel, baseline length and antenna pair. With direct=True
+# they are written straight into the FLAG column: the flag cube of each
+# chunk of rows is computed with NumPy and OR-ed into the existing flags, and
+# only the clipping goes through flagdata.
+
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from casatasks import flagdata
+
+import casa_trace
+
+# Static RFI frequency ranges per MeerKAT band: 'all' is flagged on all
+# baselines, 'subset' on the short baselines only (terrestrial and
+# satellite transmitters that decorrelate on long baselines).
+BAND_PRESETS = {
+    # From the MeerKAT Cookbook
+    # https://github.com/ska-sa/MeerKAT-Cookbook/blob/master/casa/L-band%20RFI%20frequency%20flagging.ipynb
+    'L': {
+        'all': ['850~900MHz', # Lower band edge
+            '1658~1800MHz', # Upper bandpass edge
+            '1419.8~1421.3MHz'], # Galactic HI
+        'subset': ['900MHz~915MHz', # GSM and aviation
+            '925MHz~960MHz',
+            '1080MHz~1095MHz',
+            '1565MHz~1585MHz', # GPS
+            '1217MHz~1237MHz',
+            '1375MHz~1387MHz',
+            '1166MHz~1186MHz',
+            '1592MHz~1610MHz', # GLONASS
+            '1242MHz~1249MHz',
+            '1191MHz~1217MHz', # Galileo
+            '1260MHz~1300MHz',
+            '1453MHz~1490MHz', # Afristar
+            '1616MHz~1626MHz', # Iridium
+            '1526MHz~1554MHz', # Inmarsat
+            '1600MHz'], # Alkantpan
+    },
+    # UHF (544-1088 MHz): band edges, mobile and aviation allocations.
+    # A starting point, check against the RFI seen in the data.
+    'UHF': {
+        'all': ['544~580MHz', # Lower band edge
+            '1015~1088MHz'], # Upper band edge
+        'subset': ['791MHz~821MHz', # LTE 800 downlink
+            '832MHz~862MHz', # LTE 800 uplink
+            '880MHz~915MHz', # GSM 900 uplink
+            '925MHz~960MHz', # GSM 900 downlink
+            '960MHz~1015MHz'], # Aviation (DME)
+    },
+    # S-band (1750-3500 MHz): band edges, mobile, ISM and satellite radio.
+    # A starting point, check against the RFI seen in the data.
+    'S': {
+        'all': ['1750~1800MHz', # Lower band edge
+            '3400~3500MHz'], # Upper band edge
+        'subset': ['1805MHz~1880MHz', # GSM 1800 downlink
+            '1920MHz~1980MHz', # UMTS uplink
+            '2110MHz~2170MHz', # UMTS downlink
+            '2300MHz~2400MHz', # LTE 2300
+            '2400MHz~2483.5MHz', # ISM (WiFi, Bluetooth)
+            '2483.5MHz~2500MHz', # Globalstar
+            '2500MHz~2690MHz'], # LTE 2600
+    },
+}
+
+# On-disk cache of resolved channel selections
+CHANNEL_CACHE = 'flagchannels.json'
+FREQ_UNITS = {'Hz': 1.0, 'kHz': 1e3, 'MHz': 1e6, 'GHz': 1e9}
+
+_setups = {}
+
+# Keys of a flagdata command that flag_static() can apply itself
+STATIC_KEYS = set(['mode', 'spw', 'uvrange', 'autocorr'])
+
+# ------------------------------------------------------------------------
+# I/O accounting (casa_trace.io_counters: Linux only, zeros elsewhere)
+
+def measure(func, *args, **kwargs):
+    # Run func and return (result, wall seconds, bytes read)
+    io0 = casa_trace.io_counters()
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    wall = time.time() - t0
+    io1 = casa_trace.io_counters()
+    return result, wall, {key: io1[key] - io0[key] for key in io0}
+
+# ------------------------------------------------------------------------
+# Command list construction
+
+def spw_selection(badfreqs):
+    return ','.join(['*:' + badfreq for badfreq in badfreqs])
+
+
+def _format_value(value):
+    # flagdata's list parser splits on whitespace, so no spaces inside values
+    if isinstance(value, str):
+        return "'" + value + "'"
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join([_format_value(v) for v in value]) + ']'
+    return str(value)
+
+
+def flag_cmd_string(pars):
+    return ' '.join([key + '=' + _format_value(pars[key]) for key in pars])
+
+
+def basic_flag_cmds(badfreqs_all, badfreqs_subset, subset_uvrange = '<600', clipminmax = (0.0, 100.0)):
+    # One dict of flagdata parameters per selection of the basic flagging step
+    cmds = []
+    if badfreqs_all:
+        cmds.append({'mode': 'manual', 'spw': spw_selection(badfreqs_all)})
+    if badfreqs_subset:
+        cmds.append({'mode': 'manual', 'spw': spw_selection(badfreqs_subset), 'uvrange': subset_uvrange})
+    cmds.append({'mode': 'manual', 'autocorr': True})
+    cmds.append({'mode': 'clip', 'clipzeros': True})
+    cmds.append({'mode': 'clip', 'clipminmax': list(clipminmax)})
+    return cmds
+
+# ------------------------------------------------------------------------
+# Frequency ranges to channel selections
+
+def parse_freq(value, unit = None):
+    # '900MHz' (or '900' with unit) in Hz
+    value = value.strip()
+    for name in sorted(FREQ_UNITS, key = len, reverse = True):
+        if value.endswith(name):
+            return float(value[:-len(name)]) * FREQ_UNITS[name], name
+    if unit is None:
+        raise ValueError('No frequency unit in %s' % value)
+    return float(value) * FREQ_UNITS[unit], unit
+
+
+def parse_range(text):
+    # '850~900MHz', '900MHz~915MHz' or '1600MHz' as (low, high) in Hz; a
+    # selection prefix such as '*:' is ignored
+    text = text.split(':')[-1]
+    if '~' not in text:
+        freq, unit = parse_freq(text)
+        return freq, freq
+    lo, hi = text.split('~')
+    hi, unit = parse_freq(hi)
+    lo, unit = parse_freq(lo, unit)
+    return min(lo, hi), max(lo, hi)
+
+
+def merge_ranges(ranges):
+    # Sorted, non-overlapping (low, high) arrays; touching ranges such as
+    # 1191~1217 and 1217~1237 MHz are merged
+    lo = np.array([r[0] for r in ranges], dtype = np.float64)
+    hi = np.array([r[1] for r in ranges], dtype = np.float64)
+    order = np.argsort(lo)
+    lo, hi = lo[order], hi[order]
+    reach = np.maximum.accumulate(hi)
+    start = np.concatenate([[True], lo[1:] > reach[:-1]])
+    first = np.nonzero(start)[0]
+    return lo[first], np.maximum.reduceat(hi, first)
+
+
+def spectral_setup(vis):
+    # Channel frequencies and widths (Hz) of each spw of vis, read once per
+    # version of the SPECTRAL_WINDOW table
+    path = os.path.join(vis, 'SPECTRAL_WINDOW')
+    key = (os.path.normpath(vis), os.path.getmtime(path) if os.path.exists(path) else 0)
+    if key not in _setups:
+        from casatools import table
+        tb = table()
+        tb.open(path)
+        _setups[key] = [(tb.getcell('CHAN_FREQ', row), np.abs(tb.getcell('CHAN_WIDTH', row))) for row in range(tb.nrows())]
+        tb.close()
+    return _setups[key]
+
+
+def setup_key(setup):
+    # Hash of a spectral set-up (to the Hz)
+    digest = hashlib.sha1()
+    for freqs, widths in setup:
+        digest.update(np.round(freqs).astype(np.int64).tobytes())
+        digest.update(np.round(widths).astype(np.int64).tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def channel_selection(setup, ranges):
+    # spw:channel selection of every channel that overlaps one of the
+    # frequency ranges, e.g. '0:0~58;1021~1080', or '' if none does
+    lo, hi = merge_ranges([parse_range(r) for r in ranges])
+    spw = np.concatenate([np.full(len(freqs), i) for i, (freqs, widths) in enumerate(setup)])
+    chan = np.concatenate([np.arange(len(freqs)) for freqs, widths in setup])
+    chan_lo = np.concatenate([freqs - 0.5 * widths for freqs, widths in setup])
+    chan_hi = np.concatenate([freqs + 0.5 * widths for freqs, widths in setup])
+    # Last merged range starting below each channel's top edge (channels
+    # are taken as half-open, [low edge, high edge))
+    k = np.searchsorted(lo, chan_hi, side = 'left') - 1
+    flagged = (k >= 0) & (hi[np.maximum(k, 0)] >= chan_lo)
+    selections = []
+    for i in range(len(setup)):
+        mask = flagged[spw == i]
+        if not mask.any():
+            continue
+        # Runs of flagged channels (frequency order does not matter)
+        edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+        starts = np.nonzero(edges == 1)[0]
+        stops = np.nonzero(edges == -1)[0] - 1
+        selections.append('%d:%s' % (i, ';'.join(['%d~%d' % (a, b) for a, b in zip(starts, stops)])))
+    return ','.join(selections)
+
+
+def load_channel_cache(path = CHANNEL_CACHE):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def resolve_channels(vis, ranges, cache = CHANNEL_CACHE):
+    # Channel selection of the frequency ranges in vis, from the cache file
+    # when the same spectral set-up and ranges were resolved before
+    setup = spectral_setup(vis)
+    key = setup_key(setup) + ':' + hashlib.sha1(json.dumps(sorted(ranges)).encode()).hexdigest()
+    cached = load_channel_cache(cache)
+    if key in cached:
+        return cached[key]
+    selection = channel_selection(setup, ranges)
+    if cache:
+        # Re-read so that concurrent workers do not drop each other's entries
+        cached = load_channel_cache(cache)
+        cached[key] = selection
+        tmp = '%s.%d.tmp' % (cache, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cached, f, indent = 1, sort_keys = True)
+        os.rename(tmp, cache)
+    return selection
+
+
+def channel_cmds(vis, cmds, cache = CHANNEL_CACHE):
+    # cmds with their frequency spw selections ('*:900MHz~915MHz,...')
+    # replaced by the channel ranges of vis. Selections that match no
+    # channel of vis are dropped rather than flagging every spw.
+    resolved = []
+    for pars in cmds:
+        spw = pars.get('spw', '')
+        if not spw or 'Hz' not in spw:
+            resolved.append(pars)
+            continue
+        selection = resolve_channels(vis, spw.split(','), cache = cache)
+        if selection:
+            resolved.append(dict(pars, spw = selection))
+        else:
+            print('%s: no channels in %s, skipped' % (os.path.basename(vis.rstrip('/')), spw))
+    return resolved
+
+# ------------------------------------------------------------------------
+# Direct writing of the static flags
+
+def parse_uvrange(uvrange):
+    # '<600' or '>150m' as (operator, metres); None for other selections
+    # (ranges, wavelength units), which are left to flagdata
+    uvrange = uvrange.strip()
+    if uvrange[:1] not in '<>' or not uvrange[1:]:
+        return None
+    value = uvrange[1:].strip()
+    if value.endswith('m') and not value.endswith('km'):
+        value = value[:-1]
+    elif value.endswith('km'):
+        value = str(float(value[:-2]) * 1e3)
+    try:
+        return uvrange[0], float(value)
+    except ValueError:
+        return None
+
+
+def parse_channels(selection):
+    # '0:0~58;1021~1080,1:3~7' as {spw: [(first, last), ...]}
+    channels = {}
+    for part in selection.split(','):
+        spw, ranges = part.split(':')
+        for chans in ranges.split(';'):
+            first, last = chans.split('~') if '~' in chans else (chans, chans)
+            channels.setdefault(int(spw), []).append((int(first), int(last)))
+    return channels
+
+
+def is_static(pars):
+    # True for a manual selection of channel ranges, a uv distance limit
+    # and/or autocorrelations, with nothing else selected
+    if pars.get('mode') != 'manual' or not set(pars) <= STATIC_KEYS:
+        return False
+    spw = pars.get('spw', '')
+    if spw and ('Hz' in spw or '*' in spw):
+        return False
+    if pars.get('uvrange') and parse_uvrange(pars['uvrange']) is None:
+        return False
+    return bool(spw or pars.get('autocorr'))
+
+
+def static_rules(cmds, nchans):
+    # (channel mask per spw or None for all channels, uv limit, autocorr
+    # only) of each static command; nchans is the channel count per spw
+    rules = []
+    for pars in cmds:
+        masks = None
+        if pars.get('spw'):
+            masks = {}
+            for spw, ranges in parse_channels(pars['spw']).items():
+                if spw >= len(nchans):
+                    continue
+                masks[spw] = np.zeros(nchans[spw], dtype = bool)
+                for first, last in ranges:
+                    masks[spw][first:last + 1] = True
+        uvlimit = parse_uvrange(pars['uvrange']) if pars.get('uvrange') else None
+        rules.append((masks, uvlimit, bool(pars.get('autocorr'))))
+    return rules
+
+
+def static_mask(rules, spw, nchan, uvw, ant1, ant2):
+    # (nchan, nrow) flags of the rules for rows of one spw
+    mask = np.zeros((nchan, len(ant1)), dtype = bool)
+    uvdist = None
+    for masks, uvlimit, autocorr in rules:
+        if masks is not None and spw not in masks:
+            continue
+        rows = np.ones(len(ant1), dtype = bool)
+        if autocorr:
+            rows &= ant1 == ant2
+        if uvlimit is not None:
+            if uvdist is None:
+                uvdist = np.hypot(uvw[0], uvw[1])
+            rows &= uvdist < uvlimit[1] if uvlimit[0] == '<' else uvdist > uvlimit[1]
+        if masks is None:
+            mask |= rows[None, :]
+        else:
+            mask |= masks[spw][:, None] & rows[None, :]
+    return mask
+
+
+def scan_numbers(scan):
+    # CASA scan selection ('3,5~8') as a list of scan numbers
+    numbers = []
+    for part in scan.split(','):
+        first, last = part.split('~') if '~' in part else (part, part)
+        numbers.extend(range(int(first), int(last) + 1))
+    return numbers
+
+
+def flag_static(vis, cmds, scan = '', chunkvis = 2 ** 24):
+    # OR the flags of the static commands (is_static) into the FLAG column of
+    # vis, about chunkvis visibilities at a time, and set FLAG_ROW of rows
+    # that end up fully flagged. Returns the number of rows changed.
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/SPECTRAL_WINDOW')
+    nchans = list(tb.getcol('NUM_CHAN'))
+    tb.close()
+    tb.open(vis + '/DATA_DESCRIPTION')
+    spws = list(tb.getcol('SPECTRAL_WINDOW_ID'))
+    tb.close()
+    rules = static_rules(cmds, nchans)
+
+    changed = 0
+    tb.open(vis, nomodify = False)
+    for ddid, spw in enumerate(spws):
+        query = 'DATA_DESC_ID==%d' % ddid
+        if scan:
+            query += ' && SCAN_NUMBER IN [%s]' % ','.join([str(n) for n in scan_numbers(scan)])
+        rows = tb.query(query)
+        nrows = rows.nrows()
+        if nrows == 0:
+            rows.close()
+            continue
+        ncorr, nchan = rows.getcell('FLAG', 0).shape
+        chunk = max(chunkvis // (ncorr * nchan), 1)
+        for first in range(0, nrows, chunk):
+            n = min(chunk, nrows - first)
+            mask = static_mask(rules, spw, nchan, rows.getcol('UVW', first, n),
+                rows.getcol('ANTENNA1', first, n), rows.getcol('ANTENNA2', first, n))
+            if not mask.any():
+                continue
+            flags = rows.getcol('FLAG', first, n)
+            new = flags | mask[None, :, :]
+            changed += int((new != flags).any(axis = (0, 1)).sum())
+            rows.putcol('FLAG', new, first, n)
+            rows.putcol('FLAG_ROW', rows.getcol('FLAG_ROW', first, n) | new.all(axis = (0, 1)), first, n)
+        rows.close()
+    tb.flush()
+    tb.close()
+    return changed
+
+# ------------------------------------------------------------------------
+# Flagging passes
+
+def flag_list(vis, cmds):
+    # All selections in one pass over the MS. The pipeline saves its own
+    # flag version right after, so the automatic backup is not needed.
+    flagdata(vis = vis,mode = 'list',inpfile = [flag_cmd_string(pars) for pars in cmds],flagbackup = False)
+
+
+def flag_percall(vis, cmds):
+    # The old path: one flagdata call (and one read of the MS) per selection
+    for pars in cmds:
+        flagdata(vis = vis,**pars)
+
+
+def _report(vis, label, wall, io):
+    print('%s %-8s wall %9.1f s  read %12.3f GB (%12.3f GB from disk)' % (
+        os.path.basename(vis.rstrip('/')), label, wall, io['rchar'] / 1e9, io['read_bytes'] / 1e9))
+
+
+def run_basic_flagging(vis, cmds, compare = False, scan = '', cache = CHANNEL_CACHE, direct = False):
+    # Apply the basic flags to vis (only to the scans selected by scan, if
+    # given), with the frequency ranges resolved to channels (channel_cmds).
+    # With direct=True the static selections are written by flag_static()
+    # and only the rest goes through flagdata. With compare=True the old
+    # per-call sequence (and, with direct, the full list pass) is run first
+    # and the timings are reported side by side. Flagging is idempotent, so
+    # running them all leaves the same flags.
+    cmds = channel_cmds(vis, cmds, cache = cache)
+    static = [pars for pars in cmds if direct and is_static(pars)]
+    rest = [pars for pars in cmds if not (direct and is_static(pars))]
+    if scan:
+        cmds = [dict(pars, scan = scan) for pars in cmds]
+        rest = [dict(pars, scan = scan) for pars in rest]
+    results = {}
+    if compare:
+        _, wall, io = measure(flag_percall, vis, cmds)
+        results['percall'] = {'wall': wall, 'io': io}
+        _report(vis, 'percall', wall, io)
+        if static:
+            _, wall, io = measure(flag_list, vis, cmds)
+            results['fulllist'] = {'wall': wall, 'io': io}
+            _report(vis, 'fulllist', wall, io)
+    if static:
+        changed, wall, io = measure(flag_static, vis, static, scan = scan)
+        results['direct'] = {'wall': wall, 'io': io, 'rows': changed}
+        _report(vis, 'direct', wall, io)
+    if rest:
+        _, wall, io = measure(flag_list, vis, rest)
+        results['list'] = {'wall': wall, 'io': io}
+        _report(vis, 'list', wall, io)
+    return results
@@ -0,0 +1,467 @@
+# Flag versions kept as delta bitmaps
+# flagmanager(mode='save') copies the whole FLAG column of the MS into
+# <vis>.flagversions for every version, so the pipelines' basic, residual,
+# refcal and stage checkpoint versions hold many copies of nearly the same
+# booleans, and a restore rewrites all of them. The store here
+# (<vis>.flagdeltas) keeps:
+#   - the latest version (the head) as one bit-packed, memory-mapped bitmap
+#     of FLAG and FLAG_ROW, 1 bit per flag,
+#   - every earlier version as a reverse delta: the bytes of its bitmap that
+#     differ from the next version (positions and XOR values, zlib
+#     compressed), per chunk of rows.
+# Saving reads FLAG once and writes the bytes that changed since the last
+# save; restoring rebuilds each chunk from the head and the deltas in
+# memory and only writes the rows whose flags differ from those in the MS;
+# diff() compares two versions without touching the MS. When the rows of
+# the MS change (e.g. new scans appended), the old head is kept as a full
+# bitmap and a new chain starts.
+# A save writes the new head to a file of its own (a copy-on-write clone of
+# the old one where the file system allows) and the delta of the old head,
+# and commits them by replacing index.json in one rename. A save that is
+# interrupted leaves the index at the last committed version; its files are
+# not referenced by the index and are removed by the next save.
+# flagmanager() below is a drop-in for casatasks.flagmanager: while the
+# store is enabled, versions are saved to it, and versions it holds are
+# restored, deleted and renamed there; everything else goes to CASA.
+
+import hashlib
+import json
+import os
+import time
+import zlib
+
+import numpy as np
+
+import casa_trace
+
+STORE_SUFFIX = '.flagdeltas'
+# Visibilities (flags) per chunk of rows
+CHUNKVIS = 2 ** 24
+# Fraction of changed bytes above which a chunk delta is stored whole
+DENSE = 0.2
+
+_store = {'enabled': False}
+
+# ------------------------------------------------------------------------
+
+def enable(on = True):
+    # Save flag versions in the delta store (True) or with flagmanager
+    _store['enabled'] = bool(on)
+
+
+def enabled():
+    return _store['enabled']
+
+
+def store_path(vis):
+    return vis.rstrip('/') + STORE_SUFFIX
+
+
+def layout(vis):
+    # Chunks of rows of vis as [ddid, first, nrow, ncorr, nchan, offset,
+    # nbytes]: the rows of each DATA_DESC_ID in table order, and where
+    # their FLAG and FLAG_ROW bits start in the bitmap
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/DATA_DESCRIPTION')
+    nddid = tb.nrows()
+    tb.close()
+    chunks = []
+    offset = 0
+    tb.open(vis)
+    for ddid in range(nddid):
+        rows = tb.query('DATA_DESC_ID==%d' % ddid)
+        nrows = rows.nrows()
+        if nrows:
+            ncorr, nchan = rows.getcell('FLAG', 0).shape
+            chunk = max(CHUNKVIS // (ncorr * nchan), 1)
+            for first in range(0, nrows, chunk):
+                n = min(chunk, nrows - first)
+                nbytes = (n * ncorr * nchan + 7) // 8 + (n + 7) // 8
+                chunks.append([ddid, first, n, ncorr, nchan, offset, nbytes])
+                offset += nbytes
+        rows.close()
+    tb.close()
+    return chunks
+
+
+def layout_key(chunks):
+    return hashlib.sha1(json.dumps(chunks).encode()).hexdigest()
+
+
+def _rows(vis, chunks, nomodify = True):
+    # Yield (chunk index, query table, first, nrow) for every chunk of vis
+    from casatools import table
+    tb = table()
+    tb.open(vis, nomodify = nomodify)
+    rows, current = None, None
+    for i, (ddid, first, n, ncorr, nchan, offset, nbytes) in enumerate(chunks):
+        if ddid != current:
+            if rows is not None:
+                rows.close()
+            rows, current = tb.query('DATA_DESC_ID==%d' % ddid), ddid
+        yield i, rows, first, n
+    if rows is not None:
+        rows.close()
+    if not nomodify:
+        tb.flush()
+    tb.close()
+
+
+def pack(flags, flagrow):
+    return np.concatenate([np.packbits(flags.ravel()), np.packbits(flagrow)])
+
+
+def unpack(bits, ncorr, nchan, n):
+    nflag = ncorr * nchan * n
+    split = (nflag + 7) // 8
+    flags = np.unpackbits(bits[:split], count = nflag).astype(bool).reshape((ncorr, nchan, n))
+    return flags, np.unpackbits(bits[split:], count = n).astype(bool)
+
+
+def encode(xor):
+    # (blob, count) of the non-zero bytes of xor: count positions (as gaps)
+    # and values, or the whole of xor (count -1) where most bytes changed
+    changed = np.flatnonzero(xor)
+    if changed.size == 0:
+        return None, 0
+    if changed.size > DENSE * xor.size:
+        return zlib.compress(xor.tobytes(), 1), -1
+    gaps = np.diff(changed, prepend = 0).astype(np.uint32)
+    return zlib.compress(gaps.tobytes() + xor[changed].tobytes(), 1), int(changed.size)
+
+
+def decode(blob, count, size):
+    data = zlib.decompress(blob)
+    if count < 0:
+        return np.frombuffer(data, dtype = np.uint8).copy()
+    xor = np.zeros(size, dtype = np.uint8)
+    positions = np.cumsum(np.frombuffer(data[:4 * count], dtype = np.uint32), dtype = np.int64)
+    xor[positions] = np.frombuffer(data[4 * count:], dtype = np.uint8)
+    return xor
+
+# ------------------------------------------------------------------------
+
+class FlagStore(object):
+
+    def __init__(self, vis):
+        self.vis = vis
+        self.path = store_path(vis)
+        self.index = {'versions': [], 'layouts': {}, 'next': 0}
+        if os.path.exists(os.path.join(self.path, 'index.json')):
+            with open(os.path.join(self.path, 'index.json')) as f:
+                self.index = json.load(f)
+            self.check()
+
+    def check(self):
+        # The files of every committed version must be there in full
+        for entry in self.index['versions']:
+            path = self._file(entry)
+            if not os.path.exists(path):
+                raise RuntimeError('%s: file %s of flag version %s is missing' % (self.path, os.path.basename(path), entry['name']))
+            if entry['kind'] != 'delta':
+                size = max(sum([chunk[6] for chunk in self.index['layouts'][entry['layout']]]), 1)
+                if os.path.getsize(path) != size:
+                    raise RuntimeError('%s: bitmap %s of flag version %s has %d bytes, expected %d' % (self.path,
+                        os.path.basename(path), entry['name'], os.path.getsize(path), size))
+
+    def sweep(self):
+        # Remove the files the index does not refer to: those of versions
+        # dropped from it and of an interrupted save
+        used = set(['index.json'] + [os.path.basename(self._file(entry)) for entry in self.index['versions']])
+        for name in os.listdir(self.path):
+            if name not in used:
+                os.remove(os.path.join(self.path, name))
+
+    def save_index(self):
+        tmp = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent = 1, sort_keys = True)
+        os.rename(tmp, os.path.join(self.path, 'index.json'))
+
+    def versions(self):
+        return [entry['name'] for entry in self.index['versions'] if entry['name'] is not None]
+
+    def find(self, name):
+        for k, entry in enumerate(self.index['versions']):
+            if entry['name'] == name:
+                return k
+        raise KeyError('%s has no flag version %s' % (self.path, name))
+
+    def _file(self, entry, kind = None):
+        # The bitmap of a head or full version, the delta file of the others
+        kind = kind or entry['kind']
+        return os.path.join(self.path, '%d.%s' % (entry['id'], 'delta' if kind == 'delta' else 'bits'))
+
+    def _bitmap(self, entry, mode = 'r'):
+        return np.memmap(self._file(entry), dtype = np.uint8, mode = mode)
+
+    def save(self, name, comment = ''):
+        # Save the current flags of vis as version name (replacing an
+        # earlier version of that name)
+        import casa_scheduler
+        t0 = time.time()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.sweep()
+        chunks = layout(self.vis)
+        key = layout_key(chunks)
+        versions = self.index['versions']
+        head = versions[-1] if versions and versions[-1]['kind'] == 'head' else None
+        entry = {'id': self.index['next'], 'name': name, 'comment': comment, 'kind': 'head', 'layout': key,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        size = max(sum([chunk[6] for chunk in chunks]), 1)
+        if head is not None and head['layout'] == key:
+            casa_scheduler.clone_file(self._file(head), self._file(entry))
+            bits = self._bitmap(entry, 'r+')
+            delta = open(self._file(head, 'delta'), 'wb')
+            segments = {}
+        else:
+            bits = np.memmap(self._file(entry), dtype = np.uint8, mode = 'w+', shape = (size,))
+            delta = None
+
+        nflagged = ntotal = 0
+        for i, rows, first, n in _rows(self.vis, chunks):
+            flags = rows.getcol('FLAG', first, n)
+            current = pack(flags, rows.getcol('FLAG_ROW', first, n))
+            offset, nbytes = chunks[i][5], chunks[i][6]
+            nflagged += int(flags.sum())
+            ntotal += flags.size
+            if delta is not None:
+                blob, count = encode(bits[offset:offset + nbytes] ^ current)
+                if blob is None:
+                    continue
+                segments[str(i)] = [delta.tell(), len(blob), count]
+                delta.write(blob)
+            bits[offset:offset + nbytes] = current
+        bits.flush()
+        del bits
+        if delta is not None:
+            delta.flush()
+            os.fsync(delta.fileno())
+            delta.close()
+
+        # Commit: until the index is replaced, the versions are as before
+        if delta is not None:
+            head.update(kind = 'delta', segments = segments, bytes = os.path.getsize(self._file(head, 'delta')))
+        elif head is not None:
+            # The rows changed: the old head ends its chain as a full bitmap
+            head['kind'] = 'full'
+        for old in versions:
+            if old['name'] == name:
+                old['name'] = None
+        entry.update(flagged = float(nflagged) / max(ntotal, 1), bytes = size)
+        versions.append(entry)
+        self.index['layouts'][key] = chunks
+        self.index['next'] += 1
+        self.prune()
+        self.save_index()
+        self.sweep()
+        print('Flag version %s of %s saved (%.2f%% flagged, %.3g MB of delta) in %.1f s' % (name, self.vis,
+            100 * entry['flagged'], (head['bytes'] if delta is not None else size) / 1e6, time.time() - t0))
+        return entry
+
+    def bitmap(self, k, i, files):
+        # Bytes of chunk i in version k: those of the head or full bitmap
+        # that ends its chain, with the deltas back to k applied. files
+        # caches the open bitmaps and delta files.
+        versions = self.index['versions']
+        chunk = self.index['layouts'][versions[k]['layout']][i]
+        offset, nbytes = chunk[5], chunk[6]
+        end = k
+        while versions[end]['kind'] == 'delta':
+            end += 1
+        if end not in files:
+            files[end] = self._bitmap(versions[end])
+        bits = np.array(files[end][offset:offset + nbytes])
+        for j in range(end - 1, k - 1, -1):
+            segment = versions[j]['segments'].get(str(i))
+            if segment is None:
+                continue
+            if j not in files:
+                files[j] = open(self._file(versions[j]), 'rb')
+            files[j].seek(segment[0])
+            bits ^= decode(files[j].read(segment[1]), segment[2], nbytes)
+        return bits
+
+    def _close(self, files):
+        for f in files.values():
+            if hasattr(f, 'close'):
+                f.close()
+
+    def restore(self, name, merge = 'replace'):
+        # Put the flags of version name back into vis ('or' / 'and' combine
+        # them with the current flags, as in flagmanager). Returns the
+        # number of rows written.
+        t0 = time.time()
+        k = self.find(name)
+        key = self.index['versions'][k]['layout']
+        if layout_key(layout(self.vis)) != key:
+            raise RuntimeError('The rows of %s have changed since flag version %s was saved' % (self.vis, name))
+        chunks = self.index['layouts'][key]
+        files = {}
+        written = 0
+        for i, rows, first, n in _rows(self.vis, chunks, nomodify = False):
+            flags, flagrow = unpack(self.bitmap(k, i, files), chunks[i][3], chunks[i][4], n)
+            current = rows.getcol('FLAG', first, n)
+            if merge == 'or':
+                flags |= current
+            elif merge == 'and':
+                flags &= current
+            changed = (flags != current).any(axis = (0, 1))
+            if not changed.any():
+                continue
+            if merge != 'replace':
+                flagrow = flags.all(axis = (0, 1))
+            rows.putcol('FLAG', flags, first, n)
+            rows.putcol('FLAG_ROW', flagrow, first, n)
+            written += int(changed.sum())
+        self._close(files)
+        print('Flag version %s of %s restored: %d rows written in %.1f s' % (name, self.vis, written, time.time() - t0))
+        return written
+
+    def diff(self, a, b):
+        # Flags set in version a and b, and those b adds to and removes from a
+        ka, kb = self.find(a), self.find(b)
+        versions = self.index['versions']
+        if versions[ka]['layout'] != versions[kb]['layout']:
+            raise ValueError('Flag versions %s and %s of %s have different rows' % (a, b, self.vis))
+        chunks = self.index['layouts'][versions[ka]['layout']]
+        files = {}
+        result = {'a': 0, 'b': 0, 'added': 0, 'removed': 0, 'total': 0}
+        for i, chunk in enumerate(chunks):
+            ncorr, nchan, n = chunk[3], chunk[4], chunk[2]
+            flags_a = unpack(self.bitmap(ka, i, files), ncorr, nchan, n)[0]
+            flags_b = unpack(self.bitmap(kb, i, files), ncorr, nchan, n)[0]
+            result['a'] += int(flags_a.sum())
+            result['b'] += int(flags_b.sum())
+            result['added'] += int((flags_b & ~flags_a).sum())
+            result['removed'] += int((flags_a & ~flags_b).sum())
+            result['total'] += flags_a.size
+        self._close(files)
+        return result
+
+    def delete(self, name):
+        self.index['versions'][self.find(name)]['name'] = None
+        self.prune()
+        self.save_index()
+        self.sweep()
+
+    def rename(self, oldname, name):
+        self.index['versions'][self.find(oldname)]['name'] = name
+        self.save_index()
+
+    def prune(self):
+        # Drop the unnamed versions that no named version is rebuilt from:
+        # those at the old end of a chain (the head is always kept). Their
+        # files go with the next sweep, once the index is saved.
+        keep = []
+        start = True
+        for entry in self.index['versions']:
+            if start and entry['name'] is None and entry['kind'] != 'head':
+                continue
+            keep.append(entry)
+            start = entry['kind'] != 'delta'
+        self.index['versions'] = keep
+        used = set([entry['layout'] for entry in keep])
+        self.index['layouts'] = dict([(key, chunks) for key, chunks in self.index['layouts'].items() if key in used])
+
+    def size(self):
+        return casa_trace.dir_size(self.path) if os.path.isdir(self.path) else 0
+
+    def list_versions(self):
+        for entry in self.index['versions']:
+            if entry['name'] is not None:
+                print('%-28s %s %6.2f%% flagged %10.3f MB  %s' % (entry['name'], entry['time'], 100 * entry['flagged'],
+                    entry['bytes'] / 1e6, entry['comment']))
+        print('%s: %.3f MB' % (self.path, self.size() / 1e6))
+
+# ------------------------------------------------------------------------
+
+def flagmanager(vis = '', mode = 'list', versionname = '', oldname = '', comment = '', merge = 'replace'):
+    # casatasks.flagmanager, with the versions in the delta store while it
+    # is enabled (save) or while it holds them (restore, delete, rename)
+    store = FlagStore(vis)
+    if mode == 'save' and enabled():
+        return store.save(versionname, comment)
+    if mode in ('restore', 'delete') and versionname in store.versions():
+        return store.restore(versionname, merge) if mode == 'restore' else store.delete(versionname)
+    if mode == 'rename' and oldname in store.versions():
+        return store.rename(oldname, versionname)
+    if mode == 'list' and store.versions():
+        store.list_versions()
+    from casatasks import flagmanager as casa_flagmanager
+    return casa_flagmanager(vis = vis,mode = mode,versionname = versionname,oldname = oldname,comment = comment,merge = merge)
+
+# ------------------------------------------------------------------------
+
+def compare(vis, steps = 4, outfile = 'flagversions.json'):
+    # Save steps + 1 versions of vis, each with a few more channels flagged
+    # (flagdata), with flagmanager and with the delta store, restore the
+    # first with each and write the space used and the save and restore
+    # times to outfile. The flags are left as they were.
+    from casatasks import flagdata
+    from casatasks import flagmanager as casa_flagmanager
+    import casa_flagging
+    nchan = len(casa_flagging.spectral_setup(vis)[0][0])
+    width = max(nchan // 64, 1)
+    store = FlagStore(vis)
+    names = ['casa_flagversions_bench%d' % i for i in range(steps + 1)]
+    results = {'vis': vis, 'versions': names, 'flagmanager': {'save': [], 'bytes': []}, 'delta': {'save': [], 'bytes': []}}
+    for i, name in enumerate(names):
+        if i:
+            first = nchan // 4 + i * width
+            flagdata(vis = vis,mode = 'manual',spw = '*:%d~%d' % (first, first + width - 1),flagbackup = False)
+        t0 = time.time()
+        casa_flagmanager(vis = vis,mode = 'save',versionname = name)
+        results['flagmanager']['save'].append(time.time() - t0)
+        results['flagmanager']['bytes'].append(casa_trace.dir_size(vis.rstrip('/') + '.flagversions/flags.' + name))
+        t0 = time.time()
+        store.save(name)
+        results['delta']['save'].append(time.time() - t0)
+    # Both restores start from the flags of the last version
+    t0 = time.time()
+    casa_flagmanager(vis = vis,mode = 'restore',versionname = names[0])
+    results['flagmanager']['restore'] = time.time() - t0
+    casa_flagmanager(vis = vis,mode = 'restore',versionname = names[-1])
+    t0 = time.time()
+    store.restore(names[0])
+    results['delta']['restore'] = time.time() - t0
+    results['diff'] = store.diff(names[0], names[-1])
+    # The last version is the full bitmap, the others their deltas
+    results['delta']['bytes'] = [store.index['versions'][store.find(name)]['bytes'] for name in names]
+    for name in names:
+        casa_flagmanager(vis = vis,mode = 'delete',versionname = name)
+        store.delete(name)
+    for method in ['flagmanager', 'delta']:
+        results[method]['total_bytes'] = sum(results[method]['bytes'])
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent = 1, sort_keys = True)
+    print('%s: %d versions take %.3f MB with flagmanager, %.3f MB as delta bitmaps' % (vis, len(names),
+        results['flagmanager']['total_bytes'] / 1e6, results['delta']['total_bytes'] / 1e6))
+    print('   save %.1f s / %.1f s, restore %.1f s / %.1f s (flagmanager / delta)' % (
+        sum(results['flagmanager']['save']), sum(results['delta']['save']),
+        results['flagmanager']['restore'], results['delta']['restore']))
+    return results
+
+
+if __name__ == '__main__':
+    # casa --nogui -c casa_flagversions.py [--vis sim.ms] [--list]: compare()
+    # on vis, or list the versions in its delta store; a synthetic
+    # observation (casa_simulate) is made first if vis does not exist
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vis', default = 'flagtest.ms')
+    parser.add_argument('--steps', type = int, default = 4)
+    parser.add_argument('--list', action = 'store_true')
+    parser.add_argument('--nant', type = int, default = 16)
+    parser.add_argument('--nchan', type = int, default = 256)
+    args, unknown = parser.parse_known_args(sys.argv[1:])
+    if args.list:
+        FlagStore(args.vis).list_versions()
+        sys.exit(0)
+    if not os.path.exists(args.vis):
+        import casa_simulate
+        casa_simulate.simulate_observation(args.vis, nant = args.nant, nchan = args.nchan)
+    compare(args.vis, steps = args.steps)
@@ -0,0 +1,97 @@
+# Streaming difference images for the FRB time slices
+# The exported slice FITS files are memory-mapped and subtracted one block
+# of rows at a time; each block is written straight to the output FITS file
+# and per-tile noise and peak statistics are taken in the same pass. Peak
+# memory is a few blocks of rows, whatever the image size, and no CASA
+# image directories are made on the way.
+
+import csv
+import os
+
+import numpy as np
+from astropy.io import fits
+
+STATS_COLUMNS = ['plane', 'y0', 'y1', 'x0', 'x1', 'npix', 'rms', 'madsigma', 'peak', 'peak_y', 'peak_x', 'peak_snr']
+
+# ------------------------------------------------------------------------
+
+def tile_stats(data):
+    # rms, robust (MAD) sigma, peak value and its position for one tile
+    finite = np.isfinite(data)
+    values = data[finite]
+    if values.size == 0:
+        return 0, np.nan, np.nan, np.nan, -1, -1
+    rms = np.sqrt(np.mean(values.astype(np.float64) ** 2))
+    madsigma = 1.4826 * np.median(np.abs(values - np.median(values)))
+    peak_y, peak_x = np.unravel_index(np.argmax(np.where(finite, data, -np.inf)), data.shape)
+    return values.size, rms, madsigma, data[peak_y, peak_x], peak_y, peak_x
+
+
+def difference_fits(image_a, images_b, outfiles, tile = 1024):
+    # Write outfiles[i] = image_a - images_b[i] in one pass over image_a, and
+    # the per-tile statistics of each difference to <outfile>.stats.csv.
+    # Returns, per output, the statistics row of the tile with the highest
+    # peak S/N.
+    if isinstance(images_b, str):
+        images_b, outfiles = [images_b], [outfiles]
+    statsfiles = [os.path.splitext(outfile)[0] + '.stats.csv' for outfile in outfiles]
+    for path in outfiles + statsfiles:
+        if os.path.exists(path):
+            os.remove(path)
+
+    hdul_a = fits.open(image_a, memmap = True)
+    hduls_b = [fits.open(image_b, memmap = True) for image_b in images_b]
+    data_a = hdul_a[0].data
+    ny, nx = data_a.shape[-2:]
+    planes_a = data_a.reshape((-1, ny, nx))
+    planes_b = []
+    for image_b, hdul_b in zip(images_b, hduls_b):
+        if hdul_b[0].data.shape != data_a.shape:
+            raise ValueError('%s and %s have different shapes: %s, %s' % (image_a, image_b, data_a.shape, hdul_b[0].data.shape))
+        planes_b.append(hdul_b[0].data.reshape((-1, ny, nx)))
+
+    streams = []
+    for image_b, outfile in zip(images_b, outfiles):
+        header = hdul_a[0].header.copy()
+        header['BITPIX'] = -32
+        for key in ['BSCALE', 'BZERO']:
+            header.remove(key, ignore_missing = True)
+        header.add_history('Difference image: %s - %s' % (os.path.basename(image_a), os.path.basename(image_b)))
+        streams.append(fits.StreamingHDU(outfile, header))
+    statsout = [open(statsfile, 'w') for statsfile in statsfiles]
+    writers = [csv.writer(f) for f in statsout]
+    for writer in writers:
+        writer.writerow(STATS_COLUMNS)
+
+    best = [None] * len(outfiles)
+    for plane in range(planes_a.shape[0]):
+        for y0 in range(0, ny, tile):
+            y1 = min(y0 + tile, ny)
+            block_a = np.asarray(planes_a[plane, y0:y1], dtype = np.float32)
+            for i in range(len(outfiles)):
+                block = block_a - np.asarray(planes_b[i][plane, y0:y1], dtype = np.float32)
+                streams[i].write(block)
+                for x0 in range(0, nx, tile):
+                    x1 = min(x0 + tile, nx)
+                    npix, rms, madsigma, peak, peak_y, peak_x = tile_stats(block[:, x0:x1])
+                    snr = peak / madsigma if madsigma > 0 else np.nan
+                    row = [plane, y0, y1, x0, x1, npix, rms, madsigma, peak, y0 + peak_y, x0 + peak_x, snr]
+                    writers[i].writerow(row)
+                    if np.isfinite(snr) and (best[i] is None or snr > best[i][-1]):
+                        best[i] = row
+
+    for stream in streams:
+        stream.close()
+    for f in statsout:
+        f.close()
+    for hdul in [hdul_a] + hduls_b:
+        hdul.close()
+
+    results = []
+    for outfile, row in zip(outfiles, best):
+        if row is None:
+            results.append(None)
+            continue
+        print('%s: peak S/N %.1f at pixel (%d, %d), tile sigma %.3g' % (outfile, row[-1], row[10], row[9], row[7]))
+        results.append(dict(zip(STATS_COLUMNS, row)))
+    return results
@@ -0,0 +1,104 @@
+# Image size, cell and w-projection planes from the observation metadata
+# The tclean profiles fix imsize and cell for MeerKAT L-band. The planner
+# derives them from the MS being imaged and the spw selection instead:
+#   - cell: the synthesised beam lambda / longest baseline at the centre
+#     frequency of the selection, sampled with pixperbeam pixels,
+#   - field: out to where the primary beam (a Gaussian with FWHM
+#     1.13 lambda / D, D the dish diameter, at the lowest frequency
+#     selected) drops to pbcut, on an FFT-friendly image size,
+#   - wprojplanes: enough planes that the w-term phase at the field edge,
+#     2 pi w (1 - sqrt(1 - l^2)) with w bounded by the longest baseline in
+#     wavelengths at the highest frequency, changes by at most about a
+#     radian from one plane to the next.
+# So an S-band or spw-restricted image gets a finer cell and a smaller
+# field, and a UHF one a coarser cell and a larger field, than the L-band
+# default.
+
+import math
+
+import numpy as np
+
+import casa_averaging
+import casa_flagging
+import casa_timeslices
+
+# Primary beam FWHM in units of lambda / D (MeerKAT L-band)
+PB_FWHM = 1.13
+
+# ------------------------------------------------------------------------
+
+def selected_freqs(setup, spw = ''):
+    # Channel frequencies (Hz) of the tclean spw selection ('', '0',
+    # '0:100~500;600~900', '*:900~1200MHz', ...) in a spectral set-up
+    # (casa_flagging.spectral_setup)
+    if not spw:
+        return np.concatenate([freqs for freqs, widths in setup])
+    selected = []
+    for part in spw.split(','):
+        spws, chans = part.split(':') if ':' in part else (part, '')
+        ids = range(len(setup)) if spws in ('*', '') else [int(spws)]
+        for i in ids:
+            freqs = setup[i][0]
+            if not chans:
+                selected.append(freqs)
+                continue
+            for chan in chans.split(';'):
+                if 'Hz' in chan:
+                    lo, hi = casa_flagging.parse_range(chan)
+                    selected.append(freqs[(freqs >= lo) & (freqs <= hi)])
+                else:
+                    first, last = chan.split('~') if '~' in chan else (chan, chan)
+                    selected.append(freqs[int(first):int(last) + 1])
+    freqs = np.concatenate(selected) if selected else np.zeros(0)
+    if freqs.size == 0:
+        raise ValueError('The spw selection %s has no channels' % spw)
+    return freqs
+
+
+def dish_diameter(vis):
+    # Smallest dish diameter (m) in vis
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/ANTENNA')
+    diameter = float(tb.getcol('DISH_DIAMETER').min())
+    tb.close()
+    return diameter
+
+
+def pb_radius(freq, diameter, pbcut):
+    # Radius (radians) where a Gaussian primary beam falls to pbcut
+    fwhm = PB_FWHM * casa_averaging.SPEED_OF_LIGHT / (freq * diameter)
+    return fwhm * math.sqrt(math.log(1.0 / pbcut) / (4.0 * math.log(2.0)))
+
+
+def w_planes(maxbaseline, maxfreq, radius):
+    # Number of w-projection planes for a field of radius (radians)
+    wmax = maxbaseline * maxfreq / casa_averaging.SPEED_OF_LIGHT
+    phase = 2.0 * math.pi * wmax * (1.0 - math.sqrt(1.0 - math.sin(radius) ** 2))
+    return max(int(math.ceil(phase)), 1)
+
+# ------------------------------------------------------------------------
+
+def plan(vis, spw = '', pbcut = 0.1, pixperbeam = 3.0, radius = None):
+    # tclean imsize, cell and wprojplanes for imaging the spw selection of
+    # vis out to the pbcut level of the primary beam (or out to radius, in
+    # radians, if given)
+    geometry = casa_averaging.ms_geometry(vis)
+    freqs = selected_freqs(casa_flagging.spectral_setup(vis), spw)
+    minfreq, maxfreq = float(freqs.min()), float(freqs.max())
+    centre = 0.5 * (minfreq + maxfreq)
+    diameter = dish_diameter(vis)
+
+    beam = casa_averaging.SPEED_OF_LIGHT / (centre * geometry['maxbaseline'])
+    # Cell rounded down to 0.1 arcsec (two significant figures below 1 arcsec)
+    cell = math.degrees(beam / pixperbeam) * 3600.0
+    cell = math.floor(cell * 10.0) / 10.0 if cell >= 1.0 else float('%.2g' % cell)
+    if radius is None:
+        radius = pb_radius(minfreq, diameter, pbcut)
+    npix = casa_timeslices.fft_size(2.0 * math.degrees(radius) * 3600.0 / cell)
+    wprojplanes = w_planes(geometry['maxbaseline'], maxfreq, math.radians(0.5 * npix * cell / 3600.0))
+
+    print('Image plan for %s%s: %.0f-%.0f MHz, longest baseline %.0f m, %.1f m dishes: cell %garcsec (%.1f arcsec beam), %d x %d pixels (%.2f deg, primary beam %g), %d w-planes' % (
+        vis, ' spw ' + spw if spw else '', minfreq / 1e6, maxfreq / 1e6, geometry['maxbaseline'], diameter,
+        cell, math.degrees(beam) * 3600.0, npix, npix, npix * cell / 3600.0, pbcut, wprojplanes))
+    return {'imsize': [npix, npix], 'cell': ['%garcsec' % cell], 'wprojplanes': wprojplanes}
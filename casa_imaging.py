@@ -0,0 +1,168 @@
+# Imaging engine for the MeerKAT imaging pipelines
+# Every image the pipelines make (full integration, time slices, self-cal)
+# is described by an ImageSpec: the image name, the MS and a named tclean
+# parameter profile, plus the few parameters that differ from the profile
+# (timerange, spw, phasecenter, ...). The specs are turned into tclean and
+# exportfits steps on a casa_scheduler task graph, which an executor then
+# runs serially, on a pool of worker processes or, under mpicasa, with
+# parallel tclean (casa_mpi). The wall time of every image is reported and
+# returned.
+
+import time
+
+import casa_mpi
+import casa_scheduler
+
+# tclean parameters for the MeerKAT L-band wide-field images. vis and
+# imagename come from the ImageSpec.
+WIDEFIELD = dict(selectdata=True,field="",spw="",timerange="",uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imsize=[5000, 5000],cell=['3.0arcsec'],phasecenter="",stokes="I",projection="SIN",startmodel="",specmode="mfs",reffreq="",nchan=-1,start="",width="",outframe="LSRK",veltype="radio",restfreq=[],interpolation="linear",perchanweightdensity=True,gridder="widefield",facets=1,psfphasecenter="",chanchunks=1,wprojplanes=-1,vptable="",mosweight=True,aterm=True,psterm=False,wbawp=False,conjbeams=False,cfcache="",usepointing=False,computepastep=360.0,rotatepastep=360.0,pointingoffsetsigdev=[],pblimit=-1,normtype="flatnoise",deconvolver="mtmfs",scales=[0, 5, 15],nterms=2,smallscalebias=0.6,restoration=True,restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0,noise="1.0Jy",npixels=0,uvtaper=[],niter=25000,gain=0.1,threshold="0.05mJy",nsigma=0.0,cycleniter=-1,cyclefactor=0.5,minpsffraction=0.05,maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,sidelobethreshold=2.5,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,verbose=False,fastnoise=True,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
+
+PROFILES = {
+    'widefield': WIDEFIELD,
+    # Same set-up without deconvolution
+    'dirty': dict(WIDEFIELD, niter=0, usemask='user', savemodel='none'),
+    # Small, shallow images for benchmarks on synthetic data (casa_benchmark)
+    'quick': dict(WIDEFIELD, imsize=[1024, 1024], niter=1000, threshold='1mJy'),
+}
+
+# ------------------------------------------------------------------------
+
+def profile_pars(profile, **overrides):
+    # The tclean parameters of a named profile with overrides applied
+    if profile not in PROFILES:
+        raise ValueError('Unknown imaging profile %s (known: %s)' % (profile, ', '.join(sorted(PROFILES))))
+    unknown = set(overrides) - set(PROFILES[profile]) - set(['vis', 'imagename'])
+    if unknown:
+        raise ValueError('Unknown tclean parameters: ' + ', '.join(sorted(unknown)))
+    return dict(PROFILES[profile], **overrides)
+
+
+class ImageSpec(object):
+
+    def __init__(self, imagename, vis, profile = 'widefield', export = True, **overrides):
+        # overrides are tclean parameters that differ from the profile
+        self.imagename = imagename
+        self.vis = vis
+        self.profile = profile
+        self.export = export
+        self.overrides = overrides
+        # Fail on a bad profile or parameter when the spec is made
+        profile_pars(profile, **overrides)
+
+    def pars(self):
+        return profile_pars(self.profile, vis = self.vis, imagename = self.imagename, **self.overrides)
+
+    def derive(self, imagename, **overrides):
+        # A copy of this spec with a new image name and further overrides
+        return ImageSpec(imagename, self.vis, self.profile, self.export, **dict(self.overrides, **overrides))
+
+    def product(self, kind):
+        # Name of a tclean product ('image', 'residual', 'model', ...), the
+        # zeroth Taylor term for mtmfs
+        if self.pars()['deconvolver'] == 'mtmfs':
+            return '%s.%s.tt0' % (self.imagename, kind)
+        return '%s.%s' % (self.imagename, kind)
+
+    @property
+    def image(self):
+        # The restored image
+        return self.product('image')
+
+    @property
+    def fitsimage(self):
+        return self.imagename + '.fits'
+
+    def __repr__(self):
+        return 'ImageSpec(%s, %s)' % (self.imagename, self.profile)
+
+
+def add_image(graph, spec, name = None, reads = (), deps = ()):
+    # Add the tclean (and exportfits) steps of spec to a TaskGraph. Writing
+    # the model to MODEL_DATA modifies the MS, anything else only reads it.
+    # Returns the tclean Task.
+    name = name or spec.imagename
+    pars = spec.pars()
+    if pars['savemodel'] == 'modelcolumn':
+        task = graph.add(name,'tclean',reads=list(reads),writes=[spec.vis,spec.imagename],deps=deps,**pars)
+    else:
+        task = graph.add(name,'tclean',reads=[spec.vis]+list(reads),writes=[spec.imagename],deps=deps,**pars)
+    if spec.export:
+        graph.add('export_' + name,'exportfits',reads=[spec.imagename],creates=[spec.fitsimage],imagename=spec.image,fitsimage=spec.fitsimage)
+    return task
+
+# ------------------------------------------------------------------------
+# Executors: run a task graph and return the wall time of each task
+
+class SerialExecutor(object):
+
+    def run(self, graph):
+        return graph.run(nproc = 1)
+
+    def __repr__(self):
+        return 'SerialExecutor()'
+
+
+class ProcessExecutor(object):
+
+    def __init__(self, nproc = 3):
+        self.nproc = nproc
+
+    def run(self, graph):
+        return graph.run(nproc = self.nproc)
+
+    def __repr__(self):
+        return 'ProcessExecutor(%d)' % self.nproc
+
+
+class MPIExecutor(object):
+    # Under mpicasa: the steps run one after another in the MPI client and
+    # each tclean spreads its major cycles over the MPI servers
+
+    def run(self, graph):
+        for task in graph.tasks:
+            if task.func == 'tclean':
+                task.kwargs['parallel'] = True
+        return graph.run(nproc = 1)
+
+    def __repr__(self):
+        return 'MPIExecutor()'
+
+
+def default_executor(nproc = 1):
+    # MPIExecutor when running under mpicasa, otherwise nproc processes
+    if casa_mpi.mpi_enabled():
+        return MPIExecutor()
+    if nproc > 1:
+        return ProcessExecutor(nproc)
+    return SerialExecutor()
+
+# ------------------------------------------------------------------------
+
+def image_times(specs, timings):
+    # Wall time of each spec: its tclean and exportfits steps
+    return dict([(spec.imagename, timings.get(spec.imagename, 0.0) + timings.get('export_' + spec.imagename, 0.0)) for spec in specs])
+
+
+def report(specs, timings, wall):
+    print('Imaging timings (s)')
+    times = image_times(specs, timings)
+    for spec in specs:
+        print('   %-32s %9.1f' % (spec.imagename, times[spec.imagename]))
+    print('   %-32s %9.1f' % ('sum (serial equivalent)', sum(timings.values())))
+    print('   %-32s %9.1f' % ('wall', wall))
+
+
+def make_images(specs, executor = None):
+    # Make (and export) the images of one spec or a list of specs. Images
+    # that write MODEL_DATA to the same MS keep their order. Returns the
+    # wall time of each image.
+    if isinstance(specs, ImageSpec):
+        specs = [specs]
+    executor = executor or default_executor()
+    graph = casa_scheduler.TaskGraph()
+    for spec in specs:
+        add_image(graph, spec)
+    t0 = time.time()
+    timings = executor.run(graph)
+    report(specs, timings, time.time() - t0)
+    return image_times(specs, timings)
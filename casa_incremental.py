@@ -0,0 +1,147 @@
+# Incremental runs on data that arrives in chunks
+# A ledger (JSON) records the scans of each MS that earlier runs processed.
+# The K, G and B tables are solved with solint='inf' per scan, so when new
+# scans are added to the MS files the solutions of the old scans stay as
+# they are. An incremental run therefore only:
+#   - flags the new scans,
+#   - solves the per-scan phase calibrator (or, with one calibrator, the
+#     bandpass calibrator) gains and delays of the new scans and appends
+#     them to the final K and G tables; the bandpass is not re-solved,
+#   - applies the tables to the new scans of the calibrators and target,
+#   - images the new target scans and adds that image to the full
+#     integration image, weighted by the sum of the imaging weights.
+# restrict() turns the full pipeline graph into the incremental one: the
+# steps to rerun are listed by name, given a scan selection of the new scans
+# of their MS, and everything else is skipped.
+
+import json
+import os
+import shutil
+
+# ------------------------------------------------------------------------
+
+def ms_scans(vis):
+    # Scan numbers in vis
+    from casatools import msmetadata
+    msmd = msmetadata()
+    msmd.open(vis)
+    scans = sorted([int(scan) for scan in msmd.scannumbers()])
+    msmd.close()
+    return scans
+
+
+def scan_selection(scans):
+    # CASA scan selection string, with runs of scans as ranges
+    ranges = []
+    for scan in sorted(scans):
+        if ranges and scan == ranges[-1][1] + 1:
+            ranges[-1][1] = scan
+        else:
+            ranges.append([scan, scan])
+    return ','.join([str(a) if a == b else '%d~%d' % (a, b) for a, b in ranges])
+
+
+def chunk_tag(scans):
+    # Suffix for the products of a chunk of scans
+    if not scans:
+        return ''
+    return '_scans%d-%d' % (min(scans), max(scans))
+
+
+def image_weight(imagename):
+    # Sum of the imaging weights of a tclean image
+    from casatools import image
+    ia = image()
+    for suffix in ['.sumwt', '.sumwt.tt0']:
+        if os.path.exists(imagename + suffix):
+            ia.open(imagename + suffix)
+            weight = float(ia.getchunk().sum())
+            ia.close()
+            return weight
+    raise IOError('No sum of weights image for %s' % imagename)
+
+
+class ScanLedger(object):
+
+    def __init__(self, path = 'increments.json'):
+        self.path = path
+        self.manifest = {'scans': {}, 'images': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent = 1, sort_keys = True)
+        os.rename(tmp, self.path)
+
+    def started(self, vis):
+        # True if an earlier run processed scans of vis
+        return bool(self.manifest['scans'].get(os.path.normpath(vis)))
+
+    def new_scans(self, vis):
+        done = set(self.manifest['scans'].get(os.path.normpath(vis), []))
+        return [scan for scan in ms_scans(vis) if scan not in done]
+
+    def mark(self, vis, scans):
+        # Record scans of vis as processed
+        vis = os.path.normpath(vis)
+        self.manifest['scans'][vis] = sorted(set(self.manifest['scans'].get(vis, [])) | set(scans))
+        self.save()
+
+    def set_image(self, imagename, weight, chunks):
+        self.manifest['images'][imagename] = {'weight': weight, 'chunks': chunks}
+        self.save()
+
+    def image(self, imagename):
+        return self.manifest['images'].get(imagename)
+
+# ------------------------------------------------------------------------
+
+def restrict(graph, steps, scans):
+    # Make graph rerun only the steps named in steps ({name: parameter
+    # overrides}) on the new scans: scans maps each MS to its new scans, and
+    # a step whose vis is one of them gets a scan selection. Steps that
+    # append to a table no longer make it from scratch. Stage checkpoints
+    # are kept. Returns the names of the steps to skip.
+    skip = set()
+    selections = dict([(os.path.normpath(vis), scan_selection(scans[vis])) for vis in scans])
+    for task in graph.tasks:
+        if task.name.startswith('checkpoint_'):
+            continue
+        if task.name not in steps:
+            skip.add(task.name)
+            continue
+        task.kwargs.update(steps[task.name])
+        vis = task.kwargs.get('vis')
+        if isinstance(vis, str) and os.path.normpath(vis) in selections:
+            task.kwargs['scan'] = selections[os.path.normpath(vis)]
+        if task.kwargs.get('append'):
+            task.writes.extend(task.creates)
+            task.creates = []
+    return skip
+
+
+def accumulate(ledger, spec, chunk):
+    # Add the image of a chunk of new scans (an ImageSpec) to the full
+    # integration image of spec, weighting each by its sum of weights, and
+    # re-export it. The first call only records the weight of the full image.
+    from casatasks import exportfits, immath
+    entry = ledger.image(spec.imagename)
+    if entry is None:
+        ledger.set_image(spec.imagename, image_weight(spec.imagename), [])
+        return
+    weight = image_weight(chunk.imagename)
+    total = entry['weight'] + weight
+    tmp = spec.image + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    immath(imagename = [spec.image, chunk.image],mode = 'evalexpr',outfile = tmp,
+        expr = '(IM0*%r+IM1*%r)/%r' % (entry['weight'], weight, total))
+    shutil.rmtree(spec.image)
+    os.rename(tmp, spec.image)
+    print('Added %s (weight %.4g) to %s (weight %.4g)' % (chunk.image, weight, spec.image, entry['weight']))
+    ledger.set_image(spec.imagename, total, entry['chunks'] + [chunk.imagename])
+    if spec.export:
+        exportfits(imagename = spec.image,fitsimage = spec.fitsimage,overwrite = True)
@@ -0,0 +1,112 @@
+# Clean masks made once from the full integration image
+# tclean's auto-multithresh masking (with growiterations=75 and
+# dogrowprune) recomputes the mask in every major cycle, which costs a lot
+# on 5000 x 5000 images. The time slices and self-cal images see the same
+# sources as the full integration image, so with a fixed mask the mask is
+# derived once from the restored full image: pixels above threshold times
+# its MAD sigma, grown by a few pixels (binary dilation with a disc), and
+# written as a CASA image with the same coordinates. Later images with the
+# same geometry (imsize, cell, phase centre) use it as a user mask.
+
+import csv
+import os
+import time
+
+import numpy as np
+
+import casa_imaging
+
+# Parameters that must match for a mask to be reused
+GEOMETRY = ['imsize', 'cell', 'phasecenter', 'projection']
+
+# ------------------------------------------------------------------------
+
+def mad_sigma(data):
+    # Robust noise of the finite pixels of data
+    data = data[np.isfinite(data)]
+    if data.size == 0:
+        return 0.0
+    return 1.4826 * float(np.median(np.abs(data - np.median(data))))
+
+
+def dilate(mask, radius):
+    # Binary dilation of a 2D mask with a disc of radius pixels
+    if radius <= 0:
+        return mask
+    grown = mask.copy()
+    ny, nx = mask.shape
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if (dy or dx) and dy * dy + dx * dx <= radius * radius:
+                grown[max(dy, 0):ny + min(dy, 0), max(dx, 0):nx + min(dx, 0)] |= \
+                    mask[max(-dy, 0):ny + min(-dy, 0), max(-dx, 0):nx + min(-dx, 0)]
+    return grown
+
+
+def threshold_mask(plane, threshold = 5.0, radius = 3):
+    # Pixels of a 2D image above threshold times its MAD sigma, dilated by
+    # radius pixels
+    sigma = mad_sigma(plane)
+    mask = np.isfinite(plane) & (plane > threshold * sigma)
+    return dilate(mask, radius), sigma
+
+
+def make_mask(spec, maskname, threshold = 5.0, radius = 3):
+    # Write maskname (1 inside, 0 outside) from the restored image of spec
+    # (an ImageSpec), unless it is newer than the image. Returns maskname.
+    from casatools import image
+    if os.path.exists(maskname) and os.path.getmtime(maskname) >= os.path.getmtime(spec.image):
+        return maskname
+    t0 = time.time()
+    ia = image()
+    ia.open(spec.image)
+    pixels = ia.getchunk(dropdeg = False)
+    mask = np.zeros(pixels.shape, dtype = np.float32)
+    # One plane per Stokes and channel (axes x, y, stokes, frequency)
+    for index in np.ndindex(*pixels.shape[2:]):
+        plane, sigma = threshold_mask(pixels[(slice(None), slice(None)) + index], threshold, radius)
+        mask[(slice(None), slice(None)) + index] = plane
+    out = ia.subimage(outfile = maskname, overwrite = True)
+    ia.close()
+    out.putchunk(mask)
+    out.done()
+    print('Clean mask %s from %s: %.2f%% of the pixels above %g x %.3g Jy/beam, grown by %d pixels (%.1f s)' % (
+        maskname, spec.image, 100.0 * mask.mean(), threshold, sigma, radius, time.time() - t0))
+    return maskname
+
+
+def same_geometry(spec, reference):
+    pars, ref = spec.pars(), reference.pars()
+    return all([pars[key] == ref[key] for key in GEOMETRY])
+
+
+def with_mask(spec, maskname, reference):
+    # spec using maskname as a fixed user mask if maskname exists and spec
+    # has the geometry of the reference spec it was made from; else spec
+    if not maskname or not os.path.exists(maskname):
+        return spec
+    if not same_geometry(spec, reference):
+        print('%s: different geometry from %s, keeps %s masking' % (spec.imagename, reference.imagename, spec.pars()['usemask']))
+        return spec
+    return spec.derive(spec.imagename, usemask = 'user', mask = maskname)
+
+# ------------------------------------------------------------------------
+
+def compare(spec, maskname, outfile = 'maskbench.csv', executor = None):
+    # Image spec once with its own masking and once with the fixed mask and
+    # append the two wall times and the saving to outfile
+    auto = spec.derive(spec.imagename + '_automask', savemodel = 'none')
+    fixed = spec.derive(spec.imagename + '_fixedmask', savemodel = 'none', usemask = 'user', mask = maskname)
+    auto.export = fixed.export = False
+    times = casa_imaging.make_images(auto, executor = executor)
+    times.update(casa_imaging.make_images(fixed, executor = executor))
+    row = [spec.imagename, '%.1f' % times[auto.imagename], '%.1f' % times[fixed.imagename],
+        '%.1f' % (times[auto.imagename] - times[fixed.imagename])]
+    new = not os.path.exists(outfile)
+    with open(outfile, 'a') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(['imagename', 'automask_s', 'fixedmask_s', 'saving_s'])
+        writer.writerow(row)
+    print('%s: %s s with %s masking, %s s with the fixed mask' % (spec.imagename, row[1], spec.pars()['usemask'], row[2]))
+    return times
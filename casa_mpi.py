@@ -0,0 +1,170 @@
+# MPI-parallel runs of the pipelines with mpicasa
+# Under mpicasa the CASA session is an MPI client with n-1 servers. An MS
+# partitioned into a Multi-MS (one sub-MS per scan or spw) is processed by
+# flagdata and applycal one sub-MS per server, and tclean with parallel=True
+# splits its major cycles over the servers. The pipelines check
+# mpi_enabled() and, when it is true, partition their input MS files and
+# image through casa_imaging.MPIExecutor instead of the process pool.
+#
+# Launcher, outside CASA:
+#   python casa_mpi.py run -n 8 casa_pipeline_multims_V0_0.py [--resume ...]
+#   python casa_mpi.py bench -n 8 --nant 32 --nchan 512 --duration 2h
+# bench makes a synthetic MS (casa_simulate) and times the same flagging,
+# calibration and imaging steps in a serial CASA session and under mpicasa.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+BENCH_ENV = 'CASA_MPI_BENCH'
+# casa -c does not always set __file__
+HERE = os.path.dirname(os.path.abspath(globals().get('__file__', sys.argv[0])))
+
+# ------------------------------------------------------------------------
+
+def mpi_enabled():
+    # True in a CASA session started by mpicasa with at least one server
+    try:
+        from casampi.MPIEnvironment import MPIEnvironment
+    except ImportError:
+        return False
+    return bool(MPIEnvironment.is_mpi_enabled) and MPIEnvironment.mpi_world_size > 1
+
+
+def mms_name(vis):
+    return os.path.splitext(os.path.normpath(vis))[0] + '.mms'
+
+
+def mms_pars(separationaxis = 'scan', numsubms = 'auto'):
+    # mstransform parameters that make its output a Multi-MS
+    return dict(createmms = True,separationaxis = separationaxis,numsubms = numsubms)
+
+
+def partition_pars(vis, outputvis = None, separationaxis = 'scan', numsubms = 'auto'):
+    # mstransform parameters that copy vis into a Multi-MS
+    return dict(vis = vis,outputvis = outputvis or mms_name(vis),datacolumn = 'all',**mms_pars(separationaxis, numsubms))
+
+# ------------------------------------------------------------------------
+# Benchmark
+
+def casa_command(script, nproc = 1, casa = 'casa', mpicasa = 'mpicasa', args = ()):
+    # args are passed on to the script (e.g. --resume, --from-stage stage2)
+    command = [casa, '--nogui', '--agg', '--nologger', '-c', script] + list(args)
+    if nproc > 1:
+        command = [mpicasa, '-n', str(nproc)] + command
+    return command
+
+
+def run_casa(script, nproc = 1, casa = 'casa', mpicasa = 'mpicasa', env = None, cwd = None, args = ()):
+    command = casa_command(script, nproc = nproc, casa = casa, mpicasa = mpicasa, args = args)
+    print(' '.join(command))
+    t0 = time.time()
+    subprocess.check_call(command, env = dict(os.environ, **(env or {})), cwd = cwd or os.getcwd())
+    return time.time() - t0
+
+
+def bench_steps(vis, tag, separationaxis = 'scan', imsize = 2048, cell = '3.0arcsec'):
+    # Runs inside CASA: the flagging, calibration and imaging steps of the
+    # pipelines on vis, timed one by one. Writes mpibench_<tag>.json.
+    from casatasks import applycal, flagdata, gaincal, mstransform
+    import casa_imaging
+    timings = []
+    def timed(name, func, **kwargs):
+        t0 = time.time()
+        func(**kwargs)
+        timings.append((name, time.time() - t0))
+        print('%-24s %9.1f s' % (name, timings[-1][1]))
+
+    if mpi_enabled():
+        timed('partition', mstransform, **partition_pars(vis, separationaxis = separationaxis))
+        vis = mms_name(vis)
+    gtab = vis + '.bench.G'
+    timed('tfcrop', flagdata, vis = vis, mode = 'tfcrop', datacolumn = 'data', flagbackup = False)
+    timed('rflag', flagdata, vis = vis, mode = 'rflag', datacolumn = 'data', flagbackup = False)
+    timed('gaincal', gaincal, vis = vis, caltable = gtab, solint = '64s', calmode = 'p', refant = '0', minsnr = 3)
+    timed('applycal', applycal, vis = vis, gaintable = [gtab], calwt = False, flagbackup = False)
+    spec = casa_imaging.ImageSpec(tag + '_bench', vis, 'widefield', imsize = [imsize, imsize], cell = [cell], niter = 1000, savemodel = 'none', export = False)
+    t0 = time.time()
+    casa_imaging.make_images(spec)
+    timings.append(('tclean', time.time() - t0))
+
+    with open('mpibench_%s.json' % tag, 'w') as f:
+        json.dump({'vis': vis, 'mpi': mpi_enabled(), 'timings': timings}, f, indent = 1)
+
+
+def bench(args):
+    # Make the synthetic MS once, then run the steps on a fresh copy of it
+    # serially and under mpicasa and print the two sets of timings
+    pars = {'path': HERE, 'simulate': dict(vis = args.vis, nant = args.nant, nchan = args.nchan, inttime = args.inttime, duration = args.duration)}
+    if not os.path.exists(args.vis):
+        run_casa(os.path.join(HERE, 'casa_mpi.py'), casa = args.casa, env = {BENCH_ENV: json.dumps(pars)})
+
+    results = {}
+    for tag, nproc in [('serial', 1), ('mpi', args.nproc)]:
+        vis = '%s_%s.ms' % (os.path.splitext(args.vis)[0], tag)
+        for path in [vis, mms_name(vis)]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        shutil.copytree(args.vis, vis)
+        pars = {'path': HERE, 'bench': dict(vis = vis, tag = tag, separationaxis = args.separationaxis, imsize = args.imsize)}
+        wall = run_casa(os.path.join(HERE, 'casa_mpi.py'), nproc = nproc, casa = args.casa, mpicasa = args.mpicasa, env = {BENCH_ENV: json.dumps(pars)})
+        with open('mpibench_%s.json' % tag) as f:
+            results[tag] = json.load(f)
+        results[tag]['wall'] = wall
+
+    print('%-24s %12s %12s %9s' % ('step', 'serial (s)', 'mpi-%d (s)' % args.nproc, 'speed-up'))
+    serial = dict(results['serial']['timings'])
+    for name, mpi_time in results['mpi']['timings']:
+        serial_time = serial.get(name)
+        if serial_time is None:
+            print('%-24s %12s %12.1f %9s' % (name, '-', mpi_time, '-'))
+        else:
+            print('%-24s %12.1f %12.1f %9.2f' % (name, serial_time, mpi_time, serial_time / mpi_time))
+    print('%-24s %12.1f %12.1f %9.2f' % ('wall (incl. start-up)', results['serial']['wall'], results['mpi']['wall'], results['serial']['wall'] / results['mpi']['wall']))
+    with open('mpibench.json', 'w') as f:
+        json.dump(results, f, indent = 1)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Run the pipelines under mpicasa, or benchmark serial against MPI CASA')
+    parser.add_argument('--casa', default = 'casa', help = 'casa executable')
+    parser.add_argument('--mpicasa', default = 'mpicasa', help = 'mpicasa executable')
+    sub = parser.add_subparsers(dest = 'command')
+    run = sub.add_parser('run', help = 'run a pipeline script under mpicasa')
+    run.add_argument('script')
+    run.add_argument('-n', '--nproc', type = int, default = 4, help = 'number of MPI processes (client + servers)')
+    run.add_argument('args', nargs = argparse.REMAINDER, help = 'script arguments, e.g. --resume or --from-stage stage2')
+    b = sub.add_parser('bench', help = 'benchmark serial against MPI CASA on a synthetic MS')
+    b.add_argument('-n', '--nproc', type = int, default = 4, help = 'number of MPI processes (client + servers)')
+    b.add_argument('--vis', default = 'mpibench.ms')
+    b.add_argument('--nant', type = int, default = 32)
+    b.add_argument('--nchan', type = int, default = 512)
+    b.add_argument('--inttime', default = '8s')
+    b.add_argument('--duration', default = '2h')
+    b.add_argument('--imsize', type = int, default = 2048)
+    b.add_argument('--separationaxis', default = 'scan', choices = ['scan', 'spw', 'auto'])
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run_casa(os.path.abspath(args.script), nproc = args.nproc, casa = args.casa, mpicasa = args.mpicasa, args = args.args)
+    elif args.command == 'bench':
+        bench(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    if BENCH_ENV in os.environ:
+        # Started by bench() inside CASA
+        pars = json.loads(os.environ[BENCH_ENV])
+        sys.path.insert(0, pars.pop('path'))
+        if 'simulate' in pars:
+            import casa_simulate
+            casa_simulate.simulate_ms(**pars['simulate'])
+        else:
+            bench_steps(**pars['bench'])
+    else:
+        main()
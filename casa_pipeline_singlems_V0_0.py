@@ -8,6 +8,7 @@
 # Initial config set-up (The target, calibrator names can be obtained using litobs) 
 
 import shutil
+import casa_imaging
 myms = 'FRB19_cut.ms'
 target_ms = 'FRB19_calib.ms'
 bpcal_name = 'J0408-6545'
@@ -20,6 +21,7 @@ gapfill = 24
 myuvrange = '>150m'
 delaycut = 2.5
 target = 'J1337-28'
+improfile = 'widefield'
 ktab0 = myms+'_'+'tt'+'.K0'
 bptab0 = myms+'_'+'tt'+'.B0'
 gtab0 = myms+'_'+'tt'+'.G0'
@@ -260,4 +262,4 @@ flagdata(vis=target_ms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True
 # --- First form the full integration image
 
 full_integ_imagename = target + '_full'
-tclean(vis=target_ms,selectdata=True,field="",spw="",timerange="",uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imagename=full_integ_imagename,imsize=[5000, 5000],cell=['3.0arcsec'],phasecenter="",stokes="I",projection="SIN",startmodel="",specmode="mfs",reffreq="",nchan=-1,start="",width="",outframe="LSRK",veltype="radio",restfreq=[],interpolation="linear",perchanweightdensity=True,gridder="widefield",facets=1,psfphasecenter="",chanchunks=1,wprojplanes=-1,vptable="",mosweight=True,aterm=True,psterm=False,wbawp=False,conjbeams=False,cfcache="",usepointing=False,computepastep=360.0,rotatepastep=360.0,pointingoffsetsigdev=[],pblimit=-1,normtype="flatnoise",deconvolver="mtmfs",scales=[0, 5, 15],nterms=2,smallscalebias=0.6,restoration=True,restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0,noise="1.0Jy",npixels=0,uvtaper=[],niter=25000,gain=0.1,threshold="0.05mJy",nsigma=0.0,cycleniter=-1,cyclefactor=0.5,minpsffraction=0.05,maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,sidelobethreshold=2.5,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,verbose=False,fastnoise=True,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
+casa_imaging.make_images(casa_imaging.ImageSpec(full_integ_imagename,target_ms,improfile,export = False))
@@ -8,7 +8,26 @@
 #################################Set Defaults###################################
 # Initial config set-up (The target, calibrator names can be obtained using listobs) 
 
-import shutil
+import os
+import casa_averaging
+import casa_bandpass
+import casa_config
+import casa_flagging
+import casa_flagversions
+import casa_imaging
+import casa_imagediff
+import casa_imageplan
+import casa_incremental
+import casa_masks
+import casa_mpi
+import casa_rfi
+import casa_scheduler
+import casa_selfcal
+import casa_snapshots
+import casa_stages
+import casa_timeslices
+import casa_trace
+import casa_transients
 myms = 'FRB19_cut.ms'
 target_ms = 'FRB19_calib.ms'
 bpcal_name = 'J0408-6545'
@@ -17,10 +36,69 @@ pcal_name = 'J1311-2216'
 pcal = pcal_name
 refant = 'm001'
 ref_ant = refant
+band = 'L'
 gapfill = 24
+bpclean = True
 myuvrange = '>150m'
 delaycut = 2.5
 target = 'J1337-28'
+doselfcal = True
+selfcal_schedule = [('64s','p'),('32s','p'),('300s','ap')]
+selfcal_minimprove = 0.02
+dotimeslices = True
+time_before = ''
+time_on = ''
+time_after = ''
+imspw = ''
+improfile = 'widefield'
+imageplan = True
+pbcut = 0.1
+pixperbeam = 3.0
+fixedmask = False
+maskthreshold = 5.0
+maskgrow = 3
+maskbenchmark = False
+flagbenchmark = False
+directflags = False
+deltaflags = True
+onepassrfi = False
+nproc = 1
+stagecache = 'stagecache.json'
+slicenproc = 3
+sharepsf = True
+psfmatch = 0.95
+dolocalise = False
+frb_ra = ''
+frb_dec = ''
+locradius = '3arcmin'
+loccell = '1.0arcsec'
+dofullslices = True
+difftile = 1024
+dodetect = True
+detthreshold = 6.0
+noisebox = 64
+matchradius = 3.0
+dosnapshots = False
+snapinterval = '16s'
+snapsize = 512
+snapcell = ''
+snaptimerange = ''
+usempi = casa_mpi.mpi_enabled()
+mmsaxis = 'scan'
+doaverage = True
+smeartol = 0.01
+trace = 'trace.jsonl'
+checkpoint = 'checkpoint.json'
+incremental = False
+increments = 'increments.json'
+
+# ------------------------------------------------------------------------
+# Any of the settings above can be overridden from a JSON, TOML or YAML
+# file given with --config (casa_config)
+
+casa_config.apply(globals())
+
+# Calibration tables, named after the calibrator MS
 ktab0 = myms+'_'+'tt'+'.K0'
 bptab0 = myms+'_'+'tt'+'.B0'
 gtab0 = myms+'_'+'tt'+'.G0'
@@ -33,79 +111,131 @@ ftab2 = myms+'_'+'tt'+'.flux2'
 ktab3 = myms+'_'+'tt'+'.K3'
 gtab3 = myms+'_'+'tt'+'.G3'
 ftab3 = myms+'_'+'tt'+'.flux3'
-doselfcal = True
-dotimeslices = True
-time_before = ''
-time_on = ''
-time_after = ''
-imspw = ''
 
 # ------------------------------------------------------------------------
+# Record every CASA task call (time, CPU, memory, I/O, arguments) in trace
 
-# Begin the actual data analysis
+if trace:
+   casa_trace.start(trace,pipeline = 'singlems_V0_0_dev')
+   casa_trace.instrument(globals())
 
 # ------------------------------------------------------------------------
+# Flag versions (flagmanager save, restore) go to the delta bitmap store of
+# casa_flagversions instead of full copies of FLAG
 
-# Basic flagging step
+casa_flagversions.enable(deltaflags and not usempi)
 
 # ------------------------------------------------------------------------
-# Frequency ranges to flag over all baselines
+# Stages and checkpoints (casa_stages). Run with --resume, or --from-stage
+# and --to-stage, to restart part of the way through; without them the
+# stage cache decides what to rerun.
 
-badfreqs = ['850~900MHz', # Lower band edge
-	'1658~1800MHz', # Upper bandpass edge
-	'1419.8~1421.3MHz'] # Galactic HI
+stages = casa_stages.StageRunner(['basic','stage0','stage1','stage2','stage3','target','image','timeslices','snapshots','selfcal'],path = checkpoint,inputs = [myms])
 
-myspw = ''
-for badfreq in badfreqs:
-	myspw += '*:'+badfreq+','
-myspw = myspw.rstrip(',')
+# ------------------------------------------------------------------------
+# Incremental mode (casa_incremental). The first run processes everything
+# and records the scans of myms in increments. Later runs only flag,
+# calibrate and split out the scans added since (to target_ms with a
+# _scans<first>-<last> suffix), append their per-scan solutions to the
+# final K and G tables and add their image to the full integration image.
+# Self-cal is not run on increments.
+
+ledger = casa_incremental.ScanLedger(increments)
+newscans = {myms: ledger.new_scans(myms)} if incremental else {}
+increment = incremental and ledger.started(myms)
+chunktag, chunkscans = '', ''
+if increment:
+   if usempi:
+      raise RuntimeError('The incremental mode does not work on Multi-MS copies, run it without mpicasa')
+   if not newscans[myms]:
+      print('No new scans since the last run')
+      raise SystemExit(0)
+   chunktag = casa_incremental.chunk_tag(newscans[myms])
+   target_ms = os.path.splitext(target_ms)[0] + chunktag + os.path.splitext(target_ms)[1]
+   print('Incremental run on scans %s of %s' % (casa_incremental.scan_selection(newscans[myms]),myms))
+
+# Steps rerun on the new scans, with their changed parameters
+incremental_steps = dict([(name,{}) for name in ['basic_flags','rflag_bpcal','tfcrop_bpcal','extend_bpcal','rflag_pcal','tfcrop_pcal','extend_pcal','G3_secondary','K3_secondary','applycal_pcal_3','applycal_target','split_target','rflag_target','tfcrop_target','extend_target','rfi_bpcal','rfi_pcal','rfi_target']])
+incremental_steps['setjy'] = {'selectdata': True}
 
-flagdata(vis = myms,mode = 'manual',spw = myspw)
+# ------------------------------------------------------------------------
 
+# Begin the actual data analysis
+
+# ------------------------------------------------------------------------
+
+# Basic flagging step
 
 # ------------------------------------------------------------------------
-# Frequency ranges to flag over a subset of baselines
-# From the MeerKAT Cookbook
-# https://github.com/ska-sa/MeerKAT-Cookbook/blob/master/casa/L-band%20RFI%20frequency%20flagging.ipynb
-
-badfreqs = ['900MHz~915MHz', # GSM and aviation
-	'925MHz~960MHz',				
-	'1080MHz~1095MHz',
-	'1565MHz~1585MHz', # GPS
-	'1217MHz~1237MHz',
-	'1375MHz~1387MHz',
-	'1166MHz~1186MHz',
-	'1592MHz~1610MHz', # GLONASS
-	'1242MHz~1249MHz',
-	'1191MHz~1217MHz', # Galileo
-	'1260MHz~1300MHz',
-	'1453MHz~1490MHz', # Afristar
-	'1616MHz~1626MHz', # Iridium
-	'1526MHz~1554MHz', # Inmarsat
-	'1600MHz'] # Alkantpan
-
-myspw = ''
-for badfreq in badfreqs:
-	myspw += '*:'+badfreq+','
-myspw = myspw.rstrip(',')
-
-flagdata(vis = myms,mode = 'manual',spw = myspw,uvrange = '<600')
+# Frequency ranges to flag over all baselines (badfreqs_all) and over a
+# subset of baselines (badfreqs_subset), from the presets for the band
+# (casa_flagging.BAND_PRESETS: 'L' from the MeerKAT Cookbook, 'UHF', 'S').
+# Add ranges here for RFI particular to an observation. They are resolved
+# to channel ranges once per spectral set-up and cached in flagchannels.json.
 
+badfreqs_all = list(casa_flagging.BAND_PRESETS[band]['all'])
+badfreqs_subset = list(casa_flagging.BAND_PRESETS[band]['subset'])
 
 # ------------------------------------------------------------------------
 # Clipping, quacking, zeros, autos
 # Note that clip will always flag NaN/Inf values even with a range 
+# All of the above selections go into one flagdata list pass per MS
+# With directflags the static selections (channel ranges, short baselines,
+# autocorrelations) are written straight into the FLAG column instead
+# (casa_flagging.flag_static), and only the clipping runs through flagdata.
+# Multi-MS copies (mpicasa) always use flagdata.
 
-flagdata(vis = myms,mode = 'manual',autocorr = True)
+basic_cmds = casa_flagging.basic_flag_cmds(badfreqs_all,badfreqs_subset,subset_uvrange = '<600',clipminmax = [0.0,100.0])
 
-flagdata(vis = myms,mode = 'clip',clipzeros = True)
+# ------------------------------------------------------------------------
+# Image size, cell and w-projection planes from the frequencies, longest
+# baseline and dish size of the data (casa_imageplan): the field reaches
+# the pbcut level of the primary beam, sampled with pixperbeam pixels per
+# beam. The time slices get their own plan when imspw selects part of the band.
+
+plan_pars, slice_plan_pars = {}, {}
+if imageplan:
+   plan_pars = casa_imageplan.plan(myms,pbcut = pbcut,pixperbeam = pixperbeam)
+   slice_plan_pars = casa_imageplan.plan(myms,spw = imspw,pbcut = pbcut,pixperbeam = pixperbeam) if imspw else plan_pars
 
-flagdata(vis = myms,mode = 'clip',clipminmax = [0.0,100.0])
+# ------------------------------------------------------------------------
+# Averaging of the calibrated target: as much as the imaged field allows
+# with at most smeartol peak loss from bandwidth and time smearing, in time
+# bins no longer than the shortest time slice or snapshot. imspw counts the
+# original channels; slice_spw is the same selection on the averaged ones.
+
+avg_pars = {}
+if doaverage:
+   durations = [casa_averaging.duration(t) for t in ([time_before,time_on,time_after] if dotimeslices else []) + ([snapinterval] if dosnapshots else [])]
+   maxtime = min([t for t in durations if t] or [None])
+   avg_pars = casa_averaging.averaging_pars(myms,casa_imaging.profile_pars(improfile,**plan_pars)['imsize'],casa_imaging.profile_pars(improfile,**plan_pars)['cell'],tolerance = smeartol,maxtime = maxtime)
+slice_spw = casa_averaging.averaged_spw(imspw,avg_pars.get('chanbin',1))
+
+# ------------------------------------------------------------------------
+# From here until imaging every step is added to a task graph and run by
+# casa_scheduler. Each step lists the MS and tables it reads and writes;
+# with a single MS the steps mostly run in script order.
+# Tables listed under creates are made from scratch. With stagecache set,
+# steps whose outputs are unchanged since the last run are skipped.
+
+graph = casa_scheduler.TaskGraph()
+graph.begin_stage('basic')
+
+# Under mpicasa the MS is first copied into a Multi-MS, one sub-MS per scan
+# (or spw), so that flagdata and applycal run on the MPI servers. The rest
+# of the graph then runs in the MPI client.
+
+if usempi:
+   nproc = 1
+   graph.add('partition','mstransform',reads=[myms],creates=[casa_mpi.mms_name(myms)],**casa_mpi.partition_pars(myms,separationaxis = mmsaxis))
+   myms = casa_mpi.mms_name(myms)
+
+graph.add('basic_flags',casa_flagging.run_basic_flagging,writes=[myms],vis=myms,cmds=basic_cmds,compare=flagbenchmark,direct=directflags and not usempi)
 
 # ------------------------------------------------------------------------
 # Save the flags
 
-flagmanager(vis = myms,mode = 'save',versionname = 'basic')
+graph.add('save_basic',casa_flagversions.flagmanager,writes=[myms],vis = myms,mode = 'save',versionname = 'basic')
 
 # ------------------------------------------------------------------------
 
@@ -114,23 +244,29 @@ flagmanager(vis = myms,mode = 'save',versionname = 'basic')
 # ------------------------------------------------------------------------
 
 if bpcal == 'J1939-6342':
-   setjy(vis=myms,field=bpcal_name,standard='Stevens-Reynolds 2016',scalebychan=True,usescratch=True)
+   graph.add('setjy','setjy',writes=[myms],vis=myms,field=bpcal_name,standard='Stevens-Reynolds 2016',scalebychan=True,usescratch=True)
         
 elif bpcal == 'J0408-6545':
      bpcal_mod = ([17.066,0.0,0.0,0.0],[-1.179],'1284MHz')
-     setjy(vis=myms,field=bpcal_name,standard='manual',fluxdensity=bpcal_mod[0],spix=bpcal_mod[1],reffreq=bpcal_mod[2],scalebychan=True,usescratch=True)
+     graph.add('setjy','setjy',writes=[myms],vis=myms,field=bpcal_name,standard='manual',fluxdensity=bpcal_mod[0],spix=bpcal_mod[1],reffreq=bpcal_mod[2],scalebychan=True,usescratch=True)
 
 # ------------------------------------------------------------------------
 
 # bpcal flagging
-flagdata(vis=myms,mode='rflag',datacolumn='data',field=bpcal)
-flagdata(vis=myms,mode='tfcrop',datacolumn='data',field=bpcal)
-flagdata(vis=myms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True,flagneartime=True,flagnearfreq=True,field=bpcal)
+if onepassrfi and not usempi:
+   graph.add('rfi_bpcal',casa_rfi.flag_field,writes=[myms],vis=myms,field=bpcal,datacolumn='data')
+else:
+   graph.add('rflag_bpcal','flagdata',writes=[myms],vis=myms,mode='rflag',datacolumn='data',field=bpcal)
+   graph.add('tfcrop_bpcal','flagdata',writes=[myms],vis=myms,mode='tfcrop',datacolumn='data',field=bpcal)
+   graph.add('extend_bpcal','flagdata',writes=[myms],vis=myms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True,flagneartime=True,flagnearfreq=True,field=bpcal)
 
 # pcal flagging
-flagdata(vis=myms,mode='rflag',datacolumn='data',field=pcal)
-flagdata(vis=myms,mode='tfcrop',datacolumn='data',field=pcal)
-flagdata(vis=myms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True,flagneartime=True,flagnearfreq=True,field=pcal)
+if onepassrfi and not usempi:
+   graph.add('rfi_pcal',casa_rfi.flag_field,writes=[myms],vis=myms,field=pcal,datacolumn='data')
+else:
+   graph.add('rflag_pcal','flagdata',writes=[myms],vis=myms,mode='rflag',datacolumn='data',field=pcal)
+   graph.add('tfcrop_pcal','flagdata',writes=[myms],vis=myms,mode='tfcrop',datacolumn='data',field=pcal)
+   graph.add('extend_pcal','flagdata',writes=[myms],vis=myms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True,flagneartime=True,flagnearfreq=True,field=pcal)
 
 # ------------------------------------------------------------------------
 
@@ -141,180 +277,227 @@ flagdata(vis=myms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True,flag
 # --------------------------------------------------------------- #
 # --------------------------- STAGE 0 --------------------------- #
 # --------------------------------------------------------------- #
+graph.begin_stage('stage0')
 
 # ------- K0 (primary)
 
-gaincal(vis=myms,field=bpcal,caltable=ktab0,refant = str(ref_ant),gaintype = 'K',solint = 'inf',parang=False)
+graph.add('K0','gaincal',reads=[myms],creates=[ktab0],vis=myms,field=bpcal,caltable=ktab0,refant = str(ref_ant),gaintype = 'K',solint = 'inf',parang=False)
 
 # ------- G0 (primary; apply K0)
 
-gaincal(vis=myms,field=bpcal,uvrange=myuvrange,caltable=gtab0,gaintype='G',solint='inf',calmode='p',minsnr=5,gainfield=[bpcal],interp = ['nearest'],gaintable=[ktab0])
+graph.add('G0','gaincal',reads=[myms,ktab0],creates=[gtab0],vis=myms,field=bpcal,uvrange=myuvrange,caltable=gtab0,gaintype='G',solint='inf',calmode='p',minsnr=5,gainfield=[bpcal],interp = ['nearest'],gaintable=[ktab0])
 
 # ------- B0 (primary; apply K0, G0)
 
-bandpass(vis=myms,field=bpcal,uvrange=myuvrange,caltable=bptab0,refant = str(ref_ant),solint='inf',combine='',solnorm=False,minblperant=4,minsnr=3.0,bandtype='B',fillgaps=gapfill,parang=False,gainfield=[bpcal,bpcal],interp = ['nearest','nearest'],gaintable=[ktab0,gtab0])
+graph.add('B0','bandpass',reads=[myms,ktab0,gtab0],creates=[bptab0],vis=myms,field=bpcal,uvrange=myuvrange,caltable=bptab0,refant = str(ref_ant),solint='inf',combine='',solnorm=False,minblperant=4,minsnr=3.0,bandtype='B',fillgaps=gapfill,parang=False,gainfield=[bpcal,bpcal],interp = ['nearest','nearest'],gaintable=[ktab0,gtab0])
 
-flagdata(vis=bptab0,mode='tfcrop',datacolumn='CPARAM')
-flagdata(vis=bptab0,mode='rflag',datacolumn='CPARAM')
+if bpclean:
+   graph.add('clean_B0',casa_bandpass.clean_bandpass,writes=[bptab0],caltable=bptab0,gapfill=gapfill)
+else:
+   graph.add('tfcrop_B0','flagdata',writes=[bptab0],vis=bptab0,mode='tfcrop',datacolumn='CPARAM')
+   graph.add('rflag_B0','flagdata',writes=[bptab0],vis=bptab0,mode='rflag',datacolumn='CPARAM')
 
 # ------- Correct primary data with K0,B0,G0
 
-applycal(vis=myms,gaintable=[ktab0,gtab0,bptab0],field=bpcal,parang=False,gainfield=[bpcal,bpcal,bpcal],interp = ['nearest','nearest','nearest'])
+graph.add('applycal_bpcal_0','applycal',reads=[ktab0,gtab0,bptab0],writes=[myms],vis=myms,gaintable=[ktab0,gtab0,bptab0],field=bpcal,parang=False,gainfield=[bpcal,bpcal,bpcal],interp = ['nearest','nearest','nearest'])
 
 # ------- Flag primary on CORRECTED_DATA - MODEL_DATA
 
-flagdata(vis=myms,mode='rflag',datacolumn='residual',field=bpcal)
-flagdata(vis=myms,mode='tfcrop',datacolumn='residual',field=bpcal)
-flagmanager(vis=myms,mode='save',versionname='bpcal_residual_flags')
+if onepassrfi and not usempi:
+   graph.add('rfi_bpcal_residual',casa_rfi.flag_field,writes=[myms],vis=myms,field=bpcal,datacolumn='residual',steps=('rflag','tfcrop'))
+else:
+   graph.add('rflag_bpcal_residual','flagdata',writes=[myms],vis=myms,mode='rflag',datacolumn='residual',field=bpcal)
+   graph.add('tfcrop_bpcal_residual','flagdata',writes=[myms],vis=myms,mode='tfcrop',datacolumn='residual',field=bpcal)
+graph.add('save_bpcal_residual_flags',casa_flagversions.flagmanager,writes=[myms],vis=myms,mode='save',versionname='bpcal_residual_flags')
 
 # --------------------------------------------------------------- #
 # --------------------------- STAGE 1 --------------------------- #
 # --------------------------------------------------------------- #
+graph.begin_stage('stage1')
 
 # ------- K1 (primary; apply B0, G0)
 
-gaincal(vis=myms,field=bpcal,caltable=ktab1,refant = str(ref_ant),gaintype = 'K',solint = 'inf',parang=False,gaintable=[bptab0,gtab0],gainfield=[bpcal,bpcal],interp=['nearest','nearest'])
+graph.add('K1','gaincal',reads=[myms,bptab0,gtab0],creates=[ktab1],vis=myms,field=bpcal,caltable=ktab1,refant = str(ref_ant),gaintype = 'K',solint = 'inf',parang=False,gaintable=[bptab0,gtab0],gainfield=[bpcal,bpcal],interp=['nearest','nearest'])
 
 # ------- G1 (primary; apply K1,B0)
 
-gaincal(vis=myms,field=bpcal,uvrange=myuvrange,caltable=gtab1,gaintype='G',solint='inf',calmode='p',minsnr=5,gainfield=[bpcal,bpcal],interp = ['nearest','nearest'],gaintable=[ktab1,bptab0])
+graph.add('G1','gaincal',reads=[myms,ktab1,bptab0],creates=[gtab1],vis=myms,field=bpcal,uvrange=myuvrange,caltable=gtab1,gaintype='G',solint='inf',calmode='p',minsnr=5,gainfield=[bpcal,bpcal],interp = ['nearest','nearest'],gaintable=[ktab1,bptab0])
 
 # ------- B1 (primary; apply K1, G1)
 
-bandpass(vis=myms,field=bpcal,uvrange=myuvrange,caltable=bptab1,refant = str(ref_ant),solint='inf',combine='',solnorm=False,minblperant=4,minsnr=3.0,bandtype='B',fillgaps=gapfill,parang=False,gainfield=[bpcal,bpcal],interp = ['nearest','nearest'],gaintable=[ktab1,gtab1])
+graph.add('B1','bandpass',reads=[myms,ktab1,gtab1],creates=[bptab1],vis=myms,field=bpcal,uvrange=myuvrange,caltable=bptab1,refant = str(ref_ant),solint='inf',combine='',solnorm=False,minblperant=4,minsnr=3.0,bandtype='B',fillgaps=gapfill,parang=False,gainfield=[bpcal,bpcal],interp = ['nearest','nearest'],gaintable=[ktab1,gtab1])
 
-flagdata(vis=bptab1,mode='tfcrop',datacolumn='CPARAM')
-flagdata(vis=bptab1,mode='rflag',datacolumn='CPARAM')
+if bpclean:
+   graph.add('clean_B1',casa_bandpass.clean_bandpass,writes=[bptab1],caltable=bptab1,gapfill=gapfill)
+else:
+   graph.add('tfcrop_B1','flagdata',writes=[bptab1],vis=bptab1,mode='tfcrop',datacolumn='CPARAM')
+   graph.add('rflag_B1','flagdata',writes=[bptab1],vis=bptab1,mode='rflag',datacolumn='CPARAM')
 
 # ------- Correct primary data with K1,G1,B1
 
-applycal(vis=myms,gaintable=[ktab1,gtab1,bptab1],field=bpcal,parang=False,gainfield=[bpcal,bpcal,bpcal],interp = ['nearest','nearest','nearest'])
+graph.add('applycal_bpcal_1','applycal',reads=[ktab1,gtab1,bptab1],writes=[myms],vis=myms,gaintable=[ktab1,gtab1,bptab1],field=bpcal,parang=False,gainfield=[bpcal,bpcal,bpcal],interp = ['nearest','nearest','nearest'])
 
 # --------------------------------------------------------------- #
 # --------------------------- STAGE 2 --------------------------- #
 # --------------------------------------------------------------- #
+graph.begin_stage('stage2')
 
 # ------- G2 (primary; a&p sols per scan / SPW)
 
-gaincal(vis = myms,field = bpcal,uvrange = myuvrange,caltable = gtab2,refant = str(ref_ant),solint = 'inf',solnorm = False,combine = '',minsnr = 3,calmode = 'ap',parang = False,gaintable = [ktab1,gtab1,bptab1],gainfield = [bpcal,bpcal,bpcal],interp = ['nearest','nearest','nearest'],append = False)
+graph.add('G2_primary','gaincal',reads=[myms,ktab1,gtab1,bptab1],creates=[gtab2],vis = myms,field = bpcal,uvrange = myuvrange,caltable = gtab2,refant = str(ref_ant),solint = 'inf',solnorm = False,combine = '',minsnr = 3,calmode = 'ap',parang = False,gaintable = [ktab1,gtab1,bptab1],gainfield = [bpcal,bpcal,bpcal],interp = ['nearest','nearest','nearest'],append = False)
 
 # ------- Duplicate K1
 # ------- Duplicate G2 (to save repetition of above step)
 
-shutil.copytree(ktab1,ktab2)
-shutil.copytree(gtab2,gtab3)
+graph.add('copy_K2',casa_scheduler.clone_table,reads=[ktab1],creates=[ktab2],src=ktab1,dst=ktab2)
+graph.add('copy_G3',casa_scheduler.clone_table,reads=[gtab2],creates=[gtab3],src=gtab2,dst=gtab3)
 
 # --- G2 (secondary) 
 
-gaincal(vis = myms,field = pcal,uvrange = myuvrange,caltable = gtab2,refant = str(ref_ant),minblperant = 4,minsnr = 3,solint = 'inf',solnorm = False,gaintype = 'G',combine = '',calmode = 'ap',parang = False,gaintable=[ktab1,gtab1,bptab1],gainfield=[bpcal,bpcal,bpcal],interp=['nearest','linear','linear'],append=True)
+graph.add('G2_secondary','gaincal',reads=[myms,ktab1,gtab1,bptab1],writes=[gtab2],vis = myms,field = pcal,uvrange = myuvrange,caltable = gtab2,refant = str(ref_ant),minblperant = 4,minsnr = 3,solint = 'inf',solnorm = False,gaintype = 'G',combine = '',calmode = 'ap',parang = False,gaintable=[ktab1,gtab1,bptab1],gainfield=[bpcal,bpcal,bpcal],interp=['nearest','linear','linear'],append=True)
 
 # --- K2 (secondary)
 
-gaincal(vis = myms,field = pcal,caltable = ktab1,refant = str(ref_ant),gaintype = 'K',solint = 'inf',parang = False,gaintable = [gtab1,bptab1,gtab2],gainfield = [bpcal,bpcal,pcal],interp = ['nearest','linear','linear','linear'],append = True)
+graph.add('K2_secondary','gaincal',reads=[myms,gtab1,bptab1,gtab2],writes=[ktab1],vis = myms,field = pcal,caltable = ktab1,refant = str(ref_ant),gaintype = 'K',solint = 'inf',parang = False,gaintable = [gtab1,bptab1,gtab2],gainfield = [bpcal,bpcal,pcal],interp = ['nearest','linear','linear','linear'],append = True)
 
 # --- Correct secondary with K2, G1, B1, G2
 
-applycal(vis = myms,gaintable = [ktab2,gtab1,bptab1,gtab2],field = pcal,parang = False,gainfield = ['','',bpcal,pcal],interp = ['nearest','linear','linear','linear'])
+graph.add('applycal_pcal_2','applycal',reads=[ktab2,gtab1,bptab1,gtab2],writes=[myms],vis = myms,gaintable = [ktab2,gtab1,bptab1,gtab2],field = pcal,parang = False,gainfield = ['','',bpcal,pcal],interp = ['nearest','linear','linear','linear'])
 
 # --- Flag secondary on CORRECTED_DATA - MODEL_DATA
 
-flagdata(vis = myms,field = pcal,mode = 'rflag',datacolumn = 'residual')
-flagdata(vis = myms,field = pcal,mode = 'tfcrop',datacolumn = 'residual')
-flagmanager(vis=myms,mode='save',versionname='pcal_residual_flags')
+if onepassrfi and not usempi:
+   graph.add('rfi_pcal_residual',casa_rfi.flag_field,writes=[myms],vis=myms,field=pcal,datacolumn='residual',steps=('rflag','tfcrop'))
+else:
+   graph.add('rflag_pcal_residual','flagdata',writes=[myms],vis = myms,field = pcal,mode = 'rflag',datacolumn = 'residual')
+   graph.add('tfcrop_pcal_residual','flagdata',writes=[myms],vis = myms,field = pcal,mode = 'tfcrop',datacolumn = 'residual')
+graph.add('save_pcal_residual_flags',casa_flagversions.flagmanager,writes=[myms],vis=myms,mode='save',versionname='pcal_residual_flags')
 
 # --------------------------------------------------------------- #
 # --------------------------- STAGE 3 --------------------------- #
 # --------------------------------------------------------------- #
+graph.begin_stage('stage3')
 
-gaincal(vis=myms,field=bpcal,uvrange=myuvrange,caltable=gtab3,refant=str(ref_ant),solint='inf',solnorm=False,combine='',minsnr=3,calmode='ap',parang=False,gaintable=[ktab2,gtab1,bptab1],gainfield=[bpcal,bpcal,bpcal],interp=['nearest','nearest','nearest'],append=False)
+# G3 on the primary is G2_primary's solution, cloned to gtab3 by copy_G3
+# (ktab2 is K1 before K2_secondary appended to it)
 
 # ------- Duplicate K1 table
 
-shutil.copytree(ktab1,ktab3)
+graph.add('copy_K3',casa_scheduler.clone_table,reads=[ktab1],creates=[ktab3],src=ktab1,dst=ktab3)
 
 # --- G3 (secondary)
 
-gaincal(vis=myms,field=pcal,uvrange=myuvrange,caltable=gtab3,refant=str(ref_ant),minblperant=4,minsnr=3,solint='inf',solnorm=False,gaintype='G',combine='',calmode='ap',parang=False,gaintable=[ktab2,gtab1,bptab1],gainfield=[bpcal,bpcal,bpcal],interp=['nearest','linear','linear'],append=True)
+graph.add('G3_secondary','gaincal',reads=[myms,ktab2,gtab1,bptab1],writes=[gtab3],vis=myms,field=pcal,uvrange=myuvrange,caltable=gtab3,refant=str(ref_ant),minblperant=4,minsnr=3,solint='inf',solnorm=False,gaintype='G',combine='',calmode='ap',parang=False,gaintable=[ktab2,gtab1,bptab1],gainfield=[bpcal,bpcal,bpcal],interp=['nearest','linear','linear'],append=True)
 
 # --- K3 secondary
 
-gaincal(vis=myms,field=pcal,caltable=ktab3,refant=str(ref_ant),gaintype='K',solint='inf',parang=False,gaintable=[gtab1,bptab1,gtab3],gainfield=[bpcal,bpcal,bpcal,pcal],interp=['linear','linear','linear'],append=True)
+graph.add('K3_secondary','gaincal',reads=[myms,gtab1,bptab1,gtab3],writes=[ktab3],vis=myms,field=pcal,caltable=ktab3,refant=str(ref_ant),gaintype='K',solint='inf',parang=False,gaintable=[gtab1,bptab1,gtab3],gainfield=[bpcal,bpcal,bpcal,pcal],interp=['linear','linear','linear'],append=True)
 
 # --- Correct secondaries with K3, G1, B1, G3
 
-applycal(vis=myms,gaintable=[ktab3,gtab1,bptab1,gtab3],field=pcal,parang=False,gainfield=['','',bpcal,pcal],interp=['nearest','linear','linear','linear'])
+graph.add('applycal_pcal_3','applycal',reads=[ktab3,gtab1,bptab1,gtab3],writes=[myms],vis=myms,gaintable=[ktab3,gtab1,bptab1,gtab3],field=pcal,parang=False,gainfield=['','',bpcal,pcal],interp=['nearest','linear','linear','linear'])
+
+graph.begin_stage('target')
 
 # ------- Apply final tables to targets
 # --- Correct targets with K3, G1, B1, G3
 
-applycal(vis=myms,gaintable=[ktab3,gtab1,bptab1,gtab3],field=target,parang=False,gainfield=['',bpcal,bpcal,pcal],interp=['nearest','linear','linear','linear'])
-flagmanager(vis=myms,mode='save',versionname='refcal-full')
+graph.add('applycal_target','applycal',reads=[ktab3,gtab1,bptab1,gtab3],writes=[myms],vis=myms,gaintable=[ktab3,gtab1,bptab1,gtab3],field=target,parang=False,gainfield=['',bpcal,bpcal,pcal],interp=['nearest','linear','linear','linear'])
+graph.add('save_refcal_full',casa_flagversions.flagmanager,writes=[myms],vis=myms,mode='save',versionname='refcal-full')
 
 # ------------------------------------------------------------------------
 
 # Cut out the target and imaging step
 
 # ------------------------------------------------------------------------
+# The split also averages the target with avg_pars (see above)
 
-mstransform(vis=myms,outputvis=target_ms,field=target,usewtspectrum=True,realmodelcol=True,datacolumn='corrected')
+graph.add('split_target','mstransform',reads=[myms],creates=[target_ms],vis=myms,outputvis=target_ms,field=target,usewtspectrum=True,realmodelcol=True,datacolumn='corrected',**dict(avg_pars,**(casa_mpi.mms_pars(mmsaxis) if usempi else {})))
 
 # --- RFI flagging on the calibrated target data
 
-flagdata(vis=target_ms,mode='rflag',datacolumn='data',field=target)
-flagdata(vis=target_ms,mode='tfcrop',datacolumn='data',field=target)
-flagdata(vis=target_ms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True,flagneartime=True,flagnearfreq=True,field=target)
+if onepassrfi and not usempi:
+   graph.add('rfi_target',casa_rfi.flag_field,writes=[target_ms],vis=target_ms,field=target,datacolumn='data')
+else:
+   graph.add('rflag_target','flagdata',writes=[target_ms],vis=target_ms,mode='rflag',datacolumn='data',field=target)
+   graph.add('tfcrop_target','flagdata',writes=[target_ms],vis=target_ms,mode='tfcrop',datacolumn='data',field=target)
+   graph.add('extend_target','flagdata',writes=[target_ms],vis=target_ms,mode='extend',growtime=90.0,growfreq=90.0,growaround=True,flagneartime=True,flagnearfreq=True,field=target)
+
+graph.run(nproc = nproc,cache = None if stages.active or increment else stagecache,stages = stages,skip = casa_incremental.restrict(graph,incremental_steps,newscans) if increment else ())
 
 # --- First form the full integration image
 
 full_integ_imagename = target + '_full'
-tclean(vis=target_ms,selectdata=True,field="",spw="",timerange="",uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imagename=full_integ_imagename,imsize=[5000, 5000],cell=['3.0arcsec'],phasecenter="",stokes="I",projection="SIN",startmodel="",specmode="mfs",reffreq="",nchan=-1,start="",width="",outframe="LSRK",veltype="radio",restfreq=[],interpolation="linear",perchanweightdensity=True,gridder="widefield",facets=1,psfphasecenter="",chanchunks=1,wprojplanes=-1,vptable="",mosweight=True,aterm=True,psterm=False,wbawp=False,conjbeams=False,cfcache="",usepointing=False,computepastep=360.0,rotatepastep=360.0,pointingoffsetsigdev=[],pblimit=-1,normtype="flatnoise",deconvolver="mtmfs",scales=[0, 5, 15],nterms=2,smallscalebias=0.6,restoration=True,restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0,noise="1.0Jy",npixels=0,uvtaper=[],niter=25000,gain=0.1,threshold="0.05mJy",nsigma=0.0,cycleniter=-1,cyclefactor=0.5,minpsffraction=0.05,maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,sidelobethreshold=2.5,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,verbose=False,fastnoise=True,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-image_to_export = full_integ_imagename + '.image.tt0'
-fits_image_name = full_integ_imagename + '.fits'
-exportfits(imagename=image_to_export,fitsimage=fits_image_name)
+full_spec = casa_imaging.ImageSpec(full_integ_imagename,target_ms,improfile,**plan_pars)
+cleanmask = full_integ_imagename + '.cleanmask' if fixedmask else ''
+if stages.begin('image'):
+   if increment:
+      # Image the new scans only and add them to the full integration image
+      chunk_spec = full_spec.derive(full_integ_imagename + chunktag,scan = chunkscans)
+      chunk_spec.export = False
+      casa_imaging.make_images(chunk_spec)
+      casa_incremental.accumulate(ledger,full_spec,chunk_spec)
+   else:
+      casa_imaging.make_images(full_spec)
+      if incremental:
+         casa_incremental.accumulate(ledger,full_spec,None)
+   # Only scans that have been added to the full integration image count as processed
+   for vis in newscans:
+      ledger.mark(vis,newscans[vis])
+
+# --- With fixedmask the clean mask of the later images is made once from the full integration image
+# --- (casa_masks: pixels above maskthreshold x MAD sigma, grown by maskgrow pixels) instead of auto-multithresh
+
+   if fixedmask:
+      casa_masks.make_mask(full_spec,cleanmask,threshold = maskthreshold,radius = maskgrow)
+      if maskbenchmark:
+         casa_masks.compare(full_spec.derive(target + '_maskbench',timerange = time_on,spw = slice_spw),cleanmask,executor = casa_imaging.default_executor())
+stages.complete('image')
 
 # --- Form the time slice images. There's 3 of them: 1 before, 1 at and 1 after the FRB time slice
-
-if dotimeslices:
-   before_imagename = target + '_before'
-   tclean(vis=target_ms,selectdata=True,field="",spw=imspw,timerange=time_before,uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imagename=before_imagename,imsize=[5000, 5000],cell=['3.0arcsec'],phasecenter="",stokes="I",projection="SIN",startmodel="",specmode="mfs",reffreq="",nchan=-1,start="",width="",outframe="LSRK",veltype="radio",restfreq=[],interpolation="linear",perchanweightdensity=True,gridder="widefield",facets=1,psfphasecenter="",chanchunks=1,wprojplanes=-1,vptable="",mosweight=True,aterm=True,psterm=False,wbawp=False,conjbeams=False,cfcache="",usepointing=False,computepastep=360.0,rotatepastep=360.0,pointingoffsetsigdev=[],pblimit=-1,normtype="flatnoise",deconvolver="mtmfs",scales=[0, 5, 15],nterms=2,smallscalebias=0.6,restoration=True,restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0,noise="1.0Jy",npixels=0,uvtaper=[],niter=25000,gain=0.1,threshold="0.05mJy",nsigma=0.0,cycleniter=-1,cyclefactor=0.5,minpsffraction=0.05,maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,sidelobethreshold=2.5,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,verbose=False,fastnoise=True,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-   image_to_export = before_imagename + '.image.tt0'
-   fits_image_name = before_imagename + '.fits'
-   exportfits(imagename=image_to_export,fitsimage=fits_image_name)
-
-   on_imagename = target + '_on'
-   tclean(vis=target_ms,selectdata=True,field="",spw=imspw,timerange=time_on,uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imagename=on_imagename,imsize=[5000, 5000],cell=['3.0arcsec'],phasecenter="",stokes="I",projection="SIN",startmodel="",specmode="mfs",reffreq="",nchan=-1,start="",width="",outframe="LSRK",veltype="radio",restfreq=[],interpolation="linear",perchanweightdensity=True,gridder="widefield",facets=1,psfphasecenter="",chanchunks=1,wprojplanes=-1,vptable="",mosweight=True,aterm=True,psterm=False,wbawp=False,conjbeams=False,cfcache="",usepointing=False,computepastep=360.0,rotatepastep=360.0,pointingoffsetsigdev=[],pblimit=-1,normtype="flatnoise",deconvolver="mtmfs",scales=[0, 5, 15],nterms=2,smallscalebias=0.6,restoration=True,restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0,noise="1.0Jy",npixels=0,uvtaper=[],niter=25000,gain=0.1,threshold="0.05mJy",nsigma=0.0,cycleniter=-1,cyclefactor=0.5,minpsffraction=0.05,maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,sidelobethreshold=2.5,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,verbose=False,fastnoise=True,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-   image_to_export = on_imagename + '.image.tt0'
-   fits_image_name = on_imagename + '.fits'
-   exportfits(imagename=image_to_export,fitsimage=fits_image_name)
-
-   after_imagename = target + '_after'
-   tclean(vis=target_ms,selectdata=True,field="",spw=imspw,timerange=time_after,uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imagename=after_imagename,imsize=[5000, 5000],cell=['3.0arcsec'],phasecenter="",stokes="I",projection="SIN",startmodel="",specmode="mfs",reffreq="",nchan=-1,start="",width="",outframe="LSRK",veltype="radio",restfreq=[],interpolation="linear",perchanweightdensity=True,gridder="widefield",facets=1,psfphasecenter="",chanchunks=1,wprojplanes=-1,vptable="",mosweight=True,aterm=True,psterm=False,wbawp=False,conjbeams=False,cfcache="",usepointing=False,computepastep=360.0,rotatepastep=360.0,pointingoffsetsigdev=[],pblimit=-1,normtype="flatnoise",deconvolver="mtmfs",scales=[0, 5, 15],nterms=2,smallscalebias=0.6,restoration=True,restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0,noise="1.0Jy",npixels=0,uvtaper=[],niter=25000,gain=0.1,threshold="0.05mJy",nsigma=0.0,cycleniter=-1,cyclefactor=0.5,minpsffraction=0.05,maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,sidelobethreshold=2.5,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,verbose=False,fastnoise=True,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-   image_to_export = after_imagename + '.image.tt0'
-   fits_image_name = after_imagename + '.fits'
-   exportfits(imagename=image_to_export,fitsimage=fits_image_name)
+# --- They are imaged in parallel and share a PSF when their uv coverage is similar
+# --- With dolocalise they are also (or only) imaged as a small field around the candidate
+
+if dotimeslices and stages.begin('timeslices'):
+   slice_spec = casa_imaging.ImageSpec(target,target_ms,improfile,spw = slice_spw,**slice_plan_pars)
+   slicesets = []
+   if dolocalise:
+      slicesets.append(('_loc',slice_spec.derive(target,**casa_timeslices.localisation_pars(frb_ra,frb_dec,locradius,loccell))))
+   if dofullslices:
+      slicesets.append(('',slice_spec))
+
+   for suffix, spec in slicesets:
+      spec = casa_masks.with_mask(spec,cleanmask,full_spec)
+      before_imagename = target + '_before' + suffix
+      on_imagename = target + '_on' + suffix
+      after_imagename = target + '_after' + suffix
+      casa_timeslices.run_timeslices([(before_imagename,time_before),(on_imagename,time_on),(after_imagename,time_after)],spec,executor = casa_imaging.default_executor(slicenproc),sharepsf = sharepsf,psfmatch = psfmatch)
 
 # --- Now make the difference images
+# --- The slice FITS files are memory-mapped and differenced in tiles, with per-tile RMS and peak S/N
+
+      before_imagename = before_imagename + '.fits'
+      on_imagename = on_imagename + '.fits'
+      after_imagename = after_imagename + '.fits'
+      casa_imagediff.difference_fits(on_imagename,[before_imagename,after_imagename],['on-before'+suffix+'.fits','on-after'+suffix+'.fits'],tile = difftile)
+
+# --- Search the difference images for transient candidates
 
-   before_imagename = before_imagename + '.fits'
-   on_imagename = on_imagename + '.fits'
-   after_imagename = after_imagename + '.fits'
-   immath(imagename=[on_imagename,before_imagename],mode="evalexpr",outfile="on-before",expr="(IM0-IM1)",varnames="",sigma="0.0mJy/beam",polithresh="",mask="",region="",box="",chans="",stokes="",stretch=False,imagemd="")
-   exportfits(imagename='on-before',fitsimage='on-before.fits')
-   immath(imagename=[on_imagename,after_imagename],mode="evalexpr",outfile="on-after",expr="(IM0-IM1)",varnames="",sigma="0.0mJy/beam",polithresh="",mask="",region="",box="",chans="",stokes="",stretch=False,imagemd="")
-   exportfits(imagename='on-after',fitsimage='on-after.fits')
+      if dodetect:
+         casa_transients.find_transients('on-before'+suffix+'.fits','on-after'+suffix+'.fits','candidates'+suffix+'.csv',threshold = detthreshold,box = noisebox,tile = difftile,matchradius = matchradius)
 
-# --- Now do a phase only self-cal
+stages.complete('timeslices')
 
-if doselfcal:
-   gtab = target_ms + '.GP0'
-   gaincal(vis=target_ms,field='0',uvrange=myuvrange,caltable=gtab,refant = str(ref_ant),solint='64s',solnorm=False,combine='',minsnr=3,calmode='p',parang=False,gaintable=[],gainfield=[],interp=[],append=False)
+# --- Fast time-domain mode: snapshots of snapinterval of the residual visibilities
+# --- (corrected data minus the MODEL_DATA of the full image), all made in one pass over the MS
 
-   applycal(vis=target_ms,gaintable=[gtab],field='0',calwt=False,parang=False,applymode='calonly',gainfield='0',interp = ['nearest'])
+if dosnapshots and stages.begin('snapshots'):
+   casa_snapshots.snapshot_cube(target_ms,target + '_snapshots',field = target,interval = snapinterval,npix = snapsize,cell = snapcell or loccell,ra = frb_ra,dec = frb_dec,timerange = snaptimerange,threshold = detthreshold)
+stages.complete('snapshots')
 
-# --- Now make the image again
+# --- Now self-cal in rounds of selfcal_schedule (casa_selfcal), each one solving against the model of
+# --- the previous image and reimaging with its PSF and model, until the image stops improving
 
-   full_integ_selfcal = target + 'selfcal0_full'
-   tclean(vis=target_ms,selectdata=True,field="",spw="",timerange="",uvrange="",antenna="",scan="",observation="",intent="",datacolumn="corrected",imagename=full_integ_selfcal,imsize=[5000, 5000],cell=['3.0arcsec'],phasecenter="",stokes="I",projection="SIN",startmodel="",specmode="mfs",reffreq="",nchan=-1,start="",width="",outframe="LSRK",veltype="radio",restfreq=[],interpolation="linear",perchanweightdensity=True,gridder="widefield",facets=1,psfphasecenter="",chanchunks=1,wprojplanes=-1,vptable="",mosweight=True,aterm=True,psterm=False,wbawp=False,conjbeams=False,cfcache="",usepointing=False,computepastep=360.0,rotatepastep=360.0,pointingoffsetsigdev=[],pblimit=-1,normtype="flatnoise",deconvolver="mtmfs",scales=[0, 5, 15],nterms=2,smallscalebias=0.6,restoration=True,restoringbeam=[],pbcor=False,outlierfile="",weighting="briggs",robust=0,noise="1.0Jy",npixels=0,uvtaper=[],niter=25000,gain=0.1,threshold="0.05mJy",nsigma=0.0,cycleniter=-1,cyclefactor=0.5,minpsffraction=0.05,maxpsffraction=0.8,interactive=False,usemask="auto-multithresh",mask="",pbmask=0.0,sidelobethreshold=2.5,noisethreshold=5.0,lownoisethreshold=1.5,negativethreshold=0.0,smoothfactor=1.0,minbeamfrac=0.3,cutthreshold=0.01,growiterations=75,dogrowprune=True,minpercentchange=-1.0,verbose=False,fastnoise=True,restart=True,savemodel="modelcolumn",calcres=True,calcpsf=True,parallel=False)
-   image_to_export = full_integ_selfcal + '.image.tt0'
-   fits_image_name = full_integ_selfcal + '.fits'
-   exportfits(imagename=image_to_export,fitsimage=fits_image_name)
+if doselfcal and not increment and stages.begin('selfcal'):
+   casa_selfcal.run_selfcal(casa_masks.with_mask(full_spec,cleanmask,full_spec),schedule = selfcal_schedule,refant = str(ref_ant),uvrange = myuvrange,field = '0',minimprove = selfcal_minimprove,executor = casa_imaging.default_executor())
+stages.complete('selfcal')
@@ -0,0 +1,327 @@
+# One-pass RFI flagging of a field
+# The pipelines flag each field with flagdata rflag, then tfcrop, then
+# extend: three reads of the data column (and of FLAG) and three writes of
+# FLAG. flag_field() does the same kind of flagging in one pass. The rows of
+# the field are read sorted by scan, baseline and time, in chunks of whole
+# baselines of a scan, so each chunk holds complete time-frequency planes;
+# the planes of the baselines of a scan with the same number of dumps are
+# stacked and flagged together with NumPy:
+#   - rflag-style: the RMS in a sliding window of winsize dumps, per
+#     channel, above timedevscale times its median over the scan, and the
+#     deviation from the sliding mean over winsize channels, per dump, above
+#     freqdevscale times its median over the band,
+#   - tfcrop-style: the amplitude minus a bandpass (median over time) times
+#     time shape (median over frequency) model, above timecutoff times its
+#     MAD sigma along time or freqcutoff times its MAD sigma along frequency,
+#   - extend: flags copied to all correlations, channels flagged for more
+#     than growtime percent of the scan and dumps flagged over more than
+#     growfreq percent of the band flagged entirely, points with more than
+#     four flagged neighbours flagged (growaround) and the neighbours in time
+#     and frequency of flagged points flagged (flagneartime, flagnearfreq).
+# FLAG is written back once per chunk. The statistics follow the flagdata
+# defaults but are simpler than flagdata's (medians instead of fitted
+# polynomials, one iteration), so the flags are close to but not the same
+# as those of the flagdata sequence; validate() compares the two on an MS.
+
+import json
+import warnings
+
+import numpy as np
+
+import casa_flagging
+
+STEPS = ('rflag', 'tfcrop', 'extend')
+# flagdata defaults of the pipeline calls
+DEFAULTS = dict(winsize = 3, timedevscale = 5.0, freqdevscale = 5.0, timecutoff = 4.0, freqcutoff = 3.0,
+    growtime = 90.0, growfreq = 90.0, growaround = True, flagneartime = True, flagnearfreq = True)
+# flagdata datacolumn: columns read (the second is subtracted)
+DATACOLUMNS = {'data': ('DATA',), 'corrected': ('CORRECTED_DATA',),
+    'residual': ('CORRECTED_DATA', 'MODEL_DATA'), 'residual_data': ('DATA', 'MODEL_DATA')}
+
+# ------------------------------------------------------------------------
+# Statistics of time-frequency planes: arrays of (..., nchan, ntime)
+
+def window_sum(x, half, axis):
+    # Sum over a window of 2 half + 1 samples along axis, truncated at the
+    # edges
+    x = np.moveaxis(x, axis, -1)
+    n = x.shape[-1]
+    cumsum = np.concatenate([np.zeros(x.shape[:-1] + (1,), dtype = x.dtype), np.cumsum(x, axis = -1)], axis = -1)
+    i = np.arange(n)
+    total = cumsum[..., np.minimum(i + half + 1, n)] - cumsum[..., np.maximum(i - half, 0)]
+    return np.moveaxis(total, -1, axis)
+
+
+def mad_sigma(x, axis):
+    # MAD sigma of x along axis, ignoring NaN
+    median = np.nanmedian(x, axis = axis)
+    return 1.4826 * np.nanmedian(np.abs(x - np.expand_dims(median, axis)), axis = axis)
+
+
+def rflag_plane(vis, flags, winsize = 3, timedevscale = 5.0, freqdevscale = 5.0):
+    valid = ~flags
+    data = np.where(valid, vis, 0)
+    half = winsize // 2
+    # Sliding RMS along time
+    count = window_sum(valid.astype(np.float64), half, -1)
+    mean = window_sum(data, half, -1) / np.maximum(count, 1)
+    power = window_sum(np.abs(data) ** 2, half, -1) / np.maximum(count, 1)
+    rms = np.where(valid & (count > 1), np.sqrt(np.maximum(power - np.abs(mean) ** 2, 0.0)), np.nan)
+    new = rms > timedevscale * np.nanmedian(rms, axis = -1)[..., None]
+    # Deviation from the sliding mean along frequency
+    count = window_sum(valid.astype(np.float64), half, -2)
+    mean = window_sum(data, half, -2) / np.maximum(count, 1)
+    deviation = np.where(valid & (count > 1), np.abs(vis - mean), np.nan)
+    new |= deviation > freqdevscale * np.nanmedian(deviation, axis = -2)[..., None, :]
+    return new
+
+
+def tfcrop_plane(vis, flags, timecutoff = 4.0, freqcutoff = 3.0):
+    amp = np.where(flags, np.nan, np.abs(vis))
+    bandpass = np.nanmedian(amp, axis = -1)
+    shape = np.nanmedian(amp / bandpass[..., None], axis = -2)
+    residual = amp - bandpass[..., None] * shape[..., None, :]
+    new = np.abs(residual) > timecutoff * mad_sigma(residual, -1)[..., None]
+    new |= np.abs(residual) > freqcutoff * mad_sigma(residual, -2)[..., None, :]
+    return new
+
+
+def _neighbours(flags):
+    # Number of flagged points among the 8 neighbours in the last two axes
+    padded = np.pad(flags, [(0, 0)] * (flags.ndim - 2) + [(1, 1), (1, 1)]).astype(np.int8)
+    nchan, ntime = flags.shape[-2:]
+    count = np.zeros(flags.shape, dtype = np.int8)
+    for dc in (-1, 0, 1):
+        for dt in (-1, 0, 1):
+            if dc or dt:
+                count += padded[..., 1 + dc:1 + dc + nchan, 1 + dt:1 + dt + ntime]
+    return count
+
+
+def extend_plane(flags, growtime = 90.0, growfreq = 90.0, growaround = True, flagneartime = True, flagnearfreq = True):
+    # flags of (ncorr, ..., nchan, ntime), extended over the correlations
+    flags = flags.any(axis = 0)
+    if growtime > 0:
+        flags |= (flags.mean(axis = -1) > growtime / 100.0)[..., None]
+    if growfreq > 0:
+        flags |= (flags.mean(axis = -2) > growfreq / 100.0)[..., None, :]
+    if growaround:
+        flags |= _neighbours(flags) > 4
+    grown = flags.copy()
+    if flagneartime:
+        grown[..., 1:] |= flags[..., :-1]
+        grown[..., :-1] |= flags[..., 1:]
+    if flagnearfreq:
+        grown[..., 1:, :] |= flags[..., :-1, :]
+        grown[..., :-1, :] |= flags[..., 1:, :]
+    return grown
+
+
+def flag_planes(vis, flags, steps = STEPS, **pars):
+    # New flags of the planes vis (ncorr, ..., nchan, ntime)
+    pars = dict(DEFAULTS, **pars)
+    with warnings.catch_warnings():
+        # fully flagged channels and dumps give NaN statistics
+        warnings.simplefilter('ignore', RuntimeWarning)
+        new = flags.copy()
+        if 'rflag' in steps:
+            new |= rflag_plane(vis, flags, pars['winsize'], pars['timedevscale'], pars['freqdevscale'])
+        if 'tfcrop' in steps:
+            new |= tfcrop_plane(vis, flags, pars['timecutoff'], pars['freqcutoff'])
+    if 'extend' in steps:
+        new = np.broadcast_to(extend_plane(new, pars['growtime'], pars['growfreq'], pars['growaround'],
+            pars['flagneartime'], pars['flagnearfreq']), new.shape)
+    return new
+
+# ------------------------------------------------------------------------
+# Passes over the MS
+
+def field_ids(vis, field):
+    # Field ids of a comma-separated list of field names or ids
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/FIELD')
+    names = list(tb.getcol('NAME'))
+    tb.close()
+    if not field:
+        return list(range(len(names)))
+    ids = []
+    for name in field.split(','):
+        if name in names:
+            ids.append(names.index(name))
+        elif name.isdigit():
+            ids.append(int(name))
+        else:
+            raise ValueError('%s has no field %s' % (vis, name))
+    return ids
+
+
+def _groups(scans, ant1, ant2):
+    # (first, last + 1) rows of each scan and baseline
+    change = np.nonzero((np.diff(scans) != 0) | (np.diff(ant1) != 0) | (np.diff(ant2) != 0))[0] + 1
+    edges = np.concatenate([[0], change, [len(scans)]])
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _chunks(groups, chunk):
+    # Runs of groups of about chunk rows
+    runs, current = [], []
+    for group in groups:
+        if current and group[1] - current[0][0] > chunk:
+            runs.append(current)
+            current = []
+        current.append(group)
+    if current:
+        runs.append(current)
+    return runs
+
+
+def _stacks(groups, scans):
+    # Consecutive groups of the same scan and length, flagged together
+    stacks = []
+    for group in groups:
+        last = stacks[-1][-1] if stacks else None
+        if last and scans[last[0]] == scans[group[0]] and last[1] - last[0] == group[1] - group[0]:
+            stacks[-1].append(group)
+        else:
+            stacks.append([group])
+    return stacks
+
+
+def flag_field(vis, field = '', datacolumn = 'data', steps = STEPS, scan = '', chunkvis = 2 ** 22, **pars):
+    # Flag field of vis with the steps ('rflag', 'tfcrop', 'extend') in one
+    # read of datacolumn and FLAG and one write of FLAG per chunk of about
+    # chunkvis visibilities. pars override DEFAULTS. Returns the number of
+    # visibilities newly flagged.
+    from casatools import table
+    if datacolumn not in DATACOLUMNS:
+        raise ValueError('Unknown datacolumn %s (known: %s)' % (datacolumn, ', '.join(sorted(DATACOLUMNS))))
+    unknown = set(pars) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown flagging parameters: ' + ', '.join(sorted(unknown)))
+    columns = DATACOLUMNS[datacolumn]
+    tb = table()
+    tb.open(vis + '/DATA_DESCRIPTION')
+    nddid = tb.nrows()
+    tb.close()
+    query = 'FIELD_ID IN [%s]' % ','.join([str(i) for i in field_ids(vis, field)])
+    if scan:
+        query += ' && SCAN_NUMBER IN [%s]' % ','.join([str(n) for n in casa_flagging.scan_numbers(scan)])
+
+    flagged = 0
+    tb.open(vis, nomodify = False)
+    for ddid in range(nddid):
+        rows = tb.query('%s && DATA_DESC_ID==%d' % (query, ddid), sortlist = 'SCAN_NUMBER,ANTENNA1,ANTENNA2,TIME')
+        if rows.nrows() == 0:
+            rows.close()
+            continue
+        scans = rows.getcol('SCAN_NUMBER')
+        ant1 = rows.getcol('ANTENNA1')
+        ant2 = rows.getcol('ANTENNA2')
+        ncorr, nchan = rows.getcell('FLAG', 0).shape
+        for run in _chunks(_groups(scans, ant1, ant2), max(chunkvis // (ncorr * nchan), 1)):
+            first, n = run[0][0], run[-1][1] - run[0][0]
+            data = rows.getcol(columns[0], first, n)
+            if len(columns) > 1:
+                data = data - rows.getcol(columns[1], first, n)
+            flags = rows.getcol('FLAG', first, n)
+            new = flags.copy()
+            for stack in _stacks(run, scans):
+                a, b = stack[0][0] - first, stack[-1][1] - first
+                shape = (ncorr, nchan, len(stack), (b - a) // len(stack))
+                # (ncorr, nchan, nbaseline, ntime) to (ncorr, nbaseline, nchan, ntime)
+                planes = np.swapaxes(data[..., a:b].reshape(shape), 1, 2)
+                planeflags = np.swapaxes(flags[..., a:b].reshape(shape), 1, 2)
+                result = flag_planes(planes, planeflags, steps, **pars)
+                new[..., a:b] = np.swapaxes(result, 1, 2).reshape((ncorr, nchan, b - a))
+            flagged += int((new & ~flags).sum())
+            rows.putcol('FLAG', new, first, n)
+            rows.putcol('FLAG_ROW', rows.getcol('FLAG_ROW', first, n) | new.all(axis = (0, 1)), first, n)
+        rows.close()
+    tb.flush()
+    tb.close()
+    print('%s field %s: %d visibilities flagged by %s on %s in one pass' % (vis, field or '*', flagged, '+'.join(steps), datacolumn))
+    return flagged
+
+# ------------------------------------------------------------------------
+# Validation against the flagdata sequence
+
+def flagdata_sequence(vis, field = '', datacolumn = 'data', steps = STEPS, scan = ''):
+    # The pipelines' flagdata calls for the same steps
+    from casatasks import flagdata
+    for step in steps:
+        if step == 'extend':
+            flagdata(vis = vis,mode = 'extend',growtime = 90.0,growfreq = 90.0,growaround = True,flagneartime = True,flagnearfreq = True,field = field,scan = scan,flagbackup = False)
+        else:
+            flagdata(vis = vis,mode = step,datacolumn = datacolumn,field = field,scan = scan,flagbackup = False)
+
+
+def read_flags(vis, field = ''):
+    # FLAG of the rows of field, in scan, baseline and time order
+    from casatools import table
+    tb = table()
+    tb.open(vis)
+    rows = tb.query('FIELD_ID IN [%s]' % ','.join([str(i) for i in field_ids(vis, field)]), sortlist = 'DATA_DESC_ID,SCAN_NUMBER,ANTENNA1,ANTENNA2,TIME')
+    flags = rows.getcol('FLAG')
+    rows.close()
+    tb.close()
+    return flags
+
+
+def validate(vis, field = '', datacolumn = 'data', steps = STEPS, outfile = 'rfi_validation.json'):
+    # Flag field of vis with the flagdata sequence and with flag_field(),
+    # starting from the same flags each time, and write the wall times,
+    # bytes read and flag agreement to outfile. The flags are put back as
+    # they were.
+    from casatasks import flagmanager
+    version = 'casa_rfi_validate'
+    flagmanager(vis = vis,mode = 'save',versionname = version)
+    before = read_flags(vis, field)
+    results = {'vis': vis, 'field': field, 'datacolumn': datacolumn, 'steps': list(steps)}
+    flags = {}
+    for name, func in [('flagdata', flagdata_sequence), ('onepass', flag_field)]:
+        _, wall, io = casa_flagging.measure(func, vis, field = field, datacolumn = datacolumn, steps = steps)
+        flags[name] = read_flags(vis, field)
+        results[name] = {'wall': wall, 'read_bytes': io['rchar'], 'flagged': float(flags[name].mean()),
+            'new': float((flags[name] & ~before).mean())}
+        flagmanager(vis = vis,mode = 'restore',versionname = version)
+    flagmanager(vis = vis,mode = 'delete',versionname = version)
+    new_a, new_b = flags['flagdata'] & ~before, flags['onepass'] & ~before
+    results['agreement'] = float((flags['flagdata'] == flags['onepass']).mean())
+    # Of the points flagged by either method (and not flagged before)
+    either = max(int((new_a | new_b).sum()), 1)
+    results['both'] = float((new_a & new_b).sum()) / either
+    results['flagdata_only'] = float((new_a & ~new_b).sum()) / either
+    results['onepass_only'] = float((new_b & ~new_a).sum()) / either
+    results['speedup'] = results['flagdata']['wall'] / max(results['onepass']['wall'], 1e-9)
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent = 1, sort_keys = True)
+    print('%s: flagdata %.1f s, %.3g GB read, %.2f%% flagged; one pass %.1f s, %.3g GB read, %.2f%% flagged' % (vis,
+        results['flagdata']['wall'], results['flagdata']['read_bytes'] / 1e9, 100 * results['flagdata']['flagged'],
+        results['onepass']['wall'], results['onepass']['read_bytes'] / 1e9, 100 * results['onepass']['flagged']))
+    print('   agreement %.2f%%; of the new flags %.1f%% by both, %.1f%% only by flagdata, %.1f%% only by the one pass' % (
+        100 * results['agreement'], 100 * results['both'], 100 * results['flagdata_only'], 100 * results['onepass_only']))
+    return results
+
+
+if __name__ == '__main__':
+    # casa --nogui -c casa_rfi.py [--vis sim.ms --field TARGET]: validate()
+    # on vis; a synthetic observation with RFI (casa_simulate) is made
+    # first if it does not exist
+    import argparse
+    import os
+    import sys
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vis', default = 'rfitest.ms')
+    parser.add_argument('--field', default = '')
+    parser.add_argument('--datacolumn', default = 'data', choices = sorted(DATACOLUMNS))
+    parser.add_argument('--nant', type = int, default = 16)
+    parser.add_argument('--nchan', type = int, default = 256)
+    args, unknown = parser.parse_known_args(sys.argv[1:])
+    field = args.field
+    if not os.path.exists(args.vis):
+        import casa_simulate
+        info = casa_simulate.simulate_observation(args.vis, nant = args.nant, nchan = args.nchan)
+        print('Added RFI: %s' % casa_simulate.add_rfi(args.vis))
+        field = field or info['target']
+    validate(args.vis, field = field, datacolumn = args.datacolumn)
@@ -0,0 +1,234 @@
+# Task scheduler for the MeerKAT imaging pipelines
+# Each pipeline step (a CASA task or a helper function) is described by the
+# files it reads, modifies in place (writes) and makes from scratch (creates):
+# measurement sets, calibration tables, images.
+# Dependencies follow from those lists in the order the steps are added:
+#  - a step waits for the last step that wrote any file it reads or writes
+#  - a step that writes a file also waits for the steps reading it before
+# so steps on one MS keep their script order, while steps on different MS
+# files (or only sharing read-only tables) run at the same time on separate
+# worker processes.
+# Steps can be grouped into named stages (begin_stage). At the end of a
+# stage the flags of every MS it wrote are saved as a checkpoint flag
+# version, so that a later run can restart there (casa_stages).
+
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import casa_flagversions
+import casa_trace
+
+# ioctl request of a Linux copy-on-write file clone
+FICLONE = 0x40049409
+
+# ------------------------------------------------------------------------
+
+def _resolve(func):
+    # CASA tasks are given by name so that they are looked up in the worker
+    if isinstance(func, str):
+        import casatasks
+        return getattr(casatasks, func)
+    return func
+
+
+def _execute(func, kwargs, creates = (), name = '', outputs = None, stage = None):
+    # Outputs made from scratch are removed first, so that reruns do not
+    # trip over tables left behind by an earlier run. The call is traced
+    # (casa_trace) under the step name and stage.
+    t0 = time.time()
+    for path in creates:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    task = func if isinstance(func, str) else func.__name__
+    casa_trace.call(task, _resolve(func), kwargs, label = name, paths = outputs, stage = stage)
+    return time.time() - t0
+
+
+def clone_file(src, dst):
+    # Copy the file src to dst, as a copy-on-write clone (reflink) where the
+    # file system supports it (Linux btrfs, XFS), so the copy takes no time
+    # or space until one of the two is modified; elsewhere the data are
+    # copied.
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            shutil.copyfileobj(fsrc, fdst, 2 ** 24)
+    shutil.copystat(src, dst)
+
+
+def clone_table(src, dst):
+    # Copy the table (or any directory) src to dst, each file with
+    # clone_file
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target)
+        for name in files:
+            clone_file(os.path.join(root, name), os.path.join(target, name))
+    shutil.copystat(src, dst)
+
+
+def _key(path):
+    return os.path.normpath(path)
+
+
+def is_ms(path):
+    return os.path.splitext(path)[1] in ['.ms', '.mms']
+
+
+def checkpoint_version(stage):
+    # Flag version saved at the end of stage
+    return 'checkpoint_' + stage
+
+
+class Task(object):
+
+    def __init__(self, name, func, kwargs, reads = (), writes = (), creates = (), deps = (), stage = None):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs
+        self.reads = [_key(path) for path in reads]
+        self.writes = [_key(path) for path in writes]
+        self.creates = [_key(path) for path in creates]
+        self.deps = set(deps)
+        self.stage = stage
+
+    @property
+    def outputs(self):
+        return self.writes + self.creates
+
+    def __repr__(self):
+        return 'Task(%s)' % self.name
+
+
+class TaskGraph(object):
+
+    def __init__(self):
+        self.tasks = []
+        self._names = set()
+        self._last_writer = {}
+        self._readers = {}
+        self.stage = None
+
+    def add(self, name, func, reads = (), writes = (), creates = (), deps = (), **kwargs):
+        # Add a step; keyword arguments other than the ones above are passed
+        # to func. Returns the Task so that callers can add explicit deps.
+        if name in self._names:
+            raise ValueError('Duplicate task name: ' + name)
+        task = Task(name, func, kwargs, reads = reads, writes = writes, creates = creates, deps = deps, stage = self.stage)
+        missing = task.deps - self._names
+        if missing:
+            raise ValueError('Task %s depends on unknown tasks: %s' % (name, ', '.join(sorted(missing))))
+        for path in task.reads + task.outputs:
+            if path in self._last_writer:
+                task.deps.add(self._last_writer[path])
+        for path in task.outputs:
+            task.deps.update(self._readers.get(path, ()))
+        task.deps.discard(name)
+        for path in task.reads:
+            self._readers.setdefault(path, set()).add(name)
+        for path in task.outputs:
+            self._last_writer[path] = name
+            self._readers[path] = set()
+        self.tasks.append(task)
+        self._names.add(name)
+        return task
+
+    def begin_stage(self, stage):
+        # Steps added from now on belong to stage (None for no stage)
+        self.end_stage()
+        self.stage = stage
+
+    def end_stage(self):
+        # Save the flags of each MS written in the current stage
+        stage = self.stage
+        if stage is None:
+            return
+        written = []
+        for task in self.tasks:
+            if task.stage == stage:
+                written.extend([path for path in task.outputs if is_ms(path) and path not in written])
+        for path in written:
+            self.add('checkpoint_%s_%s' % (stage, os.path.basename(path)),casa_flagversions.flagmanager,writes=[path],vis=path,mode='save',versionname=checkpoint_version(stage),merge='replace')
+        self.stage = None
+
+    def run(self, nproc = 1, mp_context = 'fork', cache = None, stages = None, skip = ()):
+        # Run every task once its dependencies are done. With nproc=1 the
+        # tasks run in the current process in the order they were added.
+        # Workers are forked so that they do not re-execute the pipeline
+        # script on start-up. cache is a casa_stagecache manifest path (or
+        # StageCache); tasks whose outputs are still valid are skipped.
+        # stages is a casa_stages.StageRunner: tasks of stages it does not
+        # select are skipped and it is told as each stage completes. Tasks
+        # named in skip are not run and count as done.
+        # Returns the wall time of each task that ran.
+        self.end_stage()
+        timings = {}
+        t0 = time.time()
+        skip = set(skip)
+        if stages is not None:
+            skip.update([task.name for task in self.tasks if not stages.selected(task.stage)])
+        if cache is not None:
+            import casa_stagecache
+            if not isinstance(cache, casa_stagecache.StageCache):
+                cache = casa_stagecache.StageCache(cache)
+            skip.update(cache.plan([task for task in self.tasks if task.name not in skip]))
+            for task in self.tasks:
+                if task.name in skip:
+                    print('%-32s cached' % task.name)
+            cache.prepare()
+        if stages is not None:
+            stages.start_graph(self.tasks, skip)
+
+        if nproc <= 1:
+            for task in self.tasks:
+                if task.name in skip:
+                    continue
+                timings[task.name] = _execute(task.func, task.kwargs, task.creates, task.name, task.outputs, task.stage)
+                if cache is not None:
+                    cache.record(task)
+                if stages is not None:
+                    stages.task_done(task)
+                _report(task.name, timings[task.name], t0)
+            return timings
+
+        pending = [task for task in self.tasks if task.name not in skip]
+        done = set(skip)
+        running = {}
+        context = multiprocessing.get_context(mp_context)
+        with ProcessPoolExecutor(max_workers = nproc, mp_context = context) as pool:
+            while pending or running:
+                for task in [task for task in pending if task.deps <= done]:
+                    if len(running) >= nproc:
+                        break
+                    pending.remove(task)
+                    running[pool.submit(_execute, task.func, task.kwargs, task.creates, task.name, task.outputs, task.stage)] = task
+                if not running:
+                    raise RuntimeError('Unresolvable task dependencies: ' + ', '.join([task.name for task in pending]))
+                finished, _ = wait(list(running), return_when = FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    try:
+                        timings[task.name] = future.result()
+                    except Exception:
+                        for other in running:
+                            other.cancel()
+                        print('Task %s failed' % task.name)
+                        raise
+                    done.add(task.name)
+                    if cache is not None:
+                        cache.record(task)
+                    if stages is not None:
+                        stages.task_done(task)
+                    _report(task.name, timings[task.name], t0)
+        return timings
+
+
+def _report(name, wall, t0):
+    print('%-32s %9.1f s  (elapsed %9.1f s)' % (name, wall, time.time() - t0))
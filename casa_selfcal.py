@@ -0,0 +1,148 @@
+# Self-calibration of the target in rounds
+# Each round solves gains against the MODEL_DATA of the previous image with
+# the next (solint, calmode) of a schedule, applies them together with the
+# tables of the earlier rounds and reimages. The solutions are applied with
+# calwt=False and without flagging, so the uv coverage and weights, and
+# with them the PSF, do not change between rounds: every round starts from
+# the PSF, weight and model images of the previous one (calcpsf=False,
+# restart=True) and only recomputes the residual and continues cleaning.
+# The loop stops when
+#   - a round improves neither the dynamic range (peak / MAD sigma of the
+#     residual) nor the residual noise by minimprove (the calibration is
+#     then put back to that of the best round), or
+#   - the new solutions are within minphase degrees and minamp of unity,
+#     in which case the round is not imaged at all.
+# Timings and image metrics of every round go to <imagename>_selfcal.csv.
+
+import csv
+import time
+
+import numpy as np
+
+import casa_imaging
+import casa_timeslices
+import casa_trace
+
+# Products of one round that the next one starts from
+REUSE_PRODUCTS = casa_timeslices.PSF_PRODUCTS + ['pb', 'model']
+
+LOG_COLUMNS = ['round', 'imagename', 'solint', 'calmode', 'phase_rms_deg', 'amp_rms', 'rms', 'peak',
+    'dynamic_range', 'gaincal_s', 'applycal_s', 'image_s', 'status']
+
+# (solint, calmode) of each round
+DEFAULT_SCHEDULE = [('64s', 'p'), ('32s', 'p'), ('300s', 'ap')]
+
+# ------------------------------------------------------------------------
+
+def image_metrics(spec):
+    # Peak of the restored image, MAD sigma of the residual and their ratio
+    from casatools import image
+    ia = image()
+    ia.open(spec.product('residual'))
+    rms = 1.4826 * float(ia.statistics(robust = True, verbose = False)['medabsdevmed'][0])
+    ia.close()
+    ia.open(spec.image)
+    peak = float(ia.statistics(verbose = False)['max'][0])
+    ia.close()
+    return {'rms': rms, 'peak': peak, 'dynamic_range': peak / rms if rms > 0 else 0.0}
+
+
+def solution_scatter(caltable):
+    # RMS phase (degrees) and RMS fractional amplitude deviation from unity
+    # of the unflagged solutions in caltable
+    from casatools import table
+    tb = table()
+    tb.open(caltable)
+    gains = tb.getcol('CPARAM')
+    flags = tb.getcol('FLAG')
+    tb.close()
+    gains = gains[~flags]
+    if gains.size == 0:
+        return 0.0, 0.0
+    phase = np.degrees(np.angle(gains))
+    return float(np.sqrt(np.mean(phase ** 2))), float(np.sqrt(np.mean((np.abs(gains) - 1.0) ** 2)))
+
+
+def _apply(vis, field, pretables, tables):
+    # CORRECTED_DATA = DATA corrected by pretables ((table, gainfield,
+    # interp) applied before self-cal) and the self-cal tables
+    from casatasks import applycal, clearcal
+    if not pretables and not tables:
+        casa_trace.call('clearcal', clearcal, dict(vis = vis,addmodel = False))
+        return
+    casa_trace.call('applycal', applycal, dict(vis = vis,field = field,
+        gaintable = [t[0] for t in pretables] + tables,
+        gainfield = [t[1] for t in pretables] + [''] * len(tables),
+        interp = [t[2] for t in pretables] + ['nearest'] * len(tables),
+        calwt = False,parang = False,applymode = 'calonly',flagbackup = False))
+
+
+def run_selfcal(spec, schedule = DEFAULT_SCHEDULE, refant = '', uvrange = '', field = '', minsnr = 3,
+        minimprove = 0.02, minphase = 1.0, minamp = 0.01, pretables = (), executor = None):
+    # Self-calibrate spec.vis starting from the image of spec, which must
+    # have written its model to MODEL_DATA. pretables are (table, gainfield,
+    # interp) applied before the self-cal tables (when the data column still
+    # holds uncalibrated data). Returns the ImageSpec of the best round.
+    from casatasks import gaincal
+    vis = spec.vis
+    pretables = list(pretables)
+    best = {'round': 0, 'spec': spec, 'tables': []}
+    best.update(image_metrics(spec))
+    log = [dict(best, imagename = spec.imagename, solint = '', calmode = '', status = 'start')]
+    print('Self-cal round 0 %s: rms %.3g, peak %.3g, dynamic range %.1f' % (spec.imagename, best['rms'], best['peak'], best['dynamic_range']))
+
+    previous = spec
+    tables = []
+    for n, (solint, calmode) in enumerate(schedule, 1):
+        entry = {'round': n, 'solint': solint, 'calmode': calmode}
+        caltable = '%s.sc%d.%s' % (vis, n, 'GP' if calmode == 'p' else 'GA')
+        t0 = time.time()
+        casa_trace.call('gaincal', gaincal, dict(vis = vis,field = field,uvrange = uvrange,caltable = caltable,
+            refant = refant,solint = solint,solnorm = calmode != 'p',combine = '',minsnr = minsnr,calmode = calmode,
+            parang = False,gaintable = [t[0] for t in pretables] + tables,gainfield = [t[1] for t in pretables] + [''] * len(tables),
+            interp = [t[2] for t in pretables] + ['nearest'] * len(tables),append = False), label = 'selfcal_%d' % n)
+        entry['gaincal_s'] = time.time() - t0
+        entry['phase_rms_deg'], entry['amp_rms'] = solution_scatter(caltable)
+        if entry['phase_rms_deg'] < minphase and (calmode == 'p' or entry['amp_rms'] < minamp):
+            entry['status'] = 'converged (solutions within %g deg / %g of unity)' % (minphase, minamp)
+            log.append(entry)
+            print('Self-cal round %d (%s, %s): %s, not imaged' % (n, solint, calmode, entry['status']))
+            break
+
+        t0 = time.time()
+        _apply(vis, field, pretables, tables + [caltable])
+        entry['applycal_s'] = time.time() - t0
+
+        # Same PSF and weights as the previous round; continue from its model
+        round_spec = spec.derive('%s_sc%d' % (spec.imagename, n), calcpsf = False, restart = True)
+        casa_timeslices.copy_psf(previous.imagename, round_spec.imagename, products = REUSE_PRODUCTS)
+        t0 = time.time()
+        casa_imaging.make_images(round_spec, executor = executor)
+        entry['image_s'] = time.time() - t0
+        entry.update(image_metrics(round_spec))
+        entry['imagename'] = round_spec.imagename
+        print('Self-cal round %d (%s, %s) %s: rms %.3g, peak %.3g, dynamic range %.1f (best %.1f)' % (n, solint, calmode,
+            round_spec.imagename, entry['rms'], entry['peak'], entry['dynamic_range'], best['dynamic_range']))
+
+        improved = (entry['dynamic_range'] >= best['dynamic_range'] * (1.0 + minimprove) or
+            entry['rms'] <= best['rms'] * (1.0 - minimprove))
+        if not improved:
+            entry['status'] = 'no improvement'
+            log.append(entry)
+            # Put back the calibration of the best round
+            _apply(vis, field, pretables, best['tables'])
+            break
+        entry['status'] = 'accepted'
+        log.append(entry)
+        tables = tables + [caltable]
+        best = dict(entry, spec = round_spec, tables = list(tables))
+        previous = round_spec
+
+    logfile = spec.imagename + '_selfcal.csv'
+    with open(logfile, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(LOG_COLUMNS)
+        for entry in log:
+            writer.writerow([entry.get(column, '') for column in LOG_COLUMNS])
+    print('Self-cal: best image %s after %d round(s), dynamic range %.1f; log in %s' % (best['spec'].imagename, best['round'], best['dynamic_range'], logfile))
+    return best['spec']
@@ -0,0 +1,289 @@
+# Synthetic MeerKAT-like measurement sets
+# Used to benchmark the pipeline steps without a real observation. The
+# antenna positions are those of the MeerKAT configuration file shipped with
+# the CASA data repository; the visibilities are point sources plus
+# thermal noise. simulate_ms() makes a single target field,
+# simulate_observation() a full calibrator and target observation like the
+# ones the pipelines reduce: a bandpass calibrator scan, then phase
+# calibrator and target scans in turn, with a transient on the target for
+# part of one scan. add_rfi() adds narrowband and broadband RFI for testing
+# the flagging. Must be run inside CASA (casatools).
+
+import json
+import math
+import os
+
+import numpy as np
+
+MEERKAT_CFG = 'alma/simmos/meerkat.cfg'
+
+# Position and L-band flux density (Jy) of the calibrators
+CALIBRATORS = {
+    'J1939-6342': ('19h39m25.026s', '-63d42m45.63s', 14.9),
+    'J0408-6545': ('04h08m20.378s', '-65d45m09.08s', 17.066),
+    'J1311-2216': ('13h11m39.70s', '-22d16m41.0s', 2.0),
+    'J1830-3602': ('18h30m58.90s', '-36d02m30.0s', 1.5),
+}
+
+# ------------------------------------------------------------------------
+
+def read_config(path = None):
+    # x, y, z (m), dish diameter (m) and name of each antenna in a CASA
+    # simmos configuration file
+    if path is None:
+        from casatools import ctsys
+        path = ctsys.resolve(MEERKAT_CFG)
+    antennas = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            antennas.append((float(fields[0]), float(fields[1]), float(fields[2]), float(fields[3]), fields[4]))
+    return antennas
+
+
+def offset_direction(ra, dec, dx, dy):
+    # The direction dx, dy arcsec (east, north) of ra, dec
+    from casatools import measures, quanta
+    me = measures()
+    qa = quanta()
+    centre = me.direction('J2000', ra, dec)
+    offset = me.shift(centre, offset = qa.quantity(math.hypot(dx, dy), 'arcsec'),
+        pa = qa.quantity(math.degrees(math.atan2(dx, dy)), 'deg'))
+    me.done()
+    return offset
+
+
+def simulate_ms(vis, ra = '17h08m00s', dec = '-35d06m00s', sources = ((0.0, 0.0, 1.0),),
+        nant = 64, nchan = 256, freq = '856MHz', bandwidth = '856MHz', inttime = '8s',
+        duration = '1h', scanlength = '10min', noise = '1Jy', fieldname = 'TARGET'):
+    # Write a single-field MS of nant MeerKAT antennas with the (dx, dy,
+    # flux) point sources (offsets in arcsec from ra, dec, flux in Jy) and
+    # simple thermal noise, observed in scans of scanlength. CORRECTED_DATA
+    # starts as a copy of DATA.
+    from casatasks import clearcal
+    from casatools import componentlist, measures, quanta, simulator
+    if os.path.exists(vis):
+        raise IOError('%s already exists' % vis)
+    antennas = read_config()[:nant]
+    sm = simulator()
+    me = measures()
+    cl = componentlist()
+    qa = quanta()
+    sm.open(vis)
+    sm.setconfig(telescopename = 'MeerKAT', x = [a[0] for a in antennas], y = [a[1] for a in antennas],
+        z = [a[2] for a in antennas], dishdiameter = [a[3] for a in antennas], mount = ['alt-az'],
+        antname = [a[4] for a in antennas], coordsystem = 'global', referencelocation = me.observatory('MeerKAT'))
+    chanwidth = '%.6fHz' % (qa.convert(bandwidth, 'Hz')['value'] / nchan)
+    sm.setspwindow(spwname = 'LBAND', freq = freq, deltafreq = chanwidth, freqresolution = chanwidth,
+        nchannels = nchan, stokes = 'XX YY')
+    sm.setfeed(mode = 'perfect X Y')
+    sm.setfield(sourcename = fieldname, sourcedirection = me.direction('J2000', ra, dec))
+    sm.setlimits(shadowlimit = 0.001, elevationlimit = '10deg')
+    sm.setauto(autocorrwt = 0.0)
+    sm.settimes(integrationtime = inttime, usehourangle = True, referencetime = me.epoch('UTC', '2021/06/10/00:00:00'))
+    total = qa.convert(duration, 's')['value']
+    step = qa.convert(scanlength, 's')['value']
+    start = 0.0
+    while start < total:
+        stop = min(start + step, total)
+        sm.observe(sourcename = fieldname, spwname = 'LBAND', starttime = '%.1fs' % start, stoptime = '%.1fs' % stop)
+        start = stop
+
+    complist = vis + '.cl'
+    for dx, dy, flux in sources:
+        cl.addcomponent(flux = flux, fluxunit = 'Jy', shape = 'point', dir = offset_direction(ra, dec, dx, dy))
+    cl.rename(complist)
+    cl.close()
+    sm.predict(complist = complist)
+    sm.setnoise(mode = 'simplenoise', simplenoise = noise)
+    sm.corrupt()
+    sm.close()
+    me.done()
+
+    clearcal(vis = vis, addmodel = False)
+    return vis
+
+
+def timerange(start, stop):
+    # CASA timerange string for two MJD times in seconds
+    from casatools import quanta
+    qa = quanta()
+    return '%s~%s' % (qa.time(qa.quantity(start, 's'), form = ['ymd'], prec = 9)[0],
+        qa.time(qa.quantity(stop, 's'), form = ['ymd'], prec = 9)[0])
+
+# ------------------------------------------------------------------------
+# Calibrator and target observation
+
+def _predict(vis, field, components):
+    # MODEL_DATA of field from (direction, flux) point components
+    from casatasks import ft
+    from casatools import componentlist
+    complist = '%s.%s.cl' % (vis, field)
+    cl = componentlist()
+    for direction, flux in components:
+        cl.addcomponent(flux = flux, fluxunit = 'Jy', shape = 'point', dir = direction)
+    cl.rename(complist)
+    cl.close()
+    ft(vis = vis,field = field,complist = complist,usescratch = True,incremental = False)
+
+
+def _add_model(vis, rows = None, sigma = 0.0, seed = 1):
+    # DATA += MODEL_DATA, plus Gaussian noise of sigma Jy in the real and
+    # imaginary parts, for the rows selected by the boolean array rows (all
+    # rows if None). Goes through the MS in chunks of about 4M visibilities.
+    from casatools import table
+    rng = np.random.RandomState(seed)
+    tb = table()
+    tb.open(vis, nomodify = False)
+    nrows = tb.nrows()
+    ncorr, nchan = tb.getcell('DATA', 0).shape
+    chunk = max(2 ** 22 // (ncorr * nchan), 1)
+    for start in range(0, nrows, chunk):
+        n = min(chunk, nrows - start)
+        select = np.ones(n, dtype = bool) if rows is None else rows[start:start + n]
+        if not select.any():
+            continue
+        data = tb.getcol('DATA', start, n)
+        model = tb.getcol('MODEL_DATA', start, n)
+        data[..., select] += model[..., select]
+        if sigma > 0:
+            shape = (ncorr, nchan, int(select.sum()))
+            data[..., select] += rng.normal(scale = sigma, size = shape) + 1j * rng.normal(scale = sigma, size = shape)
+        tb.putcol('DATA', data, start, n)
+    tb.close()
+
+
+def simulate_observation(vis, nant = 16, nchan = 256, inttime = '8s', duration = '1h',
+        bpcal = 'J1939-6342', pcal = 'J1830-3602', target = 'TARGET', ra = '17h08m00s', dec = '-35d06m00s',
+        sources = ((0.0, 0.0, 0.5), (900.0, -600.0, 0.1), (-1500.0, 1200.0, 0.05)),
+        transient = (300.0, 240.0, 0.5, 64.0), freq = '856MHz', bandwidth = '856MHz',
+        bpscan = '10min', pcalscan = '2min', targetscan = '10min', noise = '1Jy', seed = 1):
+    # Write an observation of nant MeerKAT antennas, nchan channels and
+    # inttime dumps lasting duration: a bpcal scan, then pcal and target
+    # scans in turn. The calibrators are point sources of their catalogue
+    # flux density, sources are (dx, dy, flux) point sources around the
+    # target (offsets in arcsec east and north of ra, dec, flux in Jy) and
+    # transient is (dx, dy, flux, seconds), switched on in the middle of the
+    # middle target scan. CORRECTED_DATA starts as a copy of DATA.
+    # Returns, and writes to <vis>.json, the field names, the size of the MS
+    # and timeranges just before, during and just after the transient.
+    from casatasks import clearcal
+    from casatools import measures, quanta, simulator, table
+    if os.path.exists(vis):
+        raise IOError('%s already exists' % vis)
+    antennas = read_config()[:nant]
+    sm = simulator()
+    me = measures()
+    qa = quanta()
+    tb = table()
+    sm.open(vis)
+    sm.setconfig(telescopename = 'MeerKAT', x = [a[0] for a in antennas], y = [a[1] for a in antennas],
+        z = [a[2] for a in antennas], dishdiameter = [a[3] for a in antennas], mount = ['alt-az'],
+        antname = [a[4] for a in antennas], coordsystem = 'global', referencelocation = me.observatory('MeerKAT'))
+    chanwidth = '%.6fHz' % (qa.convert(bandwidth, 'Hz')['value'] / nchan)
+    sm.setspwindow(spwname = 'LBAND', freq = freq, deltafreq = chanwidth, freqresolution = chanwidth,
+        nchannels = nchan, stokes = 'XX YY')
+    sm.setfeed(mode = 'perfect X Y')
+    directions = {target: me.direction('J2000', ra, dec)}
+    for name in [bpcal, pcal]:
+        directions[name] = me.direction('J2000', *CALIBRATORS[name][:2])
+    for name in [bpcal, pcal, target]:
+        sm.setfield(sourcename = name, sourcedirection = directions[name])
+    # No elevation limit, so that every scheduled scan is observed
+    sm.setlimits(shadowlimit = 0.001, elevationlimit = '0deg')
+    sm.setauto(autocorrwt = 0.0)
+    sm.settimes(integrationtime = inttime, usehourangle = True, referencetime = me.epoch('UTC', '2021/06/10/00:00:00'))
+    total = qa.convert(duration, 's')['value']
+    schedule = [(bpcal, qa.convert(bpscan, 's')['value'])]
+    cycle = [(pcal, qa.convert(pcalscan, 's')['value']), (target, qa.convert(targetscan, 's')['value'])]
+    start = schedule[0][1]
+    while start < total:
+        name, length = cycle[(len(schedule) - 1) % 2]
+        schedule.append((name, min(length, total - start)))
+        start += schedule[-1][1]
+    start = 0.0
+    for name, length in schedule:
+        sm.observe(sourcename = name, spwname = 'LBAND', starttime = '%.1fs' % start, stoptime = '%.1fs' % (start + length))
+        start += length
+    sm.close()
+
+    # Sky and noise
+    _predict(vis, bpcal, [(directions[bpcal], CALIBRATORS[bpcal][2])])
+    _predict(vis, pcal, [(directions[pcal], CALIBRATORS[pcal][2])])
+    _predict(vis, target, [(offset_direction(ra, dec, dx, dy), flux) for dx, dy, flux in sources])
+    _add_model(vis, sigma = qa.convert(noise, 'Jy')['value'] / math.sqrt(2.0), seed = seed)
+
+    # Transient: the middle dumps of the middle target scan
+    tb.open(vis + '/FIELD')
+    target_id = list(tb.getcol('NAME')).index(target)
+    tb.close()
+    tb.open(vis)
+    times = tb.getcol('TIME')
+    on_target = tb.getcol('FIELD_ID') == target_id
+    scans = tb.getcol('SCAN_NUMBER')
+    tb.close()
+    target_scans = sorted(set(scans[on_target]))
+    dumps = np.unique(times[scans == target_scans[len(target_scans) // 2]])
+    dt = qa.convert(inttime, 's')['value']
+    dx, dy, flux, seconds = transient
+    t_on = dumps[len(dumps) // 2] - 0.5 * dt
+    t_off = t_on + seconds
+    _predict(vis, target, [(offset_direction(ra, dec, dx, dy), flux)])
+    _add_model(vis, rows = on_target & (times > t_on) & (times < t_off))
+    tb.open(vis, nomodify = False)
+    tb.removecols('MODEL_DATA')
+    tb.close()
+    me.done()
+    clearcal(vis = vis, addmodel = False)
+
+    info = {'vis': vis, 'bpcal': bpcal, 'pcal': pcal, 'target': target,
+        'nant': len(antennas), 'nchan': nchan, 'inttime': inttime, 'duration': duration,
+        'nrows': len(times), 'nvis': len(times) * nchan * 2,
+        'transient': {'dx': dx, 'dy': dy, 'flux': flux, 'seconds': seconds},
+        'time_before': timerange(t_on - seconds - dt, t_on - dt),
+        'time_on': timerange(t_on, t_off),
+        'time_after': timerange(t_off + dt, t_off + seconds + dt)}
+    with open(vis + '.json', 'w') as f:
+        json.dump(info, f, indent = 1)
+    return info
+
+
+def add_rfi(vis, nlines = 4, nbursts = 3, strength = 10.0, seed = 2):
+    # Add RFI to DATA: nlines narrowband lines (random channels, on all
+    # rows) and nbursts broadband bursts (random dumps, on all baselines),
+    # of strength times the RMS of the data, with random phases. For
+    # testing the RFI flagging (casa_rfi). Returns the channels and times.
+    from casatools import table
+    rng = np.random.RandomState(seed)
+    tb = table()
+    tb.open(vis, nomodify = False)
+    nrows = tb.nrows()
+    ncorr, nchan = tb.getcell('DATA', 0).shape
+    times = tb.getcol('TIME')
+    sample = tb.getcol('DATA', 0, min(nrows, 1000))
+    amplitude = strength * float(np.sqrt(np.mean(np.abs(sample) ** 2)))
+    channels = sorted(rng.choice(nchan, size = min(nlines, nchan), replace = False).tolist())
+    dumps = np.unique(times)
+    bursts = sorted(rng.choice(dumps, size = min(nbursts, len(dumps)), replace = False).tolist())
+    chunk = max(2 ** 22 // (ncorr * nchan), 1)
+    for start in range(0, nrows, chunk):
+        n = min(chunk, nrows - start)
+        data = tb.getcol('DATA', start, n)
+        phase = np.exp(2j * np.pi * rng.uniform(size = (ncorr, nchan, n)))
+        data[:, channels, :] += amplitude * phase[:, channels, :]
+        burst = np.isin(times[start:start + n], bursts)
+        data[..., burst] += amplitude * phase[..., burst]
+        tb.putcol('DATA', data, start, n)
+    tb.close()
+    return {'channels': channels, 'times': bursts, 'amplitude': amplitude}
+
+
+def split_fields(vis, outputs):
+    # Split vis into one MS per item of outputs {outputvis: field selection},
+    # e.g. calibrators and target for the multi-MS pipelines
+    from casatasks import mstransform
+    for outputvis in sorted(outputs):
+        mstransform(vis = vis,outputvis = outputvis,field = outputs[outputvis],datacolumn = 'data')
+    return sorted(outputs)
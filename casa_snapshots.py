@@ -0,0 +1,243 @@
+# Fast time-domain imaging: many short dirty snapshots in one pass
+# The full integration image has written its deep model to MODEL_DATA
+# (tclean savemodel='modelcolumn'). The residual visibilities, corrected
+# data minus model, hold only what changed during the observation. They are
+# read once, chunk by chunk of rows, and each row is gridded into the
+# snapshot of the time interval it falls in; a snapshot is Fourier
+# transformed and written as soon as its last row has been read. The
+# snapshots are a dirty Stokes I cube (natural weighting, nearest-cell
+# gridding) of a small field centred on a candidate position: the
+# visibilities are phase-rotated to it without re-projecting the uvw, so
+# the field should stay well within the primary beam and small enough to
+# ignore the w-term. The noise and peak of every snapshot and the peaks
+# above threshold are written next to the cube.
+
+import csv
+import math
+import os
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import casa_imagediff
+import casa_timeslices
+import casa_transients
+
+SPEED_OF_LIGHT = 299792458.0
+
+SNAPSHOT_COLUMNS = ['snapshot', 'start', 'stop', 'nvis', 'rms', 'madsigma', 'peak', 'peak_y', 'peak_x', 'peak_snr']
+CANDIDATE_COLUMNS = ['snapshot', 'start', 'ra_deg', 'dec_deg', 'x', 'y', 'snr', 'peak']
+
+# ------------------------------------------------------------------------
+
+def direction_offset(ra, dec, ra0, dec0):
+    # Direction cosines l, m, n of ra, dec (radians) about ra0, dec0
+    l = math.cos(dec) * math.sin(ra - ra0)
+    m = math.sin(dec) * math.cos(dec0) - math.cos(dec) * math.sin(dec0) * math.cos(ra - ra0)
+    return l, m, math.sqrt(max(1.0 - l * l - m * m, 0.0))
+
+
+def grid_rows(grid, uvw, freqs, vis, weight, npix, du, shift):
+    # Add the visibilities (nchan, nrow) of rows with uvw (3, nrow) metres to
+    # the flat npix x npix grid, with their conjugates. shift is l, m, n of
+    # the image centre. Returns the sum of the gridded weights.
+    scale = freqs[:, None] / SPEED_OF_LIGHT
+    u, v, w = uvw[0][None, :] * scale, uvw[1][None, :] * scale, uvw[2][None, :] * scale
+    l, m, n = shift
+    if l or m:
+        vis = vis * np.exp(2j * np.pi * (u * l + v * m + w * (n - 1.0)))
+    iu = np.rint(u / du).astype(np.int64)
+    iv = np.rint(v / du).astype(np.int64)
+    keep = (np.abs(iu) < npix // 2) & (np.abs(iv) < npix // 2) & (weight > 0)
+    iu, iv, vis, weight = iu[keep], iv[keep], vis[keep], weight[keep]
+    size = npix * npix
+    weighted = vis * weight
+    for index, values in [((iv % npix) * npix + iu % npix, weighted), (((-iv) % npix) * npix + (-iu) % npix, np.conj(weighted))]:
+        grid.real += np.bincount(index, weights = values.real, minlength = size)
+        grid.imag += np.bincount(index, weights = values.imag, minlength = size)
+    return 2.0 * weight.sum()
+
+
+def grid_image(grid, sumwt, npix):
+    # Dirty image of a grid, RA increasing to the left
+    if sumwt <= 0:
+        return np.full((npix, npix), np.nan, dtype = np.float32)
+    image = np.fft.fftshift(np.fft.ifft2(grid.reshape((npix, npix)))).real * (npix * npix / sumwt)
+    return image[:, ::-1].astype(np.float32)
+
+
+def cube_header(ra0, dec0, npix, cell, start, interval, nsnap, vis, field):
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['BITPIX'] = -32
+    header['NAXIS'] = 3
+    header['NAXIS1'] = npix
+    header['NAXIS2'] = npix
+    header['NAXIS3'] = nsnap
+    for axis, ctype, crval, cdelt, crpix in [(1, 'RA---SIN', math.degrees(ra0) % 360.0, -math.degrees(cell), npix // 2),
+            (2, 'DEC--SIN', math.degrees(dec0), math.degrees(cell), npix // 2 + 1)]:
+        header['CTYPE%d' % axis] = ctype
+        header['CRVAL%d' % axis] = crval
+        header['CDELT%d' % axis] = cdelt
+        header['CRPIX%d' % axis] = crpix
+        header['CUNIT%d' % axis] = 'deg'
+    # Snapshot axis: mid time of each snapshot, MJD seconds
+    header['CTYPE3'] = 'TIME'
+    header['CRVAL3'] = start + 0.5 * interval
+    header['CDELT3'] = interval
+    header['CRPIX3'] = 1
+    header['CUNIT3'] = 's'
+    header['RADESYS'] = 'FK5'
+    header['EQUINOX'] = 2000.0
+    header['BUNIT'] = 'JY/BEAM'
+    header['OBJECT'] = field
+    header.add_history('Residual snapshots of %s' % os.path.basename(os.path.normpath(vis)))
+    return header
+
+# ------------------------------------------------------------------------
+
+def _open_rows(vis, field, timerange):
+    # Reference table of the rows of field within timerange, the data column
+    # to use, the field phase centre and the frequencies of each data
+    # description
+    from casatools import quanta, table
+    qa = quanta()
+    tb = table()
+    tb.open(vis + '/FIELD')
+    names = list(tb.getcol('NAME'))
+    phase_dir = tb.getcol('PHASE_DIR')
+    tb.close()
+    if field and field not in names:
+        raise ValueError('%s has no field %s' % (vis, field))
+    field_id = names.index(field) if field else 0
+    ra0, dec0 = phase_dir[0, 0, field_id], phase_dir[1, 0, field_id]
+
+    tb.open(vis + '/SPECTRAL_WINDOW')
+    chan_freqs = [tb.getcell('CHAN_FREQ', row) for row in range(tb.nrows())]
+    tb.close()
+    tb.open(vis + '/DATA_DESCRIPTION')
+    freqs = dict([(ddid, chan_freqs[spw]) for ddid, spw in enumerate(tb.getcol('SPECTRAL_WINDOW_ID'))])
+    tb.close()
+
+    query = 'FIELD_ID==%d && !FLAG_ROW' % field_id
+    if timerange:
+        start, stop = [qa.convert(qa.totime(t), 's')['value'] for t in timerange.split('~')]
+        query += ' && TIME>=%r && TIME<=%r' % (start, stop)
+    tb.open(vis)
+    columns = tb.colnames()
+    if 'MODEL_DATA' not in columns:
+        tb.close()
+        raise ValueError('%s has no MODEL_DATA: make the full integration image with savemodel=\'modelcolumn\' first' % vis)
+    datacolumn = 'CORRECTED_DATA' if 'CORRECTED_DATA' in columns else 'DATA'
+    rows = tb.query(query)
+    tb.close()
+    return rows, datacolumn, ra0, dec0, freqs
+
+
+def snapshot_cube(vis, outroot, field = '', interval = '16s', npix = 512, cell = '1.0arcsec',
+        ra = '', dec = '', timerange = '', threshold = 6.0, chunkvis = 2 ** 24):
+    # Image the residuals of field in vis as snapshots of interval seconds,
+    # npix x npix pixels of cell, centred on ra, dec (default: the phase
+    # centre). Writes <outroot>.fits (one plane per snapshot), the per-
+    # snapshot statistics to <outroot>.csv and the peaks above threshold
+    # times the MAD sigma of their snapshot to <outroot>_candidates.csv.
+    # Reads about chunkvis visibilities at a time. Returns the statistics.
+    from casatools import measures, quanta
+    qa = quanta()
+    interval = qa.convert(interval, 's')['value'] if isinstance(interval, str) else float(interval)
+    cell = math.radians(casa_timeslices.to_arcsec(cell[0] if isinstance(cell, (list, tuple)) else cell) / 3600.0)
+    npix = casa_timeslices.fft_size(npix)
+    du = 1.0 / (npix * cell)
+
+    rows, datacolumn, ra0, dec0, freqs = _open_rows(vis, field, timerange)
+    nrows = rows.nrows()
+    if nrows == 0:
+        rows.close()
+        raise ValueError('No rows of %s selected (field %s, timerange %s)' % (vis, field, timerange))
+    shift = (0.0, 0.0, 1.0)
+    if ra and dec:
+        me = measures()
+        centre = me.direction('J2000', ra, dec)
+        me.done()
+        shift = direction_offset(centre['m0']['value'], centre['m1']['value'], ra0, dec0)
+        ra0, dec0 = centre['m0']['value'], centre['m1']['value']
+
+    # Snapshot of each row, and the last row of each snapshot, so that a
+    # snapshot can be written as soon as it is complete
+    times = rows.getcol('TIME')
+    start = times.min()
+    snapshot = ((times - start) // interval).astype(np.int64)
+    nsnap = int(snapshot.max()) + 1
+    last_row = np.full(nsnap, -1, dtype = np.int64)
+    np.maximum.at(last_row, snapshot, np.arange(nrows))
+    ncorr, nchan = rows.getcell(datacolumn, 0).shape
+    chunk = max(chunkvis // (ncorr * nchan), 1)
+    print('Imaging %d snapshots of %g s of %s (%d rows, %s - MODEL_DATA) in chunks of %d rows' % (nsnap, interval, vis, nrows, datacolumn, chunk))
+
+    header = cube_header(ra0, dec0, npix, cell, start, interval, nsnap, vis, field)
+    wcs = WCS(header).celestial
+    fitsfile = outroot + '.fits'
+    if os.path.exists(fitsfile):
+        os.remove(fitsfile)
+    stream = fits.StreamingHDU(fitsfile, header)
+    statsfile = open(outroot + '.csv', 'w')
+    candfile = open(outroot + '_candidates.csv', 'w')
+    stats_writer = csv.writer(statsfile)
+    stats_writer.writerow(SNAPSHOT_COLUMNS)
+    cand_writer = csv.writer(candfile)
+    cand_writer.writerow(CANDIDATE_COLUMNS)
+
+    grids = {}
+    sumwt = {}
+    nvis = {}
+    results = []
+    written = 0
+    def write_snapshot(index):
+        plane = grid_image(grids.pop(index, np.zeros(1)), sumwt.pop(index, 0.0), npix)
+        stream.write(plane[None])
+        npixels, rms, madsigma, peak, peak_y, peak_x = casa_imagediff.tile_stats(plane)
+        snr = peak / madsigma if madsigma > 0 else np.nan
+        row = [index, start + index * interval, start + (index + 1) * interval, nvis.pop(index, 0), rms, madsigma, peak, peak_y, peak_x, snr]
+        stats_writer.writerow(row)
+        results.append(dict(zip(SNAPSHOT_COLUMNS, row)))
+        if madsigma > 0:
+            py, px = casa_transients.local_maxima(plane / madsigma, threshold)
+            for y, x in zip(py, px):
+                ra_deg, dec_deg = wcs.all_pix2world([[x, y]], 0)[0]
+                cand_writer.writerow([index, '%.3f' % row[1], '%.6f' % ra_deg, '%.6f' % dec_deg, x, y, '%.3f' % (plane[y, x] / madsigma), '%.6g' % plane[y, x]])
+
+    for first in range(0, nrows, chunk):
+        n = min(chunk, nrows - first)
+        data = rows.getcol(datacolumn, first, n) - rows.getcol('MODEL_DATA', first, n)
+        flags = rows.getcol('FLAG', first, n)
+        weights = rows.getcol('WEIGHT', first, n)
+        uvw = rows.getcol('UVW', first, n)
+        ddids = rows.getcol('DATA_DESC_ID', first, n)
+        # Stokes I from the first and last (parallel hand) correlations
+        vis_i = 0.5 * (data[0] + data[-1])
+        weight_i = np.where(flags[0] | flags[-1], 0.0, (4.0 * weights[0] * weights[-1] / np.maximum(weights[0] + weights[-1], 1e-30))[None, :])
+        for index in np.unique(snapshot[first:first + n]):
+            in_snapshot = snapshot[first:first + n] == index
+            if index not in grids:
+                grids[index] = np.zeros(npix * npix, dtype = np.complex128)
+                sumwt[index] = 0.0
+                nvis[index] = 0
+            for ddid in np.unique(ddids[in_snapshot]):
+                select = in_snapshot & (ddids == ddid)
+                sumwt[index] += grid_rows(grids[index], uvw[:, select], freqs[ddid], vis_i[:, select], weight_i[:, select], npix, du, shift)
+                nvis[index] += int((weight_i[:, select] > 0).sum())
+        while written < nsnap and last_row[written] < first + n:
+            write_snapshot(written)
+            written += 1
+    rows.close()
+    stream.close()
+    statsfile.close()
+    candfile.close()
+
+    finite = [r for r in results if np.isfinite(r['peak_snr'])]
+    if finite:
+        best = max(finite, key = lambda r: r['peak_snr'])
+        print('%s: brightest snapshot %d (%s) peak S/N %.1f at pixel (%d, %d)' % (fitsfile, best['snapshot'],
+            qa.time(qa.quantity(best['start'], 's'), form = ['ymd'])[0], best['peak_snr'], best['peak_x'], best['peak_y']))
+    return results
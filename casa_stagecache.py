@@ -0,0 +1,190 @@
+# Make-style stage cache for the pipeline task graph (casa_scheduler)
+# Every file a task touches has a content key: a hash of the task that made
+# it, that task's parameters and the content keys of everything it read.
+# The keys of the files on disk are kept in a JSON manifest, so a rerun with
+# the same names skips every task whose outputs still have the keys the
+# current parameters would give, and only rebuilds what changed downstream.
+#
+# Measurement sets are modified in place, so they cannot be rebuilt from
+# the middle. The first time the cache sees an input MS it saves its flags
+# as a flag version; if any step on that MS has to rerun, the flags are
+# restored from that version and all steps on the MS are replayed.
+
+import hashlib
+import json
+import os
+
+from casa_flagversions import flagmanager
+
+ORIGIN_VERSION = 'stagecache_origin'
+# Tasks (func_name) that copy their one read to their one create
+COPY_FUNCS = ['shutil.copytree', 'casa_scheduler.clone_table']
+# Subtables that identify an observation and are not touched by the pipeline
+FINGERPRINT_SUBTABLES = ['ANTENNA', 'FIELD', 'OBSERVATION', 'SPECTRAL_WINDOW']
+
+# ------------------------------------------------------------------------
+
+def content_hash(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys = True, default = repr).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def fingerprint(path):
+    # Identity of an input MS that stays the same while it is being flagged
+    # and calibrated: its path, the file sizes of the metadata subtables and
+    # the row count and observed time range, which change when scans are
+    # added or the MS is made again under the same name
+    entries = []
+    for subtable in FINGERPRINT_SUBTABLES:
+        for root, dirs, files in os.walk(os.path.join(path, subtable)):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                entries.append([os.path.relpath(full, path), os.path.getsize(full)])
+    return content_hash('input', os.path.abspath(path), entries, table_extent(path))
+
+
+def table_extent(path):
+    # Row count of a table and the TIME_RANGE of its OBSERVATION subtable
+    if not os.path.exists(os.path.join(path, 'table.dat')):
+        return None
+    from casatools import table
+    tb = table()
+    tb.open(path)
+    nrows = tb.nrows()
+    tb.close()
+    timerange = None
+    if os.path.exists(os.path.join(path, 'OBSERVATION', 'table.dat')):
+        tb.open(os.path.join(path, 'OBSERVATION'))
+        timerange = tb.getcol('TIME_RANGE').tolist()
+        tb.close()
+    return [nrows, timerange]
+
+
+def func_name(func):
+    if isinstance(func, str):
+        return func
+    return func.__module__ + '.' + func.__name__
+
+
+def _normalise(value, names):
+    # Replace file names in the task parameters by their content keys
+    if isinstance(value, str):
+        if value and os.path.normpath(value) in names:
+            return names[os.path.normpath(value)]
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_normalise(v, names) for v in value]
+    if isinstance(value, dict):
+        return dict([(k, _normalise(value[k], names)) for k in value])
+    return value
+
+# ------------------------------------------------------------------------
+
+class StageCache(object):
+
+    def __init__(self, path = 'stagecache.json'):
+        self.path = path
+        self.manifest = {'resources': {}, 'origins': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+        self._after = {}
+        self._rebuild = {}
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent = 1, sort_keys = True)
+        os.rename(tmp, self.path)
+
+    def _on_disk(self, path):
+        if not os.path.exists(path):
+            return None
+        return self.manifest['resources'].get(path)
+
+    def plan(self, tasks):
+        # Work out the content key of every file after every task, then the
+        # set of tasks that have to run. Returns the names of the others.
+        state = {}
+        before = []
+        writers = {}
+        for pos, task in enumerate(tasks):
+            for path in task.reads + task.writes:
+                if path not in state:
+                    state[path] = fingerprint(path)
+            names = dict([(path, '@' + state[path]) for path in task.reads + task.writes])
+            for i, path in enumerate(task.creates):
+                names[path] = '@out%d' % i
+            key = content_hash(func_name(task.func), _normalise(task.kwargs, names),
+                [state[path] for path in task.reads + task.writes])
+            before.append(dict([(path, state[path]) for path in task.reads + task.writes]))
+            for path in task.writes:
+                state[path] = content_hash(state[path], key)
+                writers.setdefault(path, []).append((pos, False))
+            for i, path in enumerate(task.creates):
+                state[path] = content_hash(key, 'out', i)
+                writers.setdefault(path, []).append((pos, True))
+            if func_name(task.func) in COPY_FUNCS:
+                # A copy has the content, and so the key, of its source
+                state[task.creates[0]] = state[task.reads[0]]
+            self._after[task.name] = dict([(path, state[path]) for path in task.outputs])
+
+        def start(path, pos):
+            # Rebuilding path for a task at pos starts at the last task that
+            # created it from scratch, or at the original input (-1)
+            created = [p for p, creates in writers[path] if creates and p <= pos]
+            return created[-1] if created else -1
+
+        rebuild = {}
+        def mark(path, first):
+            if path not in rebuild or first < rebuild[path]:
+                rebuild[path] = first
+                return True
+            return False
+
+        for path in writers:
+            if self._on_disk(path) != state[path]:
+                mark(path, start(path, len(tasks)))
+        changed = True
+        while changed:
+            changed = False
+            run = set([p for path in rebuild for p, _ in writers[path] if p >= rebuild[path]])
+            for pos in sorted(run):
+                task = tasks[pos]
+                for path in task.outputs:
+                    changed = mark(path, start(path, pos)) or changed
+                for path in task.reads:
+                    # A rerun task must see its inputs as they were planned
+                    if path not in writers or (path in rebuild and rebuild[path] < pos):
+                        continue
+                    if self._on_disk(path) != before[pos][path]:
+                        changed = mark(path, start(path, pos)) or changed
+        run = set([p for path in rebuild for p, _ in writers[path] if p >= rebuild[path]])
+        run.update([pos for pos, task in enumerate(tasks) if not task.outputs])
+        self._rebuild = rebuild
+        return set([task.name for pos, task in enumerate(tasks) if pos not in run])
+
+    def prepare(self):
+        # Invalidate the files that will be rebuilt and put input MS files
+        # back to their original flags before any task runs
+        for path in sorted(self._rebuild):
+            self.manifest['resources'].pop(path, None)
+            if self._rebuild[path] >= 0:
+                continue
+            if not os.path.exists(path):
+                continue
+            if self.manifest['origins'].get(path) == fingerprint(path):
+                flagmanager(vis = path,mode = 'restore',versionname = ORIGIN_VERSION)
+            else:
+                flagmanager(vis = path,mode = 'save',versionname = ORIGIN_VERSION)
+                self.manifest['origins'][path] = fingerprint(path)
+        self.save()
+
+    def record(self, task):
+        # Called as each task finishes
+        self.manifest['resources'].update(self._after[task.name])
+        self.save()
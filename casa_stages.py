@@ -0,0 +1,169 @@
+# Checkpointed, resumable pipeline runs
+# The pipelines are split into named stages (basic flagging, calibration
+# stages 0-3, the target, the images, self-cal). A JSON manifest records
+# each stage as it completes, with the checkpoint flag version saved for
+# every MS the stage wrote (casa_scheduler.TaskGraph.end_stage). A run can
+# then be restricted to a range of stages:
+#   casa --nogui -c casa_pipeline_multims_V0_0.py --resume
+#   casa --nogui -c casa_pipeline_multims_V0_0.py --from-stage stage2 --to-stage target
+# Before starting at a later stage the flags of every MS are restored
+# (casa_flagversions.flagmanager) to the checkpoint of the last completed
+# stage that wrote it, or to the flags the input MS had before the first
+# run. Calibration tables and images made by earlier stages are used as
+# they are on disk.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import casa_scheduler
+import casa_trace
+from casa_flagversions import flagmanager
+
+ORIGIN_VERSION = 'checkpoint_origin'
+
+# ------------------------------------------------------------------------
+
+def parse_args(stages, argv = None):
+    parser = argparse.ArgumentParser(description = 'Stages: ' + ', '.join(stages))
+    parser.add_argument('--resume', action = 'store_true', help = 'start after the last completed stage')
+    parser.add_argument('--from-stage', choices = stages, help = 'first stage to run')
+    parser.add_argument('--to-stage', choices = stages, help = 'last stage to run')
+    parser.add_argument('--list-stages', action = 'store_true', help = 'show the stages and their checkpoints, then exit')
+    # CASA passes its own options through to the script
+    args, unknown = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return args
+
+
+class StageRunner(object):
+
+    def __init__(self, stages, path = 'checkpoint.json', inputs = (), argv = None):
+        # stages in running order; inputs are the MS files the pipeline
+        # starts from, whose original flags are kept as a flag version
+        self.stages = list(stages)
+        self.path = path
+        self.manifest = {'completed': {}, 'origins': []}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+        self._remaining = {}
+        self._started = {}
+
+        args = parse_args(self.stages, argv)
+        if args.list_stages:
+            self.list_stages()
+            sys.exit(0)
+        first = 0
+        if args.resume:
+            while first < len(self.stages) and self.stages[first] in self.manifest['completed']:
+                first += 1
+        if args.from_stage:
+            first = self.stages.index(args.from_stage)
+        last = len(self.stages) - 1
+        if args.to_stage:
+            last = self.stages.index(args.to_stage)
+        self.first, self.last = first, last
+        self.active = args.resume or args.from_stage is not None or args.to_stage is not None
+
+        for vis in inputs:
+            vis = os.path.normpath(vis)
+            if vis not in self.manifest['origins'] and os.path.exists(vis):
+                flagmanager(vis = vis,mode = 'save',versionname = ORIGIN_VERSION,merge = 'replace')
+                self.manifest['origins'].append(vis)
+        if self.active:
+            if first > last:
+                print('Nothing to run: all stages up to %s are complete' % self.stages[last])
+            else:
+                print('Running stages %s' % ', '.join(self.stages[first:last + 1]))
+                self.restore(first)
+        for stage in self.stages[first:]:
+            self.manifest['completed'].pop(stage, None)
+        self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent = 1, sort_keys = True)
+        os.rename(tmp, self.path)
+
+    def list_stages(self):
+        for stage in self.stages:
+            entry = self.manifest['completed'].get(stage)
+            if entry:
+                print('%-12s completed %s  %s' % (stage, entry['time'], ', '.join(sorted(entry['flagversions']))))
+            else:
+                print('%-12s -' % stage)
+
+    def restore(self, first):
+        # Put the flags of every MS back to where they were after the stages
+        # before first
+        for stage in self.stages[:first]:
+            if stage not in self.manifest['completed']:
+                raise RuntimeError('Cannot start at %s: stage %s has not been completed' % (self.stages[first], stage))
+        versions = dict([(vis, ORIGIN_VERSION) for vis in self.manifest['origins']])
+        for stage in self.stages[:first]:
+            versions.update(self.manifest['completed'][stage]['flagversions'])
+        for vis in sorted(versions):
+            if not os.path.exists(vis):
+                continue
+            print('Restoring flag version %s of %s' % (versions[vis], vis))
+            flagmanager(vis = vis,mode = 'restore',versionname = versions[vis])
+
+    def selected(self, stage):
+        # Steps outside any stage always run
+        if stage is None:
+            return True
+        return self.first <= self.stages.index(stage) <= self.last
+
+    def begin(self, stage):
+        # Start a stage run directly from the script: the CASA task calls
+        # from now on are traced under it. Returns selected(stage).
+        if not self.selected(stage):
+            return False
+        self._started[stage] = time.time()
+        casa_trace.set_stage(stage)
+        return True
+
+    def complete(self, stage, flagversions = None):
+        # Record stage as done, with the checkpoint flag version of each MS
+        # (and its wall time if it was started with begin). Does nothing for
+        # stages that were not selected.
+        if not self.selected(stage):
+            return
+        entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'flagversions': flagversions or {}}
+        if stage in self._started:
+            entry['wall'] = time.time() - self._started.pop(stage)
+            casa_trace.set_stage(None)
+        self.manifest['completed'][stage] = entry
+        self.save()
+        print('Stage %s complete' % stage)
+
+    def start_graph(self, tasks, skip):
+        # Track the selected stages of a TaskGraph until all their tasks
+        # have run
+        self._remaining = {}
+        self._written = {}
+        for task in tasks:
+            if task.stage is None or not self.selected(task.stage):
+                continue
+            self._remaining.setdefault(task.stage, set())
+            self._written.setdefault(task.stage, set())
+            if task.name not in skip:
+                self._remaining[task.stage].add(task.name)
+            self._written[task.stage].update([path for path in task.outputs if casa_scheduler.is_ms(path)])
+        for stage in list(self._remaining):
+            self._check(stage)
+
+    def task_done(self, task):
+        if task.stage in self._remaining:
+            self._remaining[task.stage].discard(task.name)
+            self._check(task.stage)
+
+    def _check(self, stage):
+        if self._remaining[stage]:
+            return
+        del self._remaining[stage]
+        version = casa_scheduler.checkpoint_version(stage)
+        self.complete(stage, dict([(vis, version) for vis in sorted(self._written[stage])]))
@@ -0,0 +1,295 @@
+# Time-slice imaging for FRB localisation
+# The before/on/after slices use the same MS, spw and imaging set-up and are
+# independent, so they are imaged at the same time by a casa_imaging
+# executor (worker processes). Slices whose uv coverage is close enough share
+# one PSF: it is made once (tclean with niter=0) and copied into each slice,
+# which is then cleaned with calcpsf=False. The copied sum of weights and
+# weight images are rescaled to the slice's own WEIGHT sum, so the slices keep
+# the same flux scale; check_flux compares a steady source across the slices.
+# For localisation only a few arcminutes around the candidate matter, so the
+# slices can also be imaged as a small field phase-shifted to the candidate.
+
+import glob
+import os
+import shutil
+import time
+
+import numpy as np
+
+import casa_imaging
+import casa_scheduler
+
+# Image products made when the PSF is computed (one per Taylor term for mtmfs)
+PSF_PRODUCTS = ['psf', 'sumwt', 'weight']
+# Of those, the ones that scale with the summed visibility weights
+WEIGHT_PRODUCTS = ['sumwt', 'weight']
+
+# ------------------------------------------------------------------------
+# uv coverage comparison
+
+def uv_coverage(vis, timerange = '', spw = ''):
+    # u and v (metres) of every row selected by timerange and spw
+    from casatools import ms as mstool
+    myms = mstool()
+    myms.open(vis)
+    selection = {}
+    if timerange:
+        selection['time'] = timerange
+    if spw:
+        selection['spw'] = spw
+    if selection:
+        myms.msselect(selection)
+    uvw = myms.getdata(['uvw'])['uvw']
+    myms.close()
+    return uvw[:2]
+
+
+def weight_sum(vis, timerange = '', spw = '', chunkvis = 2 ** 24):
+    # Sum of WEIGHT over the unflagged data selected by timerange and spw
+    # (a partly flagged row counts with its unflagged fraction of the
+    # selected channels), read about chunkvis visibilities at a time
+    from casatools import ms as mstool, quanta, table
+    qa = quanta()
+    tb = table()
+    tb.open(vis + '/DATA_DESCRIPTION')
+    spws = list(tb.getcol('SPECTRAL_WINDOW_ID'))
+    tb.close()
+    channels = dict([(i, None) for i in set(spws)])
+    if spw:
+        myms = mstool()
+        index = myms.msseltoindex(vis = vis, spw = spw)
+        channels = {}
+        for i, start, stop, step in index['channel']:
+            channels.setdefault(int(i), []).append((int(start), int(stop) + 1, max(int(step), 1)))
+    query = '!FLAG_ROW'
+    if timerange:
+        start, stop = [qa.convert(qa.totime(t), 's')['value'] for t in timerange.split('~')]
+        query += ' && TIME>=%r && TIME<=%r' % (start, stop)
+
+    total = 0.0
+    tb.open(vis)
+    for ddid, i in enumerate(spws):
+        if i not in channels:
+            continue
+        rows = tb.query('DATA_DESC_ID==%d && %s' % (ddid, query))
+        nrows = rows.nrows()
+        if nrows == 0:
+            rows.close()
+            continue
+        ncorr, nchan = rows.getcell('FLAG', 0).shape
+        select = np.ones(nchan, dtype = bool)
+        if channels[i] is not None:
+            select[:] = False
+            for start, stop, step in channels[i]:
+                select[start:stop:step] = True
+        chunk = max(chunkvis // (ncorr * nchan), 1)
+        for first in range(0, nrows, chunk):
+            n = min(chunk, nrows - first)
+            unflagged = 1.0 - rows.getcol('FLAG', first, n)[:, select, :].mean(axis = 1)
+            total += float((rows.getcol('WEIGHT', first, n) * unflagged).sum())
+        rows.close()
+    tb.close()
+    return total
+
+
+def uv_similarity(uv_a, uv_b, nbins = 128):
+    # Cosine similarity of the two gridded uv densities (including the
+    # conjugate points), scaled by the ratio of the number of samples
+    if uv_a.shape[1] == 0 or uv_b.shape[1] == 0:
+        return 0.0
+    uvmax = max(np.abs(uv_a).max(), np.abs(uv_b).max())
+    edges = np.linspace(-uvmax, uvmax, nbins + 1)
+    def density(uv):
+        u = np.concatenate([uv[0], -uv[0]])
+        v = np.concatenate([uv[1], -uv[1]])
+        return np.histogram2d(u, v, bins = [edges, edges])[0].ravel()
+    a = density(uv_a)
+    b = density(uv_b)
+    cosine = np.dot(a, b) / np.sqrt(np.dot(a, a) * np.dot(b, b))
+    counts = float(min(uv_a.shape[1], uv_b.shape[1])) / max(uv_a.shape[1], uv_b.shape[1])
+    return float(cosine * counts)
+
+
+def psf_groups(vis, slices, spw = '', psfmatch = 0.95):
+    # Group the (imagename, timerange) slices so that every slice in a group
+    # has similarity >= psfmatch with the first one
+    coverage = dict([(name, uv_coverage(vis, timerange, spw)) for name, timerange in slices])
+    groups = []
+    for name, timerange in slices:
+        for group in groups:
+            similarity = uv_similarity(coverage[group[0]], coverage[name])
+            if similarity >= psfmatch:
+                print('%s shares the PSF of %s (uv similarity %.3f)' % (name, group[0], similarity))
+                group.append(name)
+                break
+        else:
+            groups.append([name])
+    return groups
+
+
+def remove_images(imagename):
+    # Remove the tclean products of imagename
+    for path in glob.glob(imagename + '.*'):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def copy_psf(src, dst, products = PSF_PRODUCTS, scale = 1.0):
+    # Start dst afresh with the PSF (or other) products of src. The sum of
+    # weights and weight images are multiplied by scale, the ratio of the
+    # WEIGHT sums of dst and src, as tclean normalises dst by them.
+    remove_images(dst)
+    for product in products:
+        for path in glob.glob('%s.%s*' % (src, product)):
+            shutil.copytree(path, dst + path[len(src):])
+            if scale != 1.0 and product in WEIGHT_PRODUCTS:
+                scale_image(dst + path[len(src):], scale)
+
+
+def scale_image(imagename, scale):
+    from casatools import image
+    ia = image()
+    ia.open(imagename)
+    ia.putchunk(ia.getchunk() * scale)
+    ia.close()
+
+# ------------------------------------------------------------------------
+# Flux scale check
+
+def check_flux(specs, minsnr = 10.0, fluxtol = 0.05):
+    # Compare a steady source across the slice images (ImageSpecs on the same
+    # grid): the brightest pixel of the first slice is read in every slice.
+    # A slice is flagged if it differs from the first by more than fluxtol
+    # (fractional) and by more than 5 sigma of the two residuals. Returns
+    # {imagename: flux ratio to the first slice} ({} without a source) and
+    # the names of the flagged slices.
+    from casatools import image
+    ia = image()
+    def measure(spec, pos = None):
+        ia.open(spec.product('residual'))
+        rms = 1.4826 * float(ia.statistics(robust = True, verbose = False)['medabsdevmed'][0])
+        ia.close()
+        ia.open(spec.image)
+        if pos is None:
+            pos = [int(p) for p in ia.statistics(verbose = False)['maxpos']]
+        flux = float(ia.getchunk(blc = pos, trc = pos).ravel()[0])
+        ia.close()
+        return flux, rms, pos
+    flux0, rms0, pos = measure(specs[0])
+    if rms0 <= 0 or flux0 < minsnr * rms0:
+        print('Slice flux check: no source above %g sigma in %s' % (minsnr, specs[0].imagename))
+        return {}, []
+    print('Slice flux check at pixel %s (%s peak %.4g Jy/beam, %.1f sigma)' % (pos[:2], specs[0].imagename, flux0, flux0 / rms0))
+    ratios = {}
+    mismatched = []
+    for spec in specs:
+        flux, rms, pos = measure(spec, pos)
+        ratios[spec.imagename] = flux / flux0
+        offset = abs(flux - flux0)
+        bad = offset > fluxtol * flux0 and offset > 5.0 * np.hypot(rms, rms0)
+        print('   %-32s %10.4g %7.3f %s' % (spec.imagename, flux, flux / flux0, 'MISMATCH' if bad else ''))
+        if bad:
+            mismatched.append(spec.imagename)
+    return ratios, mismatched
+
+# ------------------------------------------------------------------------
+# Localisation fields
+
+def fft_size(n):
+    # Smallest even size >= n with no prime factors above 7
+    n = max(int(np.ceil(n)), 2)
+    while True:
+        if n % 2 == 0:
+            m = n
+            for p in [2, 3, 5, 7]:
+                while m % p == 0:
+                    m //= p
+            if m == 1:
+                return n
+        n += 1
+
+
+def to_arcsec(value):
+    # '3arcmin', '0.1deg', '20arcsec' or a number of arcsec
+    if not isinstance(value, str):
+        return float(value)
+    for unit, scale in [('arcsec', 1.0), ('arcmin', 60.0), ('deg', 3600.0)]:
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * scale
+    return float(value)
+
+
+def localisation_pars(ra, dec, radius, cell, frame = 'J2000'):
+    # tclean phasecenter, imsize and cell for a field of the given radius
+    # centred on the candidate position
+    if isinstance(cell, (list, tuple)):
+        cell = cell[0]
+    npix = fft_size(2.0 * to_arcsec(radius) / to_arcsec(cell))
+    return {'phasecenter': '%s %s %s' % (frame, ra, dec), 'imsize': [npix, npix], 'cell': [cell]}
+
+# ------------------------------------------------------------------------
+
+def run_timeslices(slices, spec, executor = None, sharepsf = True, psfmatch = 0.95):
+    # Image the (imagename, timerange) slices with the casa_imaging spec
+    # (its imagename is not used) and export each one to <imagename>.fits.
+    # The slices run in parallel, so none of them writes MODEL_DATA.
+    # A shared PSF is copied with its weights rescaled to each slice. The
+    # WEIGHT sums are not those of the imaging weights (e.g. briggs), so a
+    # slice whose flux scale then disagrees with the first slice is imaged
+    # again with its own PSF; a mismatch that remains raises RuntimeError.
+    executor = executor or casa_imaging.default_executor(3)
+    specs = [spec.derive(name, timerange = timerange, savemodel = 'none') for name, timerange in slices]
+    spw = spec.pars()['spw']
+    if sharepsf and len(slices) > 1:
+        groups = psf_groups(spec.vis, slices, spw = spw, psfmatch = psfmatch)
+    else:
+        groups = [[name] for name, timerange in slices]
+    slice_specs = specs
+    specs = dict([(slice_spec.imagename, slice_spec) for slice_spec in specs])
+    timeranges = dict(slices)
+
+    graph = casa_scheduler.TaskGraph()
+    for group in groups:
+        if len(group) > 1:
+            psfname = group[0] + '_psf'
+            psf_spec = specs[group[0]].derive(psfname, niter = 0, calcres = False, calcpsf = True, restoration = False)
+            psf_spec.export = False
+            casa_imaging.add_image(graph, psf_spec, name = 'psf_' + group[0])
+            weights = dict([(name, weight_sum(spec.vis, timeranges[name], spw)) for name in group])
+        for name in group:
+            if len(group) > 1:
+                scale = weights[name] / weights[group[0]] if weights[group[0]] > 0 else 1.0
+                print('%s: PSF weights of %s scaled by %.4f' % (name, group[0], scale))
+                graph.add('copy_psf_' + name,copy_psf,reads=[psfname],writes=[name],src=psfname,dst=name,scale=scale)
+                casa_imaging.add_image(graph, specs[name].derive(name, calcpsf = False, restart = True))
+            else:
+                casa_imaging.add_image(graph, specs[name])
+
+    t0 = time.time()
+    timings = executor.run(graph)
+    wall = time.time() - t0
+
+    print('Time slice timings (s)')
+    for name, timerange in slices:
+        slice_time = sum([timings.get(step + name, 0.0) for step in ['copy_psf_', '', 'export_']])
+        print('   %-32s %9.1f' % (name, slice_time))
+    for group in groups:
+        if len(group) > 1:
+            print('   %-32s %9.1f (shared by %d slices)' % (group[0] + '_psf', timings['psf_' + group[0]], len(group)))
+    print('   %-32s %9.1f' % ('sum (serial equivalent)', sum(timings.values())))
+    print('   %-32s %9.1f' % ('wall', wall))
+
+    ratios, mismatched = check_flux(slice_specs)
+    shared = [name for group in groups if len(group) > 1 for name in group[1:]]
+    redo = [name for name in mismatched if name in shared]
+    if redo:
+        print('Imaging %s again with their own PSF' % ', '.join(redo))
+        graph = casa_scheduler.TaskGraph()
+        for name in redo:
+            graph.add('reset_' + name,remove_images,writes=[name],imagename=name)
+            casa_imaging.add_image(graph, specs[name], name = 'own_psf_' + name)
+        timings.update(executor.run(graph))
+        ratios, mismatched = check_flux(slice_specs)
+    if mismatched:
+        raise RuntimeError('Flux scale of time slices %s differs from %s' % (', '.join(mismatched), slices[0][0]))
+    return timings
@@ -0,0 +1,248 @@
+# Instrumentation of the CASA task calls made by the pipelines
+# Once start() is called every traced call appends one JSON line to the
+# trace file: the task and its arguments, wall and CPU time, peak RSS, the
+# bytes the process read and wrote (/proc/self/io) and the change in size of
+# the MS, table and image directories it wrote. The calls made through
+# casa_scheduler are traced in the worker that runs them; instrument()
+# wraps the CASA tasks called directly from a pipeline script. At exit a
+# summary table per task is printed. Records carry the pipeline name and
+# the git revision, so traces of different versions can be compared, and
+# the pipeline stage they belong to (casa_stages).
+
+import atexit
+import glob
+import json
+import os
+import resource
+import socket
+import subprocess
+import time
+
+# Tasks wrapped by instrument()
+TASKS = ['flagdata', 'flagmanager', 'setjy', 'gaincal', 'bandpass', 'applycal',
+    'mstransform', 'split', 'tclean', 'immath', 'exportfits']
+# Keyword arguments naming the files a task writes
+OUTPUT_ARGS = ['caltable', 'outputvis', 'outfile', 'fitsimage']
+# Tasks that modify their vis in place
+INPLACE_TASKS = ['flagdata', 'flagmanager', 'setjy', 'applycal', 'gaincal', 'bandpass', 'tclean']
+
+_trace = {}
+
+# ------------------------------------------------------------------------
+# Process counters (Linux only, falls back to zeros elsewhere)
+
+def io_counters():
+    counters = {'rchar': 0, 'wchar': 0, 'read_bytes': 0, 'write_bytes': 0}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+
+def reset_peak_rss():
+    # Start a new high-water mark for peak_rss()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    # Peak resident set size (MB) since reset_peak_rss(), or of the process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def cpu_times():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'cpu_user': own.ru_utime, 'cpu_sys': own.ru_stime,
+        'cpu_children': children.ru_utime + children.ru_stime}
+
+
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+# ------------------------------------------------------------------------
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = here,
+            stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError, NameError):
+        return ''
+
+
+def start(path = 'trace.jsonl', pipeline = '', summary = True):
+    # Trace every call from now on to path (appended to if it exists)
+    _trace.update(path = os.path.abspath(path), pipeline = pipeline, revision = git_revision(),
+        host = socket.gethostname(), run = time.strftime('%Y-%m-%dT%H:%M:%S'))
+    if summary:
+        atexit.register(lambda: print_summary(path, run = _trace['run']))
+
+
+def tracing():
+    return 'path' in _trace
+
+
+def set_stage(stage):
+    # Stage recorded for calls that are not given one
+    _trace['stage'] = stage
+
+
+def output_paths(task, kwargs):
+    # Directories and files a call writes, from its arguments
+    paths = [kwargs[key] for key in OUTPUT_ARGS if kwargs.get(key)]
+    if task in INPLACE_TASKS and kwargs.get('vis'):
+        paths.append(kwargs['vis'])
+    if task == 'tclean' and kwargs.get('imagename'):
+        paths.extend(sorted(glob.glob(kwargs['imagename'] + '.*')) or [kwargs['imagename'] + '.image'])
+    return paths
+
+
+def _arguments(kwargs):
+    # The arguments as JSON, with long lists shortened
+    args = {}
+    for key in sorted(kwargs):
+        value = kwargs[key]
+        if isinstance(value, (list, tuple)) and len(value) > 20:
+            value = list(value[:20]) + ['... %d more' % (len(value) - 20)]
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            value = repr(value)
+        args[key] = value
+    return args
+
+
+def call(task, func, kwargs, label = '', paths = None, stage = None):
+    # Run func(**kwargs) and, when tracing, record it under task (the CASA
+    # task or helper name), label (the pipeline step) and stage
+    if not tracing():
+        return func(**kwargs)
+    if paths is None:
+        paths = output_paths(task, kwargs)
+    sizes = dict([(path, dir_size(path)) for path in paths if os.path.exists(path)])
+    reset_peak_rss()
+    io0 = io_counters()
+    cpu0 = cpu_times()
+    t0 = time.time()
+    error = ''
+    try:
+        return func(**kwargs)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        wall = time.time() - t0
+        io1 = io_counters()
+        cpu1 = cpu_times()
+        if task == 'tclean' and kwargs.get('imagename'):
+            paths = output_paths(task, kwargs)
+        record = {'run': _trace['run'], 'pipeline': _trace['pipeline'], 'revision': _trace['revision'],
+            'host': _trace['host'], 'pid': os.getpid(), 'task': task, 'label': label,
+            'stage': stage or _trace.get('stage') or '',
+            'start': t0, 'wall': wall, 'peak_rss_mb': peak_rss(), 'error': error,
+            'size_change': dict([(path, dir_size(path) - sizes.get(path, 0)) for path in paths if os.path.exists(path)]),
+            'args': _arguments(kwargs)}
+        record.update([(key, cpu1[key] - cpu0[key]) for key in cpu0])
+        record.update([(key, io1[key] - io0[key]) for key in io0])
+        with open(_trace['path'], 'a') as f:
+            f.write(json.dumps(record, sort_keys = True) + '\n')
+
+
+def wrap(task, func):
+    # func traced under the name task
+    def traced(*args, **kwargs):
+        if args:
+            # CASA tasks take everything by keyword; positional calls are
+            # not traced
+            return func(*args, **kwargs)
+        return call(task, func, kwargs)
+    traced.__name__ = getattr(func, '__name__', task)
+    traced.__doc__ = getattr(func, '__doc__', None)
+    traced.__wrapped__ = func
+    return traced
+
+
+def instrument(namespace, tasks = TASKS):
+    # Replace the CASA tasks in namespace (a script's globals()) by traced
+    # versions, importing them from casatasks when they are not there
+    import casatasks
+    for task in tasks:
+        func = namespace.get(task) or getattr(casatasks, task, None)
+        if func is None or hasattr(func, '__wrapped__'):
+            continue
+        namespace[task] = wrap(task, func)
+
+# ------------------------------------------------------------------------
+
+def load(path, run = None):
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                if run is None or record['run'] == run:
+                    records.append(record)
+    return records
+
+
+def summary(records, top = 10):
+    # Per-task totals and the slowest calls, as lines of text
+    lines = ['%-14s %6s %10s %10s %10s %10s %10s %10s' % ('task', 'calls', 'wall (s)', 'cpu (s)', 'rss (MB)', 'read (GB)', 'write (GB)', 'size (GB)')]
+    tasks = {}
+    for record in records:
+        tasks.setdefault(record['task'], []).append(record)
+    for task in sorted(tasks, key = lambda task: -sum([r['wall'] for r in tasks[task]])):
+        group = tasks[task]
+        lines.append('%-14s %6d %10.1f %10.1f %10.0f %10.2f %10.2f %10.2f' % (task, len(group),
+            sum([r['wall'] for r in group]),
+            sum([r['cpu_user'] + r['cpu_sys'] + r['cpu_children'] for r in group]),
+            max([r['peak_rss_mb'] for r in group]),
+            sum([r['read_bytes'] for r in group]) / 1e9,
+            sum([r['write_bytes'] for r in group]) / 1e9,
+            sum([sum(r['size_change'].values()) for r in group]) / 1e9))
+    lines.append('%-14s %6d %10.1f' % ('total', len(records), sum([r['wall'] for r in records])))
+    lines.append('')
+    lines.append('Slowest calls')
+    for record in sorted(records, key = lambda r: -r['wall'])[:top]:
+        lines.append('   %-14s %-32s %10.1f s  %s' % (record['task'], record['label'] or '-', record['wall'], record['error']))
+    return lines
+
+
+def print_summary(path = 'trace.jsonl', run = None):
+    if not os.path.exists(path):
+        return
+    records = load(path, run = run)
+    if records:
+        print('\n'.join(summary(records)))
+
+
+if __name__ == '__main__':
+    # python casa_trace.py trace.jsonl [run]: summary of a trace (all runs
+    # unless one is given)
+    import sys
+    print_summary(sys.argv[1], run = sys.argv[2] if len(sys.argv) > 2 else None)
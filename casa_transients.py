@@ -0,0 +1,134 @@
+# Transient candidate detection on the on-before and on-after difference images
+# Each difference image is memory-mapped and searched one tile at a time
+# (plus a halo, so windows and peaks at tile edges are complete). The noise
+# is a sliding MAD: the MAD sigma in a box x box window centred every
+# box/2 pixels, applied to the pixels nearest each centre. Local maxima
+# above threshold x sigma are candidates; those seen in both differences
+# within matchradius pixels are matched, as a real burst in the 'on' slice
+# shows up in both. Memory use is bounded by the tile size.
+
+import csv
+import warnings
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from numpy.lib.stride_tricks import sliding_window_view
+
+CANDIDATE_COLUMNS = ['id', 'ra_deg', 'dec_deg', 'x', 'y', 'matched',
+    'snr_on_before', 'peak_on_before', 'snr_on_after', 'peak_on_after']
+
+# ------------------------------------------------------------------------
+
+def local_sigma(data, box, step):
+    # Sliding MAD sigma of a 2D array, evaluated every step pixels over a
+    # box x box window and expanded back to the shape of data
+    ny, nx = data.shape
+    half = box // 2
+    padded = np.pad(data.astype(np.float32), half, mode = 'constant', constant_values = np.nan)
+    centres_y = np.arange(step // 2, ny, step)
+    centres_x = np.arange(step // 2, nx, step)
+    windows = sliding_window_view(padded, (box, box))[centres_y[:, None], centres_x[None, :]]
+    windows = windows.reshape((len(centres_y), len(centres_x), -1))
+    with warnings.catch_warnings():
+        # windows that are entirely blank give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(windows, axis = -1)
+        sigma = 1.4826 * np.nanmedian(np.abs(windows - median[..., None]), axis = -1)
+    iy = np.minimum(np.arange(ny) // step, len(centres_y) - 1)
+    ix = np.minimum(np.arange(nx) // step, len(centres_x) - 1)
+    return sigma[iy][:, ix]
+
+
+def local_maxima(snr, threshold):
+    # Pixels above threshold that are the maximum of their 3x3 neighbourhood
+    padded = np.pad(snr, 1, mode = 'constant', constant_values = -np.inf)
+    ny, nx = snr.shape
+    peak = np.isfinite(snr) & (snr >= threshold)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                peak &= snr >= padded[1 + dy:1 + dy + ny, 1 + dx:1 + dx + nx]
+    return np.nonzero(peak)
+
+
+def find_peaks(image, threshold = 6.0, box = 64, tile = 1024):
+    # Candidates of one difference image as arrays of x, y, snr and peak
+    with fits.open(image, memmap = True) as hdul:
+        data = hdul[0].data
+        ny, nx = data.shape[-2:]
+        plane = data.reshape((-1, ny, nx))[0]
+        halo = box // 2 + 1
+        step = max(box // 2, 1)
+        found = {'x': [], 'y': [], 'snr': [], 'peak': []}
+        for y0 in range(0, ny, tile):
+            y1 = min(y0 + tile, ny)
+            for x0 in range(0, nx, tile):
+                x1 = min(x0 + tile, nx)
+                ylo, xlo = max(y0 - halo, 0), max(x0 - halo, 0)
+                region = np.asarray(plane[ylo:min(y1 + halo, ny), xlo:min(x1 + halo, nx)], dtype = np.float32)
+                sigma = local_sigma(region, box, step)
+                with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                    snr = np.where(sigma > 0, region / sigma, np.nan)
+                py, px = local_maxima(snr, threshold)
+                core = (py + ylo >= y0) & (py + ylo < y1) & (px + xlo >= x0) & (px + xlo < x1)
+                py, px = py[core], px[core]
+                found['x'].append(px + xlo)
+                found['y'].append(py + ylo)
+                found['snr'].append(snr[py, px])
+                found['peak'].append(region[py, px])
+        header = hdul[0].header
+    found = dict([(key, np.concatenate(found[key])) for key in found])
+    return found, header
+
+
+def match(a, b, radius):
+    # Index pairs of a and b closer than radius pixels, nearest first
+    if len(a['x']) == 0 or len(b['x']) == 0:
+        return []
+    dist = np.hypot(a['x'][:, None] - b['x'][None, :], a['y'][:, None] - b['y'][None, :])
+    pairs = []
+    used_a, used_b = set(), set()
+    for k in np.argsort(dist, axis = None):
+        i, j = np.unravel_index(k, dist.shape)
+        if dist[i, j] > radius:
+            break
+        if i not in used_a and j not in used_b:
+            pairs.append((i, j))
+            used_a.add(i)
+            used_b.add(j)
+    return pairs
+
+
+def find_transients(on_before, on_after, outfile, threshold = 6.0, box = 64, tile = 1024, matchradius = 3.0):
+    # Search both difference images and write the candidate list to outfile
+    # (CSV). Matched candidates come first, brightest first.
+    cands_b, header = find_peaks(on_before, threshold = threshold, box = box, tile = tile)
+    cands_a, _ = find_peaks(on_after, threshold = threshold, box = box, tile = tile)
+    pairs = match(cands_b, cands_a, matchradius)
+
+    rows = []
+    nan = float('nan')
+    for i, j in pairs:
+        rows.append([cands_b['x'][i], cands_b['y'][i], True, cands_b['snr'][i], cands_b['peak'][i], cands_a['snr'][j], cands_a['peak'][j]])
+    paired_b = set([i for i, j in pairs])
+    paired_a = set([j for i, j in pairs])
+    for i in range(len(cands_b['x'])):
+        if i not in paired_b:
+            rows.append([cands_b['x'][i], cands_b['y'][i], False, cands_b['snr'][i], cands_b['peak'][i], nan, nan])
+    for j in range(len(cands_a['x'])):
+        if j not in paired_a:
+            rows.append([cands_a['x'][j], cands_a['y'][j], False, nan, nan, cands_a['snr'][j], cands_a['peak'][j]])
+    rows.sort(key = lambda row: (not row[2], -np.nanmax([row[3], row[5]])))
+
+    wcs = WCS(header).celestial
+    with open(outfile, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(CANDIDATE_COLUMNS)
+        for n, row in enumerate(rows):
+            ra, dec = wcs.all_pix2world([[row[0], row[1]]], 0)[0]
+            writer.writerow([n, '%.6f' % ra, '%.6f' % dec, int(row[0]), int(row[1]), row[2]] +
+                ['%.3f' % value if np.isfinite(value) else '' for value in row[3:]])
+
+    print('%s: %d candidates, %d seen in both differences' % (outfile, len(rows), len(pairs)))
+    return rows
@@ -0,0 +1,236 @@
+# Tests of the flag version delta store (casa_flagversions) without CASA:
+# the MS is a dict of FLAG and FLAG_ROW arrays per DATA_DESC_ID, read and
+# written through stubs of layout() and _rows()
+
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import casa_flagversions
+
+
+class FakeRows(object):
+
+    def __init__(self, ncorr, nchan, nrow):
+        self.cols = {'FLAG': np.zeros((ncorr, nchan, nrow), dtype = bool), 'FLAG_ROW': np.zeros(nrow, dtype = bool)}
+
+    def getcol(self, column, first, n):
+        return self.cols[column][..., first:first + n].copy()
+
+    def putcol(self, column, value, first, n):
+        self.cols[column][..., first:first + n] = value
+
+
+class FakeMS(object):
+
+    def __init__(self, shapes, seed = 0):
+        # shapes: (ncorr, nchan, nrow) of each DATA_DESC_ID
+        self.rng = np.random.default_rng(seed)
+        self.ddids = [FakeRows(*shape) for shape in shapes]
+        for rows in self.ddids:
+            rows.cols['FLAG'][:] = self.rng.random(rows.cols['FLAG'].shape) < 0.1
+
+    def flags(self):
+        return [dict([(k, v.copy()) for k, v in rows.cols.items()]) for rows in self.ddids]
+
+    def same(self, flags):
+        return all([(rows.cols[k] == saved[k]).all() for rows, saved in zip(self.ddids, flags) for k in saved])
+
+    def change(self, fraction = 0.01):
+        # Flag (and unflag) a few more visibilities and flag a whole row
+        for rows in self.ddids:
+            flags = rows.cols['FLAG']
+            flags ^= self.rng.random(flags.shape) < fraction
+            row = self.rng.integers(flags.shape[2])
+            flags[..., row] = True
+            rows.cols['FLAG_ROW'][row] = True
+
+
+@pytest.fixture
+def ms(tmp_path, monkeypatch):
+    fake = FakeMS([(4, 16, 37), (2, 7, 20)])
+    monkeypatch.setattr(casa_flagversions, 'CHUNKVIS', 500)
+
+    def layout(vis):
+        chunks = []
+        offset = 0
+        for ddid, rows in enumerate(fake.ddids):
+            ncorr, nchan, nrows = rows.cols['FLAG'].shape
+            chunk = max(casa_flagversions.CHUNKVIS // (ncorr * nchan), 1)
+            for first in range(0, nrows, chunk):
+                n = min(chunk, nrows - first)
+                nbytes = (n * ncorr * nchan + 7) // 8 + (n + 7) // 8
+                chunks.append([ddid, first, n, ncorr, nchan, offset, nbytes])
+                offset += nbytes
+        return chunks
+
+    def rows(vis, chunks, nomodify = True):
+        for i, chunk in enumerate(chunks):
+            yield i, fake.ddids[chunk[0]], chunk[1], chunk[2]
+
+    monkeypatch.setattr(casa_flagversions, 'layout', layout)
+    monkeypatch.setattr(casa_flagversions, '_rows', rows)
+    fake.vis = str(tmp_path / 'test.ms')
+    return fake
+
+
+def store_files(store):
+    return sorted(os.listdir(store.path))
+
+
+def index_files(store):
+    return sorted(['index.json'] + [os.path.basename(store._file(entry)) for entry in store.index['versions']])
+
+# ------------------------------------------------------------------------
+
+def test_pack_unpack():
+    rng = np.random.default_rng(1)
+    for ncorr, nchan, n in [(1, 1, 1), (2, 3, 5), (4, 13, 11)]:
+        flags = rng.random((ncorr, nchan, n)) < 0.5
+        flagrow = rng.random(n) < 0.5
+        bits = casa_flagversions.pack(flags, flagrow)
+        assert bits.size == (ncorr * nchan * n + 7) // 8 + (n + 7) // 8
+        flags2, flagrow2 = casa_flagversions.unpack(bits, ncorr, nchan, n)
+        assert (flags2 == flags).all() and (flagrow2 == flagrow).all()
+
+
+def test_encode_decode():
+    rng = np.random.default_rng(2)
+    assert casa_flagversions.encode(np.zeros(100, dtype = np.uint8)) == (None, 0)
+    for fraction, dense in [(0.01, False), (0.9, True)]:
+        xor = np.where(rng.random(1000) < fraction, rng.integers(1, 256, 1000), 0).astype(np.uint8)
+        xor[0] = 7
+        blob, count = casa_flagversions.encode(xor)
+        assert (count < 0) == dense
+        assert (casa_flagversions.decode(blob, count, xor.size) == xor).all()
+
+
+def test_save_restore(ms):
+    store = casa_flagversions.FlagStore(ms.vis)
+    saved = {}
+    for v in range(5):
+        store.save('v%d' % v)
+        saved['v%d' % v] = ms.flags()
+        ms.change()
+    assert [entry['kind'] for entry in store.index['versions']] == ['delta'] * 4 + ['head']
+    # Restore from a fresh load, in an order that goes back and forth
+    store = casa_flagversions.FlagStore(ms.vis)
+    for name in ['v0', 'v3', 'v1', 'v4', 'v2', 'v0']:
+        store.restore(name)
+        assert ms.same(saved[name]), name
+    result = store.diff('v0', 'v4')
+    before, after = saved['v0'], saved['v4']
+    assert result['a'] == sum([int(d['FLAG'].sum()) for d in before])
+    assert result['b'] == sum([int(d['FLAG'].sum()) for d in after])
+    assert result['added'] == sum([int((b['FLAG'] & ~a['FLAG']).sum()) for a, b in zip(before, after)])
+
+
+def test_restore_merge(ms):
+    store = casa_flagversions.FlagStore(ms.vis)
+    store.save('v0')
+    saved = ms.flags()
+    ms.change(0.2)
+    current = ms.flags()
+    store.restore('v0', merge = 'or')
+    for rows, a, b in zip(ms.ddids, saved, current):
+        assert (rows.cols['FLAG'] == (a['FLAG'] | b['FLAG'])).all()
+
+
+def test_save_same_name(ms):
+    store = casa_flagversions.FlagStore(ms.vis)
+    store.save('a')
+    store.save('b')
+    ms.change()
+    store.save('a')
+    saved = ms.flags()
+    assert store.versions() == ['b', 'a']
+    ms.change()
+    store.restore('a')
+    assert ms.same(saved)
+
+
+def test_delete_prune(ms):
+    store = casa_flagversions.FlagStore(ms.vis)
+    saved = {}
+    for v in range(4):
+        store.save('v%d' % v)
+        saved['v%d' % v] = ms.flags()
+        ms.change()
+    # A deleted version in the middle is still needed to rebuild v0
+    store.delete('v1')
+    assert store.versions() == ['v0', 'v2', 'v3']
+    assert len(store.index['versions']) == 4
+    store.restore('v0')
+    assert ms.same(saved['v0'])
+    # Deleting the start of the chain drops it and the unnamed v1 after it
+    store.delete('v0')
+    assert [entry['name'] for entry in store.index['versions']] == ['v2', 'v3']
+    assert store_files(store) == index_files(store)
+    for name in ['v2', 'v3']:
+        store.restore(name)
+        assert ms.same(saved[name])
+    # The head is kept even when it is unnamed
+    store.delete('v3')
+    store.delete('v2')
+    assert [entry['name'] for entry in store.index['versions']] == [None]
+    assert store_files(store) == index_files(store)
+
+
+def test_new_rows(ms):
+    store = casa_flagversions.FlagStore(ms.vis)
+    store.save('v0')
+    ms.change()
+    store.save('v1')
+    old = ms.flags()
+    # Appending rows starts a new chain; the old head is kept whole
+    ms.ddids[1] = FakeRows(2, 7, 30)
+    store.save('v2')
+    saved = ms.flags()
+    assert [entry['kind'] for entry in store.index['versions']] == ['delta', 'full', 'head']
+    with pytest.raises(RuntimeError):
+        store.restore('v1')
+    with pytest.raises(ValueError):
+        store.diff('v1', 'v2')
+    ms.change()
+    store.restore('v2')
+    assert ms.same(saved)
+    assert store.diff('v0', 'v1')['b'] == sum([int(d['FLAG'].sum()) for d in old])
+    # The start of the new chain is pruned as well
+    store.save('v3')
+    store.delete('v2')
+    assert [entry['name'] for entry in store.index['versions']] == ['v0', 'v1', 'v3']
+    assert store_files(store) == index_files(store)
+    store.restore('v3')
+    store.delete('v0')
+    store.delete('v1')
+    assert [entry['name'] for entry in store.index['versions']] == ['v3']
+
+
+def test_interrupted_save(ms):
+    store = casa_flagversions.FlagStore(ms.vis)
+    store.save('v0')
+    ms.change()
+    store.save('v1')
+    saved = ms.flags()
+    # Files of a save that never reached the index commit
+    for name in ['%d.bits' % store.index['next'], '0.delta.tmp']:
+        with open(os.path.join(store.path, name), 'wb') as f:
+            f.write(b'partial')
+    store = casa_flagversions.FlagStore(ms.vis)
+    assert store.versions() == ['v0', 'v1']
+    ms.change()
+    store.save('v2')
+    assert store_files(store) == index_files(store)
+    store.restore('v1')
+    assert ms.same(saved)
+    # A committed file that is missing or cut short is an error
+    head = store.index['versions'][-1]
+    with open(store._file(head), 'r+b') as f:
+        f.truncate(3)
+    with pytest.raises(RuntimeError):
+        casa_flagversions.FlagStore(ms.vis)
+    os.remove(store._file(head))
+    with pytest.raises(RuntimeError):
+        casa_flagversions.FlagStore(ms.vis)